@@ -0,0 +1,281 @@
+from __future__ import annotations
+
+import asyncio
+import copy
+import io
+import os
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, ClassVar, TextIO
+
+import numpy
+
+import Simulator
+from Environment import StimulusHistory, StimulusSummary
+from Experiment import RWArgs
+from HistoryStore import HistoryStore
+from Models import Model
+from ResultCache import ResultCache
+
+# Python interface of the simulator, for notebooks and analysis scripts:
+#
+#   import Api
+#   results = Api.simulate('Control|10A+\nBlocking|10A+|10AB+', model = 'Rescorla Wagner', beta = .4, alpha_A = .3)
+#   results.get('assoc', 'Blocking', 2, 'B')
+#
+# Neither Qt nor Matplotlib are imported. Simulations keep all their state
+# in their own groups, so several can run at once in threads.
+
+# Results of every group as dense arrays.
+# values[g, p, c, t, f] is the value of field f of CS c on recorded trial t of
+# phase p of group g, or NaN if that CS isn't in that phase or has fewer
+# trials. The fields are those of a HistoryStore, with compound as 0 or 1.
+@dataclass
+class Results:
+    groups: list[str]
+    cs: list[str]
+    fields: list[str]
+
+    # Phase strings of every group.
+    phases: dict[str, list[str]]
+
+    values: numpy.ndarray
+
+    # lengths[g, p, c]: number of recorded trials of each CS, 0 if it's absent.
+    lengths: numpy.ndarray
+
+    # Number of every recorded trial, starting from 1 as in the exported results.
+    trials: numpy.ndarray
+
+    # Results as returned by Simulator.runExperiment, for exporting or plotting.
+    strengths: list[dict[str, StimulusHistory]]
+
+    @classmethod
+    def from_groups(cls, groups: dict[str, list[str]], group_strengths: list[list[dict[str, StimulusHistory]]], stride: int = 1) -> Results:
+        names, cs, strengths = merge_groups(groups, group_strengths)
+        num_phases = len(strengths)
+        fields = HistoryStore.fields
+
+        lengths = numpy.zeros((len(names), num_phases, len(cs)), dtype = int)
+        for phase_num, phase in enumerate(strengths):
+            for key, hist in phase.items():
+                group, c = key.rsplit(' - ', maxsplit = 1)
+                lengths[names.index(group), phase_num, cs.index(c)] = len(hist)
+
+        num_trials = int(lengths.max(initial = 0))
+        values = numpy.full((len(names), num_phases, len(cs), num_trials, len(fields)), numpy.nan)
+        for phase_num, phase in enumerate(strengths):
+            for key, hist in phase.items():
+                group, c = key.rsplit(' - ', maxsplit = 1)
+                for e, field in enumerate(fields):
+                    values[names.index(group), phase_num, cs.index(c), :len(hist), e] = numpy.array(getattr(hist, field), dtype = float)
+
+        return cls(
+            groups = names,
+            cs = cs,
+            fields = fields,
+            phases = {name: phase_strs for name, phase_strs in zip(names, groups.values())},
+            values = values,
+            lengths = lengths,
+            trials = numpy.arange(num_trials) * stride + 1,
+            strengths = strengths,
+        )
+
+    # Values of a field of a single CS in a phase of a group, with phases
+    # numbered from 1 as in the experiment file; only its recorded trials.
+    def get(self, field: str, group: str, phase: int, cs: str) -> numpy.ndarray:
+        g, c = self.groups.index(group), self.cs.index(cs)
+        return self.values[g, phase - 1, c, :self.lengths[g, phase - 1, c], self.fields.index(field)]
+
+    # A field of every group, phase, CS and trial.
+    def __getitem__(self, field: str) -> numpy.ndarray:
+        return self.values[..., self.fields.index(field)]
+
+    # Write the results as CSV, as --save-results.
+    def export(self, file: TextIO, should_plot_macknhall: bool = False):
+        StimulusHistory.exportData(self.strengths, file = file, should_plot_macknhall = should_plot_macknhall)
+
+# Summary statistics of every group as dense arrays, when simulating with
+# `summary`, as --summary.
+# values[g, p, c, s, f] is statistic s ('final', 'min' or 'max') of field f
+# of CS c in phase p of group g, and blocks[g, p, c, b, f] is its mean over
+# block b of `block_size` trials; NaN if that CS isn't in that phase or has
+# fewer blocks. The fields are those of StimulusSummary.
+@dataclass
+class Summaries:
+    stats: ClassVar[list[str]] = ['final', 'min', 'max']
+
+    groups: list[str]
+    cs: list[str]
+    fields: list[str]
+
+    # Phase strings of every group.
+    phases: dict[str, list[str]]
+
+    values: numpy.ndarray
+    blocks: numpy.ndarray
+
+    # counts[g, p, c]: number of trials of each CS, 0 if it's absent, and
+    # block_counts[g, p, c, b]: number of those in each of its blocks.
+    counts: numpy.ndarray
+    block_counts: numpy.ndarray
+
+    # Statistics that are exported, as --summary-stats.
+    summary: list[str]
+
+    # Summaries as returned by Simulator.runExperiment, for exporting.
+    summaries: list[dict[str, StimulusSummary]]
+
+    @classmethod
+    def from_groups(cls, groups: dict[str, list[str]], group_summaries: list[list[dict[str, StimulusSummary]]], summary: list[str]) -> Summaries:
+        names, cs, summaries = merge_groups(groups, group_summaries)
+        num_phases = len(summaries)
+        fields = StimulusSummary.fields
+
+        num_blocks = max((len(x.block_counts) for phase in summaries for x in phase.values()), default = 0)
+        values = numpy.full((len(names), num_phases, len(cs), len(cls.stats), len(fields)), numpy.nan)
+        blocks = numpy.full((len(names), num_phases, len(cs), num_blocks, len(fields)), numpy.nan)
+        counts = numpy.zeros((len(names), num_phases, len(cs)), dtype = int)
+        block_counts = numpy.zeros((len(names), num_phases, len(cs), num_blocks), dtype = int)
+        for phase_num, phase in enumerate(summaries):
+            for key, x in phase.items():
+                group, c = key.rsplit(' - ', maxsplit = 1)
+                g = names.index(group)
+                i = cs.index(c)
+
+                counts[g, phase_num, i] = x.count
+                block_counts[g, phase_num, i, :len(x.block_counts)] = x.block_counts
+                for s, stat in enumerate((x.final, x.minimum, x.maximum)):
+                    values[g, phase_num, i, s] = [stat[f] for f in fields]
+                for b, means in enumerate(x.block_means()):
+                    blocks[g, phase_num, i, b] = [means[f] for f in fields]
+
+        return cls(
+            groups = names,
+            cs = cs,
+            fields = fields,
+            phases = {name: phase_strs for name, phase_strs in zip(names, groups.values())},
+            values = values,
+            blocks = blocks,
+            counts = counts,
+            block_counts = block_counts,
+            summary = summary,
+            summaries = summaries,
+        )
+
+    # A statistic of a field of a single CS in a phase of a group, with
+    # phases numbered from 1 as in the experiment file. The 'block'
+    # statistic is the mean of every block.
+    def get(self, stat: str, field: str, group: str, phase: int, cs: str) -> float | numpy.ndarray:
+        g, c, f = self.groups.index(group), self.cs.index(cs), self.fields.index(field)
+        if stat == 'block':
+            return self.blocks[g, phase - 1, c, :numpy.count_nonzero(self.block_counts[g, phase - 1, c]), f]
+
+        return float(self.values[g, phase - 1, c, self.stats.index(stat), f])
+
+    # A statistic of a field of every group, phase and CS; 'block' has an
+    # axis of blocks too.
+    def __getitem__(self, key: tuple[str, str]) -> numpy.ndarray:
+        stat, field = key
+        if stat == 'block':
+            return self.blocks[..., self.fields.index(field)]
+
+        return self.values[..., self.stats.index(stat), self.fields.index(field)]
+
+    # Write the summaries as CSV, as --summary with --save-results.
+    def export(self, file: TextIO, should_plot_macknhall: bool = False):
+        StimulusSummary.exportData(self.summaries, file = file, stats = self.summary, should_plot_macknhall = should_plot_macknhall)
+
+# Results of every group merged by phase, with the names of the groups and
+# of every CS in them, ordered by their number of CS.
+def merge_groups(groups: dict[str, list[str]], group_strengths: list[list[dict[str, Any]]]) -> tuple[list[str], list[str], list[dict[str, Any]]]:
+    num_phases = max((len(x) for x in group_strengths), default = 0)
+    strengths: list[dict[str, Any]] = [{} for _ in range(num_phases)]
+    for local in group_strengths:
+        for phase_num, phase in enumerate(local):
+            strengths[phase_num] |= phase
+
+    names = [name.split('/')[0] for name in groups]
+    keys = [key.rsplit(' - ', maxsplit = 1) for phase in strengths for key in phase]
+    cs = sorted({c for _, c in keys}, key = lambda x: (len(x.strip("'()")), x))
+
+    return names, cs, strengths
+
+# Groups of a design: the text of an experiment file, an open experiment
+# file or its path, or the phases of every group by name, as a list or a
+# "|"-separated string.
+def read_design(design: str | os.PathLike | TextIO | dict[str, str | list[str]]) -> str:
+    if isinstance(design, dict):
+        return '\n'.join(
+            f'{name}|{phases if isinstance(phases, str) else "|".join(phases)}'
+            for name, phases in design.items()
+        )
+
+    if isinstance(design, os.PathLike):
+        return Path(design).read_text()
+
+    if isinstance(design, str):
+        return design
+
+    return design.read()
+
+# Parameters of a simulation: the defaults of the command line, updated with
+# the given ones, named as in RWArgs or as in the "@" lines of an experiment
+# file, such as beta, betan, lambda, or alpha_A for a single CS.
+# `summary` is True to only record every summary statistic, or a list of the
+# ones to export, as --summary-stats.
+def make_args(model: str, params: dict[str, Any]) -> RWArgs:
+    if model not in Model.types():
+        raise ValueError(f'Unknown model {model}; use one of {", ".join(Model.types())}.')
+
+    args = Simulator.default_args()
+    args.model = model
+    for name, value in params.items():
+        if name == 'summary':
+            continue
+
+        try:
+            Simulator.set_experiment_arg(args, name, value)
+        except (KeyError, AttributeError):
+            raise TypeError(f'Unknown parameter {name}.') from None
+
+    summary = params.get('summary')
+    if summary is True:
+        args.summary = list(StimulusSummary.stats)
+    elif summary:
+        unknown = set(summary) - set(StimulusSummary.stats)
+        if unknown:
+            raise ValueError(f"Unknown summary statistics: {', '.join(sorted(unknown))}.")
+
+        args.summary = list(summary)
+
+    return args
+
+# Run every group of a design, as the command line does. Parameters given in
+# the "@" lines of the design apply to the groups after them, overriding the
+# ones given here. Results of groups already run with the same parameters are
+# reused from the cache directory, if given. With `summary`, only the summary
+# statistics are recorded and returned.
+def simulate(design: str | os.PathLike | TextIO | dict[str, str | list[str]], model: str = 'Rescorla Wagner', *, max_workers: None | int = None, cache: None | str | os.PathLike = None, **params) -> Results | Summaries:
+    args = make_args(model, params)
+    result_cache = None if cache is None else ResultCache(cache)
+
+    groups: dict[str, list[str]] = {}
+    group_strengths = []
+    for name, phase_strs in Simulator.parse_experiment_file(io.StringIO(read_design(design)), args):
+        groups[name] = phase_strs
+        local, _ = Simulator.runGroup(name, phase_strs, copy.deepcopy(args), max_workers, result_cache)
+        group_strengths.append(local)
+
+    if not groups:
+        raise ValueError('The design has no groups.')
+
+    if args.summary is not None:
+        return Summaries.from_groups(groups, group_strengths, args.summary)
+
+    return Results.from_groups(groups, group_strengths, args.history_stride)
+
+# `simulate` in a thread, for use with asyncio:
+#   results = await Api.simulate_async(design, beta = .4)
+async def simulate_async(design: str | os.PathLike | TextIO | dict[str, str | list[str]], model: str = 'Rescorla Wagner', *, max_workers: None | int = None, cache: None | str | os.PathLike = None, **params) -> Results | Summaries:
+    return await asyncio.to_thread(simulate, design, model, max_workers = max_workers, cache = cache, **params)
@@ -0,0 +1,122 @@
+from __future__ import annotations
+
+import copy
+import json
+import os
+import time
+from argparse import Namespace
+from concurrent.futures import Future, ProcessPoolExecutor
+from pathlib import Path
+from typing import Any
+
+import Simulator
+from Environment import StimulusHistory, StimulusSummary
+from Experiment import Phase, RWArgs
+from ResultCache import ResultCache
+
+# Run a single group in a worker of the shared pool. Random trials run in the
+# worker itself, since the groups already use every core.
+def run_group(name: str, phase_strs: list[str], args: RWArgs, cache_path: None | str) -> tuple[list[dict[str, StimulusHistory]], list[Phase], float, bool]:
+    start = time.perf_counter()
+
+    cache = None if cache_path is None else ResultCache(cache_path)
+    strengths, phases = Simulator.runGroup(name, phase_strs, args, max_workers = 1, cache = cache)
+
+    return strengths, phases, time.perf_counter() - start, cache is not None and cache.hits > 0
+
+# Run every .rw file of a directory, writing the results and plots of every
+# file to `args.out` along with a manifest.json with their timings.
+# All files are parsed first, and every group of every file is scheduled on a
+# single pool; the results of each file are written as soon as its groups finish.
+def run_directory(args: Namespace, experiment_args: RWArgs) -> dict[str, Any]:
+    start = time.perf_counter()
+
+    files = sorted(Path(args.batch).glob('*.rw'))
+    out = Path(args.out)
+    out.mkdir(parents = True, exist_ok = True)
+
+    cache_path = str(args.cache or out / 'cache')
+
+    # Parameter lines only apply to the rest of their own file.
+    parsed: list[tuple[Path, list[tuple[str, list[str], RWArgs]]]] = []
+    for path in files:
+        file_args = copy.deepcopy(experiment_args)
+        with open(path) as file:
+            groups = [
+                (name, phase_strs, copy.deepcopy(file_args))
+                for name, phase_strs in Simulator.parse_experiment_file(file, file_args)
+            ]
+
+        parsed.append((path, groups))
+
+    parse_time = time.perf_counter() - start
+
+    cpu_count = getattr(os, 'process_cpu_count', os.cpu_count)() or 1
+    manifest: dict[str, Any] = dict(files = [], parse_seconds = parse_time, cache = cache_path)
+
+    with ProcessPoolExecutor(max_workers = args.max_workers or cpu_count) as executor:
+        futures: list[list[Future]] = [
+            [executor.submit(run_group, name, phase_strs, group_args, cache_path) for name, phase_strs, group_args in groups]
+            for _, groups in parsed
+        ]
+
+        for (path, groups), file_futures in zip(parsed, futures):
+            entry = write_results(args, path, out, groups, [f.result() for f in file_futures])
+            manifest['files'].append(entry)
+
+    manifest['total_seconds'] = time.perf_counter() - start
+    with open(out / 'manifest.json', 'w') as file:
+        json.dump(manifest, file, indent = 2)
+
+    return manifest
+
+def write_results(args: Namespace, path: Path, out: Path, groups: list[tuple[str, list[str], RWArgs]], results: list[tuple[list[dict[str, StimulusHistory]], list[Phase], float, bool]]) -> dict[str, Any]:
+    start = time.perf_counter()
+
+    strengths: list[dict] = []
+    phases = {}
+    for (name, _, _), (local, group_phases, _, _) in zip(groups, results):
+        strengths = local if not strengths else [a | b for a, b in zip(strengths, local)]
+        phases[name] = group_phases
+
+    outputs = [str(out / f'{path.stem}.csv')]
+    with open(outputs[0], 'w') as file:
+        if args.summary is not None:
+            StimulusSummary.exportData(strengths, file = file, stats = args.summary, should_plot_macknhall = args.plot_macknhall)
+        else:
+            StimulusHistory.exportData(strengths, file = file, should_plot_macknhall = args.plot_macknhall)
+
+    export_time = time.perf_counter() - start
+
+    # Summaries have no history to plot.
+    if args.summary is None and strengths:
+        from matplotlib import pyplot
+        from Plots import save_plots
+
+        save_plots(
+            strengths,
+            phases = phases,
+            filename = str(out / path.stem),
+            plot_phase = args.plot_phase,
+            plot_alpha = args.plot_alpha,
+            plot_macknhall = args.plot_macknhall,
+            show_title = args.show_title,
+            plot_stimuli = args.plot_stimuli,
+            singular_legend = args.singular_legend,
+            dpi = args.dpi,
+            plot_width = args.output_width,
+        )
+        pyplot.close('all')
+
+        outputs += [str(out / f'{path.stem}_{n}.png') for n in ([args.plot_phase] if args.plot_phase else range(1, len(strengths) + 1))]
+
+    return dict(
+        file = str(path),
+        groups = [
+            dict(name = name, seconds = seconds, cached = cached)
+            for (name, _, _), (_, _, seconds, cached) in zip(groups, results)
+        ],
+        export_seconds = export_time,
+        plot_seconds = time.perf_counter() - start - export_time,
+        outputs = outputs,
+    )
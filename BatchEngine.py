@@ -0,0 +1,354 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+from typing import ClassVar
+
+import numpy
+
+from Environment import CompactHistory, Environment, RecordSpec, StimulusHistory
+from Experiment import Experiment, Phase, RWArgs
+from HistoryStore import ArrayHistory, HistoryStore
+from Models import Model, RunParameters
+
+# State of every CS across a batch of simulations. Every field of a Stimulus
+# is an array with one row per simulation and one column per CS.
+class StimulusBatch:
+    fields: ClassVar[list[str]] = [
+        'assoc', 'Ve', 'Vi',
+        'alpha', 'alpha_mack', 'alpha_hall',
+        'salience', 'habituation', 'rho', 'nu',
+        'alpha_0', 'alpha_mack_0', 'alpha_hall_0',
+    ]
+
+    def __init__(self, **values: numpy.ndarray):
+        for f in self.fields:
+            setattr(self, f, values[f])
+
+    def copy(self) -> StimulusBatch:
+        return StimulusBatch(**{f: getattr(self, f) for f in self.fields})
+
+    # Repeat every row `reps` times, as row r * reps + p.
+    def repeat(self, reps: int) -> StimulusBatch:
+        return StimulusBatch(**{f: numpy.repeat(getattr(self, f), reps, axis = 0) for f in self.fields})
+
+    # Average every `reps` consecutive rows, undoing `repeat`.
+    def avg(self, reps: int) -> StimulusBatch:
+        def avg(x):
+            x = x / reps
+            return x.reshape(-1, reps, x.shape[1]).sum(axis = 1)
+
+        return StimulusBatch(**{f: avg(getattr(self, f)) for f in self.fields})
+
+# Everything needed to run a single phase, which doesn't depend on the parameters.
+@dataclass
+class PhasePlan:
+    phase: Phase
+
+    # Distinct (part, plus) trials of the phase, and the index of every trial in it.
+    types: list[tuple[str, str]]
+    elems: numpy.ndarray
+
+    # Sparse incidence of the CS, configural cues included, in every trial
+    # type: members[t, k] is the column of the kth CS of trial type t, where
+    # valid[t, k]. Rows are padded with column 0 up to the largest compound,
+    # so that a trial only reads and updates the columns of its own CS.
+    members: numpy.ndarray
+    valid: numpy.ndarray
+
+    # 2 for '++', 1 for '+', and 0 for '-' trial types.
+    plus: numpy.ndarray
+
+    # Recorded histories, their number of recorded trials, and where they
+    # start in the phase results.
+    keys: list[str]
+    lengths: list[int]
+    offsets: numpy.ndarray
+
+    # For every trial type, the keys it records and the column where their
+    # value comes from. Column n_cs is the sum of the trial compound, and rows
+    # are padded with the key len(keys).
+    type_keys: numpy.ndarray
+    type_sources: numpy.ndarray
+
+# Run an experiment for many parameter sets at once, with numpy.
+# Parameter sets are a dimension of the state arrays, and so are the random
+# orders of random phases, which are averaged at the end of the phase as
+# Experiment.run_random_trials does. Every trial updates all its CS at once,
+# which gives the same results as Group.runPhase, since within a trial every
+# step only changes its own CS.
+# All parameter sets must use the same model and number of random trials. By
+# default they share the random orders of every phase, so that their
+# differences are only due to the parameters.
+class BatchEngine:
+    experiment: Experiment
+    args: list[RWArgs]
+    record: RecordSpec
+
+    # Whether compounds include their configural cue, and the names of the
+    # CS, configural cues included, as columns of the state arrays.
+    configural_cues: bool
+    cs: list[str]
+    initial: StimulusBatch
+
+    model: Model
+    num_trials: int
+    plans: list[PhasePlan]
+
+    rng: numpy.random.Generator
+    shared_orders: bool
+
+    def __init__(self, experiment: Experiment, args: list[RWArgs], seed: None | int = None, shared_orders: bool = True):
+        if not args:
+            raise ValueError('At least one set of parameters is needed.')
+
+        if len({a.model for a in args}) != 1:
+            raise ValueError('All parameter sets of a batch must use the same model.')
+
+        if len({a.num_trials for a in args}) != 1:
+            raise ValueError('All parameter sets of a batch must use the same number of random trials.')
+
+        if len({experiment.configural_cues(a) for a in args}) != 1:
+            raise ValueError('All parameter sets of a batch must use the same configural cues.')
+
+        self.experiment = experiment
+        self.args = args
+        self.record = experiment.record_spec(args[0])
+        self.num_trials = args[0].num_trials
+        self.rng = numpy.random.default_rng(seed)
+        self.shared_orders = shared_orders
+
+        self.configural_cues = experiment.configural_cues(args[0])
+
+        groups = [experiment.initial_group(a) for a in args]
+        self.cs = sorted(groups[0].s.s.keys())
+        if any(sorted(g.s.s.keys()) != self.cs for g in groups):
+            raise ValueError('All parameter sets of a batch must define the same CS.')
+
+        self.plans = [self.plan_phase(phase) for phase in experiment.phases]
+
+        if not Model.base(args[0].model).has_step_batch():
+            raise ValueError(f'Model {args[0].model} cannot be run in batches.')
+
+        self.initial = StimulusBatch(**{
+            f: numpy.array(
+                [[getattr(g.s.s[cs], f) for cs in self.cs] for g in groups],
+                dtype = float,
+            ).reshape(len(groups), len(self.cs))
+            for f in StimulusBatch.fields
+        })
+
+        params = ['betan', 'betap', 'lamda', 'gamma', 'thetaE', 'thetaI', 'kay']
+        self.model = Model.get(
+            args[0].model,
+            xi_hall = args[0].xi_hall,
+            **{p: numpy.array([[getattr(g.model, p)] for g in groups], dtype = float) for p in params},
+        )
+
+    def plan_phase(self, phase: Phase) -> PhasePlan:
+        column = {cs: c for c, cs in enumerate(self.cs)}
+        n_cs = len(self.cs)
+
+        types = sorted(set(phase.elems))
+        type_num = {t: e for e, t in enumerate(types)}
+
+        type_columns = [sorted(column[cs] for cs in set(Environment.list_cs(part, self.configural_cues))) for part, _ in types]
+        size = max((len(x) for x in type_columns), default = 0)
+        members = numpy.zeros((len(types), size), dtype = int)
+        valid = numpy.zeros((len(types), size), dtype = bool)
+        for e, columns in enumerate(type_columns):
+            members[e, :len(columns)] = columns
+            valid[e, :len(columns)] = True
+
+        plus = numpy.array([{'++': 2, '+': 1}.get(plus, 0) for _, plus in types], dtype = int)
+
+        key_num: dict[str, int] = {}
+        type_records = []
+        for part, plus_str in types:
+            compounds = Environment.list_cs(part, self.configural_cues)
+
+            records = []
+            for key, cs in self.record.trial_keys(self.experiment.name, part, plus_str, compounds):
+                records.append((key_num.setdefault(key, len(key_num)), column[cs] if cs in column else n_cs))
+
+            type_records.append(records)
+
+        # Keys are numbered by their first trial type, not their first trial;
+        # order them as Group.runPhase does.
+        first = {}
+        for part, plus_str in phase.elems:
+            for key, _ in self.record.trial_keys(self.experiment.name, part, plus_str, Environment.list_cs(part, self.configural_cues)):
+                first.setdefault(key, len(first))
+
+        keys = sorted(key_num, key = first.__getitem__)
+        renumber = {key_num[k]: e for e, k in enumerate(keys)}
+
+        occurrences = numpy.zeros(len(keys), dtype = int)
+        for t in (type_num[x] for x in phase.elems):
+            for key, _ in type_records[t]:
+                occurrences[renumber[key]] += 1
+
+        stride = self.record.stride
+        lengths = [int(-(-x // stride)) for x in occurrences]
+        offsets = numpy.concatenate([[0], numpy.cumsum(lengths)]).astype(int)
+
+        width = max((len(x) for x in type_records), default = 0)
+        type_keys = numpy.full((len(types), width), len(keys), dtype = int)
+        type_sources = numpy.full((len(types), width), n_cs, dtype = int)
+        for t, records in enumerate(type_records):
+            for e, (key, source) in enumerate(records):
+                type_keys[t, e] = renumber[key]
+                type_sources[t, e] = source
+
+        return PhasePlan(
+            phase = phase,
+            types = types,
+            elems = numpy.array([type_num[x] for x in phase.elems], dtype = int),
+            members = members,
+            valid = valid,
+            plus = plus,
+            keys = keys,
+            lengths = lengths,
+            offsets = offsets,
+            type_keys = type_keys,
+            type_sources = type_sources,
+        )
+
+    # Model with its parameters repeated for `reps` rows per parameter set.
+    def repeated_model(self, reps: int) -> Model:
+        if reps == 1:
+            return self.model
+
+        params = ['betan', 'betap', 'lamda', 'gamma', 'thetaE', 'thetaI', 'kay']
+        return Model.get(
+            self.args[0].model,
+            xi_hall = self.model.xi_hall,
+            **{p: numpy.repeat(getattr(self.model, p), reps, axis = 0) for p in params},
+        )
+
+    # Random orders of the trials of a phase, one row per random trial.
+    def orders(self, plan: PhasePlan, num_rows: int) -> numpy.ndarray:
+        return self.rng.random((num_rows, len(plan.elems))).argsort(axis = 1)
+
+    # Run a single phase from `state`, returning the final state and the
+    # recorded histories: an array with one row per parameter set, and the
+    # trials of every key one after another, with one column per HistoryStore field.
+    def run_phase(self, state: StimulusBatch, plan: PhasePlan) -> tuple[StimulusBatch, numpy.ndarray]:
+        num_sets = len(self.args)
+        n_cs = len(self.cs)
+
+        if plan.phase.rand:
+            reps = self.num_trials
+            if self.shared_orders:
+                types = numpy.tile(plan.elems[self.orders(plan, reps)], (num_sets, 1))
+            else:
+                types = plan.elems[self.orders(plan, num_sets * reps)]
+            state = state.repeat(reps)
+        else:
+            reps = 1
+            types = numpy.broadcast_to(plan.elems, (num_sets, len(plan.elems)))
+
+        num_rows = num_sets * reps
+        rows = numpy.arange(num_rows)[:, None]
+        param_rows = numpy.broadcast_to(rows // reps, (num_rows, plan.type_keys.shape[1]))
+
+        model = self.repeated_model(reps)
+        betap = plan.phase.beta or model.betap
+        lamda = plan.phase.lamda or model.lamda
+
+        fields = CompactHistory.fields
+        hist = numpy.zeros((num_sets, plan.offsets[-1], len(HistoryStore.fields)))
+        offsets = numpy.append(plan.offsets[:-1], 0)
+        counts = numpy.zeros((num_rows, len(plan.keys) + 1), dtype = int)
+
+        # The trials update the state arrays in place.
+        if reps == 1:
+            state = StimulusBatch(**{f: getattr(state, f).copy() for f in StimulusBatch.fields})
+
+        for trial_num, trial_types in enumerate(types.T, start = 1):
+            columns = plan.members[trial_types]
+            valid = plan.valid[trial_types]
+            plus = plan.plus[trial_types][:, None]
+
+            # State of the CS of every trial, one column per CS of its compound,
+            # gathered by their flat index in the state arrays.
+            indices = rows * n_cs + columns
+            trial = StimulusBatch(**{f: getattr(state, f).take(indices) for f in StimulusBatch.fields})
+
+            # Record every key of the trial before updating it; this is a predictive model.
+            keys = plan.type_keys[trial_types]
+            sources = plan.type_sources[trial_types]
+            compound = sources == n_cs
+            single = numpy.minimum(sources, n_cs - 1)
+
+            recorded = numpy.empty(keys.shape + (len(HistoryStore.fields),))
+            for e, f in enumerate(fields):
+                total = numpy.where(valid, getattr(trial, f), 0.).sum(axis = 1, keepdims = True)
+                recorded[..., e] = numpy.where(compound, total, getattr(state, f).take(rows * n_cs + single))
+            recorded[..., len(fields)] = compound
+
+            occurrence = counts[rows, keys]
+            counts[rows, keys] += 1
+
+            keep = (keys < len(plan.keys)) & (occurrence % self.record.stride == 0)
+            slots = offsets[keys] + occurrence // self.record.stride
+            numpy.add.at(hist, (param_rows[keep], slots[keep]), recorded[keep] / reps)
+
+            # We need to calculate max_{i != cs} V_i.
+            # This is always either the maximum V_i, or the second maximum when i = cs.
+            masked = numpy.where(valid, trial.assoc, -numpy.inf)
+            argmax = masked.argmax(axis = 1)
+            maxAssoc = masked.max(axis = 1, keepdims = True)
+            masked[rows[:, 0], argmax] = -numpy.inf
+            secondMaxAssoc = masked.max(axis = 1, keepdims = True)
+            secondMaxAssoc = numpy.where(numpy.isfinite(secondMaxAssoc), secondMaxAssoc, 0.)
+
+            rp = RunParameters(
+                beta = numpy.where(plus == 2, 2 * betap, numpy.where(plus == 1, betap, model.betan)),
+                lamda = numpy.where(plus > 0, lamda, 0.),
+                sign = numpy.where(plus > 0, 1, -1),
+                sigma = numpy.where(valid, trial.assoc, 0.).sum(axis = 1, keepdims = True),
+                sigmaE = numpy.where(valid, trial.Ve, 0.).sum(axis = 1, keepdims = True),
+                sigmaI = numpy.where(valid, trial.Vi, 0.).sum(axis = 1, keepdims = True),
+                count = valid.sum(axis = 1, keepdims = True),
+                maxAssocRest = numpy.where(numpy.arange(columns.shape[1]) == argmax[:, None], secondMaxAssoc, maxAssoc),
+                trial_num = trial_num,
+            )
+
+            # Padding columns are computed too, and discarded.
+            with numpy.errstate(all = 'ignore'):
+                model.run_step_batch(trial, rp)
+
+            updated = indices[valid]
+            for f in StimulusBatch.fields:
+                getattr(state, f).put(updated, getattr(trial, f)[valid])
+
+        if reps > 1:
+            state = state.avg(reps)
+
+        return state, hist
+
+    # Run all the phases, returning the histories of every phase: a dictionary
+    # from key to an array with one row per parameter set, one row per
+    # recorded trial, and one column per HistoryStore field.
+    def run(self) -> list[dict[str, numpy.ndarray]]:
+        state = self.initial
+        results = []
+        for plan in self.plans:
+            state, hist = self.run_phase(state, plan)
+            hist = hist.astype(self.record.precision, copy = False)
+            results.append({
+                key: hist[:, plan.offsets[e] : plan.offsets[e + 1]]
+                for e, key in enumerate(plan.keys)
+            })
+
+        return results
+
+    # Results of the parameter set `num`, in the same form as Experiment.run_all_phases.
+    def strengths(self, results: list[dict[str, numpy.ndarray]], num: int) -> list[dict[str, StimulusHistory]]:
+        return [
+            {
+                f'{self.experiment.name} - {key.replace("(", "q(")}': ArrayHistory(hist[num], 0, hist.shape[1], self.record.stride)
+                for key, hist in phase.items()
+            }
+            for phase in results
+        ]
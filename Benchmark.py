@@ -0,0 +1,302 @@
+from __future__ import annotations
+
+import argparse
+import copy
+import io
+import json
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any
+
+import numpy
+
+import Simulator
+from Environment import StimulusHistory
+from Experiment import RWArgs
+from Models import Model
+from version import __version__
+
+# A single design to benchmark: the text of an experiment file, run with a given model.
+@dataclass
+class Case:
+    name: str
+    source: str
+    model: str
+    tags: dict[str, Any] = field(default_factory = dict)
+
+# Letters of the CSs of synthetic designs.
+letters = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+
+# Synthetic designs scaling a single dimension, by the dimension and its sizes.
+# Each one is an experiment file: a compound of CSs is trained and then one
+# of its CSs is extinguished.
+def synthetic_design(stimuli: int = 2, groups: int = 1, trials: int = 20, num_trials: None | int = None) -> str:
+    compound = letters[:stimuli]
+    if num_trials is None:
+        phases = f'{trials}{compound}+|{trials}{compound[0]}-'
+        lines = []
+    else:
+        phases = f'rand/{trials}{compound}+/{trials}{compound[0]}-'
+        lines = [f'@num_trials={num_trials}']
+
+    return '\n'.join(lines + [f'G{n}|{phases}' for n in range(1, groups + 1)]) + '\n'
+
+scales = {
+    'stimuli': [1, 2, 4, 8, 16, 26],
+    'groups': [1, 2, 4, 8, 16],
+    'trials': [10, 100, 1000, 5000],
+    'num_trials': [10, 100, 1000],
+}
+
+def synthetic_cases(models: list[str], quick: bool = False) -> list[Case]:
+    cases = []
+    for dimension, sizes in scales.items():
+        for size in sizes[:2] if quick else sizes:
+            source = synthetic_design(**{dimension: size})
+            cases += [Case(f'synthetic/{dimension}={size} [{model}]', source, model, {dimension: size}) for model in models]
+
+    return cases
+
+def experiment_cases(files: list[Path], models: list[str]) -> list[Case]:
+    return [Case(f'{path.parent.name}/{path.name} [{model}]', path.read_text(), model) for path in files for model in models]
+
+# Peak resident set size of this process and its finished children, in MiB.
+# Forked processes start from the peak of their parent, which is small since
+# the benchmark itself doesn't simulate anything.
+def peak_rss() -> float:
+    kib = max(resource.getrusage(who).ru_maxrss for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN))
+    return kib / 1024
+
+# Run a case `repeat` times, keeping the fastest run. Meant to run in a fresh
+# process, so that its peak RSS belongs to the case alone.
+def run_case(case: Case, base: RWArgs, repeat: int, plots: bool, seed: int, max_workers: None | int = None) -> dict[str, Any]:
+    best: None | dict[str, float] = None
+    trials = 0
+
+    for _ in range(repeat):
+        random.seed(seed)
+        stages = {}
+
+        start = time.perf_counter()
+        args = copy.deepcopy(base)
+        groups = []
+        for name, phase_strs in Simulator.parse_experiment_file(io.StringIO(case.source), args):
+            group_args = copy.deepcopy(args)
+            group_args.model = case.model
+            groups.append((name, phase_strs, group_args))
+
+        stages['parse'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        groups_strengths: list[dict[str, StimulusHistory]] = []
+        phases = {}
+        trials = 0
+        for name, phase_strs, group_args in groups:
+            local, phases[name] = Simulator.runGroup(name, phase_strs, group_args, max_workers)
+            groups_strengths = local if not groups_strengths else [a | b for a, b in zip(groups_strengths, local)]
+            trials += sum(len(p.elems) * (group_args.num_trials if p.rand else 1) for p in phases[name])
+
+        stages['simulate'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        StimulusHistory.exportData(groups_strengths, file = io.StringIO())
+        stages['export'] = time.perf_counter() - start
+
+        if plots:
+            from matplotlib import pyplot
+            from Plots import save_plots
+
+            start = time.perf_counter()
+            with tempfile.TemporaryDirectory() as directory:
+                save_plots(groups_strengths, phases = phases, filename = f'{directory}/plot')
+            pyplot.close('all')
+            stages['plot'] = time.perf_counter() - start
+
+        if best is None or sum(stages.values()) < sum(best.values()):
+            best = stages
+
+    assert best is not None
+    wall = sum(best.values())
+
+    return dict(
+        model = case.model,
+        tags = case.tags,
+        wall_seconds = wall,
+        trials = trials,
+        trials_per_second = trials / best['simulate'] if best['simulate'] > 0 else None,
+        peak_rss_mib = peak_rss(),
+        stages = best,
+    )
+
+# Commands of the command-line interface whose startup is timed, by name, as
+# arguments of PALMS.py; "{design}" is replaced by a small synthetic design.
+# None of them draws a figure, so they must not import any of `heavy_modules`.
+startup_commands = {
+    'startup/cli --help': ['cli', '--help'],
+    'startup/cli --print-results': ['cli', '{design}', '--print-results'],
+}
+heavy_modules = ['PySide6', 'PavlovianApp', 'matplotlib', 'seaborn', 'colorcet', 'Plots']
+
+# Top-level names of the modules imported by a command, from -X importtime.
+def imported_modules(command: list[str]) -> set[str]:
+    process = subprocess.run([sys.executable, '-X', 'importtime'] + command, capture_output = True, text = True, check = True)
+    return {
+        line.rsplit('|', maxsplit = 1)[-1].strip().split('.')[0]
+        for line in process.stderr.splitlines()
+        if line.startswith('import time:')
+    }
+
+# Run a command in a new interpreter `repeat` times, keeping the fastest run,
+# and check it against the startup budget.
+def run_startup(arguments: list[str], repeat: int, budget: float) -> dict[str, Any]:
+    with tempfile.TemporaryDirectory() as directory:
+        design = Path(directory) / 'design.rw'
+        design.write_text(synthetic_design())
+
+        command = [str(Path(__file__).parent / 'PALMS.py')] + [x.replace('{design}', str(design)) for x in arguments]
+
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            subprocess.run([sys.executable] + command, capture_output = True, check = True)
+            wall = time.perf_counter() - start
+            best = wall if best is None else min(best, wall)
+
+        heavy = sorted(imported_modules(command) & set(heavy_modules))
+
+    assert best is not None
+    return dict(
+        wall_seconds = best,
+        budget_seconds = budget,
+        heavy_modules = heavy,
+        ok = best <= budget and not heavy,
+    )
+
+# Cases whose wall time grew by more than `threshold`, relative to the
+# previous results, and by more than `min_delta` seconds, so that the timer
+# noise of the smallest cases is ignored. Returns (name, previous, current).
+def regressions(previous: dict[str, Any], current: dict[str, Any], threshold: float, min_delta: float = 0.) -> list[tuple[str, float, float]]:
+    slower = []
+    for name, result in current['cases'].items():
+        if name not in previous['cases']:
+            continue
+
+        before, after = previous['cases'][name]['wall_seconds'], result['wall_seconds']
+        if after > (1 + threshold) * before and after - before > min_delta:
+            slower.append((name, before, after))
+
+    return slower
+
+def parse_args() -> tuple[argparse.Namespace, argparse.Namespace]:
+    parser = argparse.ArgumentParser(
+        description = 'Benchmark the simulator over the bundled experiments and synthetic designs.',
+        formatter_class = argparse.RawTextHelpFormatter,
+        epilog = f'''\
+Every experiment file is run with every model, and so are synthetic designs
+scaling each of: {", ".join(scales)}. Every case runs in a fresh process,
+reporting its wall time, trials per second, peak RSS and the time of every
+stage. The startup of the command-line interface is timed first, and must fit
+in the startup budget without importing Qt or Matplotlib. Any other option of the command-line interface sets the parameters of
+the cases; the experiment file argument is ignored.
+
+Example:
+  %(prog)s --save bench.json
+  %(prog)s --compare bench.json --threshold 0.1
+''',
+    )
+    parser.add_argument('--experiments', metavar = 'directory', default = str(Path(__file__).parent / 'Experiments'), help = 'Directory of the .rw files to benchmark.')
+    parser.add_argument('--models', metavar = 'model', nargs = '*', choices = list(Model.types()), default = list(Model.types()), help = 'Models to run every case with. Default: every model.')
+    parser.add_argument('--no-experiments', action = 'store_true', help = 'Skip the experiment files.')
+    parser.add_argument('--no-synthetic', action = 'store_true', help = 'Skip the synthetic designs.')
+    parser.add_argument('--no-startup', action = 'store_true', help = 'Skip timing the startup of the command-line interface.')
+    parser.add_argument('--startup-budget', metavar = 'seconds', type = float, default = .5, help = 'Longest startup of the command-line interface allowed; exits with an error if exceeded.')
+    parser.add_argument('--quick', action = 'store_true', help = 'Only run the two smallest sizes of every synthetic design.')
+    parser.add_argument('--match', metavar = 'text', help = 'Only run the cases whose name contains this text.')
+    parser.add_argument('--repeat', type = int, default = 3, help = 'Number of runs of every case; the fastest one is kept.')
+    parser.add_argument('--plots', action = 'store_true', help = 'Also time saving the figures.')
+    parser.add_argument('--seed', type = int, default = 0, help = 'Seed for the random orders of randomised phases.')
+    parser.add_argument('--save', metavar = 'filename', help = 'Save the results as JSON.')
+    parser.add_argument('--compare', metavar = 'filename', type = argparse.FileType('r'), help = 'Compare against the JSON results of a previous run; exits with an error if any case regressed.')
+    parser.add_argument('--threshold', type = float, default = .1, help = 'Relative increase of the wall time of a case considered a regression.')
+    parser.add_argument('--min-delta', metavar = 'seconds', type = float, default = .05, help = 'Increase of the wall time of a case, in seconds, below which it is never a regression.')
+
+    args, rest = parser.parse_known_args()
+    sys.argv[1:] = rest
+    return args, Simulator.parse_args()
+
+def main():
+    bench_args, args = parse_args()
+
+    base = RWArgs(
+        **{k: v for k, v in args.__dict__.items() if k in set(RWArgs.__match_args__) and v is not None}
+    )
+
+    cases = []
+    if not bench_args.no_experiments:
+        cases += experiment_cases(sorted(Path(bench_args.experiments).glob('*.rw')), bench_args.models)
+    if not bench_args.no_synthetic:
+        cases += synthetic_cases(bench_args.models, bench_args.quick)
+    if bench_args.match is not None:
+        cases = [case for case in cases if bench_args.match in case.name]
+
+    results: dict[str, Any] = dict(
+        version = __version__,
+        python = platform.python_version(),
+        numpy = numpy.__version__,
+        platform = platform.platform(),
+        cases = {},
+    )
+
+    over_budget = []
+    if not bench_args.no_startup:
+        print(f'{"Startup":70} {"Wall (s)":>10} {"Budget (s)":>12}', file = sys.stderr)
+        for name, arguments in startup_commands.items():
+            if bench_args.match is not None and bench_args.match not in name:
+                continue
+
+            result = run_startup(arguments, bench_args.repeat, bench_args.startup_budget)
+            results['cases'][name] = result
+            print(f'{name:70} {result["wall_seconds"]:10.4f} {result["budget_seconds"]:12.4f}', file = sys.stderr)
+
+            if not result['ok']:
+                over_budget.append(name)
+                if result['heavy_modules']:
+                    print(f'{name} imports {", ".join(result["heavy_modules"])}.', file = sys.stderr)
+
+    print(f'{"Case":70} {"Wall (s)":>10} {"Trials/s":>12} {"RSS (MiB)":>10}', file = sys.stderr)
+
+    # Cases run one at a time, each in a new process, started as the pools of
+    # randomised phases are.
+    for case in cases:
+        with ProcessPoolExecutor(max_workers = 1) as executor:
+            result = executor.submit(run_case, case, base, bench_args.repeat, bench_args.plots, bench_args.seed, args.max_workers).result()
+
+        results['cases'][case.name] = result
+        print(f'{case.name:70} {result["wall_seconds"]:10.4f} {result["trials_per_second"] or 0:12.0f} {result["peak_rss_mib"]:10.1f}', file = sys.stderr)
+
+    if bench_args.save is not None:
+        with open(bench_args.save, 'w') as file:
+            json.dump(results, file, indent = 2)
+
+    slower = []
+    if bench_args.compare is not None:
+        slower = regressions(json.load(bench_args.compare), results, bench_args.threshold, bench_args.min_delta)
+        for name, previous, current in slower:
+            print(f'Regression: {name}: {previous:.4f}s -> {current:.4f}s ({current / previous - 1:+.0%})', file = sys.stderr)
+
+    for name in over_budget:
+        print(f'Over the startup budget: {name}.', file = sys.stderr)
+
+    if slower or over_budget:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
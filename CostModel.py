@@ -0,0 +1,130 @@
+from __future__ import annotations
+
+import os
+import pickle
+import sys
+import threading
+import time
+from typing import ClassVar, Type
+
+from Counters import Counters
+from Models import Model
+
+# Estimates of the wall time of the random trials of a phase, used to choose
+# how they run when the executor is 'auto': serially, or split in tasks on
+# threads or processes. Small phases never pay for a pool, and large ones
+# use every CPU.
+# The costs of a step of every model, of averaging the histories of random
+# trials and of sending stimuli to a worker are measured with a short
+# micro-benchmark the first time they're needed; the overheads of pools are
+# defaults, and the start of processes is updated when a pool is started.
+class CostModel:
+    # Seconds of a step of a single CS, by model.
+    step_seconds: ClassVar[dict[Type[Model], float]] = {}
+
+    # Seconds to add a single stimulus of a random trial to the averages.
+    avg_seconds: ClassVar[None | float] = None
+
+    # Seconds to pickle and unpickle a single stimulus, in either direction.
+    transfer_seconds: ClassVar[None | float] = None
+
+    # Seconds to send a task to a running worker and get its result back,
+    # besides its data, and to start a worker process.
+    process_task_seconds: ClassVar[float] = 1e-3
+    process_start_seconds: ClassVar[float] = 2e-2
+
+    # Seconds to run a task in a thread, and to start a thread.
+    thread_task_seconds: ClassVar[float] = 1e-4
+    thread_start_seconds: ClassVar[float] = 1e-4
+
+    lock: ClassVar[threading.Lock] = threading.Lock()
+
+    # Measure the cost of a step of `model` by running a small phase serially,
+    # along with the costs of averaging and sending its results.
+    @classmethod
+    def calibrate(cls, model: Type[Model]) -> float:
+        with cls.lock:
+            if model in cls.step_seconds:
+                return cls.step_seconds[model]
+
+            # Imported here, since Experiment itself uses the cost model.
+            import Simulator
+            from Environment import Environment
+            from Experiment import Experiment
+
+            args = Simulator.default_args()
+            args.model = next(name for name, type_ in Model.types().items() if type_ is model)
+            experiment = Experiment('calibration', ['4AB+/4AC-/4B-'])
+            group = experiment.initial_group(args)
+            steps_per_run = 4 * (2 + 2 + 1)
+
+            # The calibration isn't counted as part of the run.
+            with Counters.scope(include = False):
+                hists = []
+                best = float('inf')
+                for _ in range(5):
+                    group.s = experiment.initial_group(args).s
+                    start = time.perf_counter()
+                    hists.append(group.runPhase(experiment.phases[0].elems, None, None))
+                    best = min(best, time.perf_counter() - start)
+
+                cls.step_seconds[model] = best / steps_per_run
+
+                if cls.avg_seconds is None:
+                    start = time.perf_counter()
+                    for x in range(len(hists[0])):
+                        Environment.avg([h[x] for h in hists], len(hists))
+                    cls.avg_seconds = (time.perf_counter() - start) / (len(hists) * len(hists[0]) * len(group.s.s))
+
+                if cls.transfer_seconds is None:
+                    start = time.perf_counter()
+                    pickle.loads(pickle.dumps(group.s))
+                    cls.transfer_seconds = (time.perf_counter() - start) / len(group.s.s)
+
+            return cls.step_seconds[model]
+
+    # Record the time it took to start a pool of processes.
+    @classmethod
+    def observe_pool_start(cls, workers: int, seconds: float):
+        cls.process_start_seconds = seconds / workers
+
+    # Seconds of running `steps` steps of `model` and averaging `stimuli`
+    # stimuli of their histories, on a single CPU.
+    @classmethod
+    def work(cls, model: Type[Model], steps: int, stimuli: int) -> float:
+        step_seconds = cls.calibrate(model)
+        assert cls.avg_seconds is not None
+        return steps * step_seconds + stimuli * cls.avg_seconds
+
+    # Estimated wall time of `work` seconds split in `tasks` tasks on the
+    # given executor. Every task sends `transfer` stimuli to its worker and
+    # back, and processes are started unless `running` of them are already.
+    @classmethod
+    def estimate(cls, executor: str, tasks: int, work: float, transfer: int, running: int = 0) -> float:
+        if executor == 'serial':
+            return work
+
+        cpu_count = getattr(os, 'process_cpu_count', os.cpu_count)() or 1
+        if executor == 'threads':
+            free_threaded = not getattr(sys, '_is_gil_enabled', lambda: True)()
+            parallel = min(tasks, cpu_count) if free_threaded else 1
+            return work / parallel + tasks * (cls.thread_task_seconds + cls.thread_start_seconds)
+
+        assert cls.transfer_seconds is not None
+        start = 0. if running >= tasks else tasks * cls.process_start_seconds
+        return work / min(tasks, cpu_count) + tasks * (cls.process_task_seconds + transfer * cls.transfer_seconds) + start
+
+    # Executor and number of tasks, of at most `max_tasks`, with the lowest
+    # estimated wall time, along with that estimate.
+    @classmethod
+    def choose(cls, model: Type[Model], steps: int, stimuli: int, transfer: int, max_tasks: int, running: int = 0) -> tuple[str, int, float]:
+        work = cls.work(model, steps, stimuli)
+
+        best = ('serial', 1, work)
+        for executor in ('threads', 'processes'):
+            for tasks in range(2, max_tasks + 1):
+                seconds = cls.estimate(executor, tasks, work, transfer, running)
+                if seconds < best[2]:
+                    best = (executor, tasks, seconds)
+
+        return best
@@ -0,0 +1,63 @@
+from __future__ import annotations
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import ClassVar, Iterator
+
+# Counts of the operations on the hot paths of the simulation. They are
+# incremented unconditionally, which is cheap enough to always leave on.
+# Operations are counted in the counts of the current scope, such as those of
+# a single phase, so that simulations running at the same time in other
+# threads aren't counted in them; outside of any scope, they are counted in
+# the totals of the process.
+class Counters:
+    totals: ClassVar[dict[str, int]] = {
+        # Trials run by Group.runPhase, and steps of a single CS by Model.run_step.
+        'trials': 0,
+        'model_steps': 0,
+
+        # Lookups of Environment.__getitem__, and those of compound CS that
+        # are summed into a new Stimulus.
+        'lookups': 0,
+        'compound_sums': 0,
+
+        # Every Stimulus created, and those created by Stimulus.copy and Stimulus.__add__.
+        'stimuli': 0,
+        'stimulus_copies': 0,
+        'stimulus_adds': 0,
+
+        # Tasks of random trials sent to workers, and the size of the tasks and their results.
+        'worker_tasks': 0,
+        'bytes_to_workers': 0,
+        'bytes_from_workers': 0,
+    }
+
+    # Counts of the current scope; see `scope`.
+    current: ClassVar[ContextVar[dict[str, int]]] = ContextVar('counters', default = totals)
+
+    # Whether to measure the size of the tasks and results of workers, which
+    # pickles them once more.
+    measure_ipc: ClassVar[bool] = False
+
+    # Count the operations of this thread in new counts until the end of the
+    # block. They are then added to the counts of the enclosing scope, unless
+    # `include` is False. Threads don't inherit the scope of the thread that
+    # started them, so their operations are added explicitly.
+    @classmethod
+    @contextmanager
+    def scope(cls, include: bool = True) -> Iterator[dict[str, int]]:
+        counts = dict.fromkeys(cls.totals, 0)
+        token = cls.current.set(counts)
+        try:
+            yield counts
+        finally:
+            cls.current.reset(token)
+            if include:
+                cls.add(counts)
+
+    # Add counts from elsewhere, such as those of a worker, to the current scope.
+    @classmethod
+    def add(cls, counts: dict[str, int]):
+        current = cls.current.get()
+        for k, v in counts.items():
+            current[k] += v
@@ -1,11 +1,16 @@
 from __future__ import annotations
 
+from array import array
 from collections import deque, defaultdict
+from dataclasses import dataclass
+from functools import partial
 from typing import Any, ClassVar
 from csv import DictWriter
 
 import re
 
+from Counters import Counters
+
 class Stimulus:
     name: str
     compound: bool
@@ -42,6 +47,8 @@ class Stimulus:
             alpha_mack_0 = None, alpha_hall_0 = None,
             compound = False,
         ):
+        Counters.current.get()['stimuli'] += 1
+
         self.name = name
         self.compound = compound
 
@@ -68,6 +75,8 @@ class Stimulus:
         return str(self.assoc)
 
     def __add__(self, other: Stimulus) -> Stimulus:
+        Counters.current.get()['stimulus_adds'] += 1
+
         ret: dict[str, Any] = dict(name = self.name)
         if self.name != other.name:
             ret['name'] = ''.join(sorted(set(self.splitName() + other.splitName())))
@@ -117,6 +126,7 @@ class Stimulus:
         return Stimulus(**ret)
 
     def copy(self) -> Stimulus:
+        Counters.current.get()['stimulus_copies'] += 1
         return Stimulus(**self.__dict__)
 
     def splitName(self) -> list[str]:
@@ -125,13 +135,44 @@ class Stimulus:
 class StimulusHistory:
     hist: list[Stimulus]
 
-    def __init__(self, hist: None | list[Stimulus] = None):
+    # Only every `stride`-th stimulus passed to `record` is kept.
+    stride: int
+    offered: int
+
+    def __init__(self, hist: None | list[Stimulus] = None, stride: int = 1):
         self.hist = hist or []
+        self.stride = stride
+        self.offered = 0
 
     def add(self, ind: Stimulus):
         self.hist.append(ind.copy())
 
+    # Add a snapshot without copying it. Snapshots can be shared between
+    # histories, so they must not be modified afterwards.
+    def append(self, ind: Stimulus):
+        self.hist.append(ind)
+
+    # Whether the next stimulus passed to `record` will be kept.
+    def due(self) -> bool:
+        return self.offered % self.stride == 0
+
+    # Append a snapshot if it's due; only every `stride`-th one is kept.
+    def record(self, ind: None | Stimulus):
+        if self.due():
+            assert ind is not None
+            self.append(ind)
+
+        self.offered += 1
+
+    # Trial numbers, starting from 0, of each recorded stimulus.
+    def trials(self) -> range:
+        return range(0, len(self) * self.stride, self.stride)
+
     def __getattr__(self, key):
+        # Unpickling looks up special methods before `hist` is set.
+        if key.startswith('__') or key == 'hist':
+            raise AttributeError(key)
+
         return [getattr(p, key) for p in self.hist]
 
     def __len__(self):
@@ -139,13 +180,13 @@ class StimulusHistory:
 
     def __getitem__(self, key):
         if isinstance(key, slice):
-            return StimulusHistory(self.hist[key])
+            return StimulusHistory(self.hist[key], self.stride)
 
         return self.hist[key]
 
     @classmethod
-    def emptydict(cls) -> dict[str, StimulusHistory]:
-        return defaultdict(lambda: StimulusHistory())
+    def emptydict(cls, stride: int = 1) -> dict[str, StimulusHistory]:
+        return defaultdict(partial(StimulusHistory, stride = stride))
 
     @classmethod
     def exportData(cls, strengths: list[dict[str, StimulusHistory]], file, should_plot_macknhall = False):
@@ -161,12 +202,12 @@ class StimulusHistory:
         for phase_num, phase in enumerate(strengths, start = 1):
             for group_cs, hist in phase.items():
                 group, cs = group_cs.rsplit(' - ', maxsplit = 1)
-                for trial, stimulus in enumerate(hist, start = 1):
+                for trial, stimulus in zip(hist.trials(), hist):
                     row = {
                         'Phase': phase_num,
                         'Group': group,
                         'CS': cs,
-                        'Trial': trial,
+                        'Trial': trial + 1,
                         'Assoc': stimulus.assoc,
                         'Ve': stimulus.Ve,
                         'Vi': stimulus.Vi,
@@ -176,26 +217,320 @@ class StimulusHistory:
                     }
                     writer.writerow(row)
 
-class Environment:
-    # Static class variable indicating whether to use configural cues.
-    # Apologies for using a class variable here. Better solutions require
-    # rewriting large amounts of the code.
-    configural_cues: ClassVar[bool] = False
+# A results history stored as one array per field rather than as Stimulus
+# objects, which is far smaller when kept for a whole session. Only the
+# fields that are plotted or exported are stored, in the given precision.
+class CompactHistory(StimulusHistory):
+    fields: ClassVar[list[str]] = ['assoc', 'Ve', 'Vi', 'alpha', 'alpha_mack', 'alpha_hall']
+    typecodes: ClassVar[dict[str, str]] = {'float32': 'f', 'float64': 'd'}
+
+    values: dict[str, array]
+    compounds: array
+
+    def __init__(self, precision: str = 'float32', stride: int = 1):
+        super().__init__(stride = stride)
+        self.values = {f: array(self.typecodes[precision]) for f in self.fields}
+        self.compounds = array('b')
+
+    def add(self, ind: Stimulus):
+        self.append(ind)
+
+    def append(self, ind: Stimulus):
+        for f in self.fields:
+            self.values[f].append(getattr(ind, f))
+
+        self.compounds.append(ind.compound)
+
+    def __getattr__(self, key):
+        if key == 'compound':
+            return [bool(x) for x in self.compounds]
+
+        if key not in self.fields:
+            raise AttributeError(key)
+
+        return list(self.values[key])
+
+    def __len__(self):
+        return len(self.compounds)
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            ret = CompactHistory(stride = self.stride)
+            ret.values = {f: v[key] for f, v in self.values.items()}
+            ret.compounds = self.compounds[key]
+            return ret
+
+        values = {f: v[key] for f, v in self.values.items()}
+        return Stimulus(
+            name = '',
+            salience = None, habituation = None,
+            rho = None, nu = None,
+            compound = bool(self.compounds[key]),
+            **values,
+        )
+
+    @classmethod
+    def emptydict(cls, precision: str = 'float32', stride: int = 1) -> dict[str, StimulusHistory]:
+        return defaultdict(partial(CompactHistory, precision, stride))
+
+# Running reductions of a single CS over a phase, used instead of a
+# StimulusHistory when only summary statistics are requested.
+# No stimulus is copied: `add` only reads the values of the stimulus it's given.
+class StimulusSummary:
+    fields: ClassVar[list[str]] = ['assoc', 'Ve', 'Vi', 'alpha', 'alpha_mack', 'alpha_hall']
+    stats: ClassVar[list[str]] = ['final', 'block', 'min', 'max']
+
+    compound: bool
+    block_size: int
+    count: int
+
+    final: dict[str, float]
+    minimum: dict[str, float]
+    maximum: dict[str, float]
+
+    # Sums and amount of elements of every block of `block_size` trials.
+    block_sums: list[dict[str, float]]
+    block_counts: list[int]
+
+    # Values of every trial, only kept in randomised phases, so that the
+    # minimum and maximum are those of the values averaged over the random
+    # trials, as the full history would have them.
+    trials: None | list[dict[str, float]]
+
+    def __init__(self, block_size: int = 10, keep_trials: bool = False):
+        self.compound = False
+        self.block_size = block_size
+        self.count = 0
+
+        self.final = {}
+        self.minimum = {}
+        self.maximum = {}
+
+        self.block_sums = []
+        self.block_counts = []
+
+        self.trials = [] if keep_trials else None
+
+    def add(self, ind: Stimulus):
+        values = {f: getattr(ind, f) for f in self.fields}
+
+        if self.count % self.block_size == 0:
+            self.block_sums.append(dict.fromkeys(self.fields, 0.))
+            self.block_counts.append(0)
+
+        for f, v in values.items():
+            self.block_sums[-1][f] += v
+            self.minimum[f] = min(self.minimum.get(f, v), v)
+            self.maximum[f] = max(self.maximum.get(f, v), v)
+
+        self.block_counts[-1] += 1
+        if self.trials is not None:
+            self.trials.append(values)
 
+        self.final = values
+        self.compound = ind.compound
+        self.count += 1
+
+    # Summaries never keep the stimulus, so there's nothing to copy, and
+    # every trial is summarised.
+    append = add
+    record = add
+
+    def due(self) -> bool:
+        return True
+
+    def __len__(self):
+        return self.count
+
+    def block_means(self) -> list[dict[str, float]]:
+        return [{f: v / n for f, v in s.items()} for s, n in zip(self.block_sums, self.block_counts)]
+
+    # Summaries of random trials are averaged as `sum(X / n)`, like Environment.avg.
+    # Final values, block means and the values of every trial are averaged,
+    # and the minimum and maximum are taken again over the averaged trials.
+    def __add__(self, other: StimulusSummary) -> StimulusSummary:
+        ret = StimulusSummary(self.block_size)
+        ret.compound = self.compound or other.compound
+        ret.count = max(self.count, other.count)
+
+        ret.final = {f: self.final[f] + other.final[f] for f in self.fields}
+        ret.minimum = {f: min(self.minimum[f], other.minimum[f]) for f in self.fields}
+        ret.maximum = {f: max(self.maximum[f], other.maximum[f]) for f in self.fields}
+
+        ret.block_sums = [{f: a[f] + b[f] for f in self.fields} for a, b in zip(self.block_sums, other.block_sums)]
+        ret.block_counts = self.block_counts
+
+        if self.trials is not None and other.trials is not None:
+            ret.trials = [{f: a[f] + b[f] for f in self.fields} for a, b in zip(self.trials, other.trials)]
+            ret.update_extremes()
+
+        return ret
+
+    def __truediv__(self, quot: int) -> StimulusSummary:
+        ret = StimulusSummary(self.block_size)
+        ret.compound = self.compound
+        ret.count = self.count
+
+        ret.final = {f: v / quot for f, v in self.final.items()}
+        ret.minimum = self.minimum
+        ret.maximum = self.maximum
+
+        ret.block_sums = [{f: v / quot for f, v in s.items()} for s in self.block_sums]
+        ret.block_counts = self.block_counts
+
+        if self.trials is not None:
+            ret.trials = [{f: v / quot for f, v in t.items()} for t in self.trials]
+            ret.update_extremes()
+
+        return ret
+
+    # Take the minimum and maximum over the kept values of every trial.
+    def update_extremes(self):
+        assert self.trials is not None
+        self.minimum = {f: min(t[f] for t in self.trials) for f in self.fields}
+        self.maximum = {f: max(t[f] for t in self.trials) for f in self.fields}
+
+    @classmethod
+    def emptydict(cls, block_size: int = 10, keep_trials: bool = False) -> dict[str, StimulusSummary]:
+        return defaultdict(partial(StimulusSummary, block_size, keep_trials))
+
+    @classmethod
+    def exportData(cls, summaries: list[dict[str, StimulusSummary]], file, stats: None | list[str] = None, should_plot_macknhall = False):
+        stats = stats or cls.stats
+
+        fieldnames = ['Phase', 'Group', 'CS', 'Statistic', 'Block', 'Trials', 'Assoc', 'Ve', 'Vi']
+        if not should_plot_macknhall:
+            fieldnames += ['Alpha']
+        else:
+            fieldnames += ['Alpha Mack', 'Alpha Hall']
+
+        writer = DictWriter(file, fieldnames = fieldnames, extrasaction = 'ignore')
+        writer.writeheader()
+
+        for phase_num, phase in enumerate(summaries, start = 1):
+            for group_cs, summary in phase.items():
+                group, cs = group_cs.rsplit(' - ', maxsplit = 1)
+
+                rows: list[tuple[str, None | int, int, dict[str, float]]] = []
+                if 'final' in stats:
+                    rows.append(('final', None, summary.count, summary.final))
+                if 'block' in stats:
+                    for block, (means, n) in enumerate(zip(summary.block_means(), summary.block_counts), start = 1):
+                        rows.append(('block', block, n, means))
+                if 'min' in stats:
+                    rows.append(('min', None, summary.count, summary.minimum))
+                if 'max' in stats:
+                    rows.append(('max', None, summary.count, summary.maximum))
+
+                for stat, block, trials, values in rows:
+                    writer.writerow({
+                        'Phase': phase_num,
+                        'Group': group,
+                        'CS': cs,
+                        'Statistic': stat,
+                        'Block': block,
+                        'Trials': trials,
+                        'Assoc': values['assoc'],
+                        'Ve': values['Ve'],
+                        'Vi': values['Vi'],
+                        'Alpha': values['alpha'],
+                        'Alpha Mack': values['alpha_mack'],
+                        'Alpha Hall': values['alpha_hall'],
+                    })
+
+# Specification of which histories Group.runPhase records, and how.
+# Keys that won't be plotted or exported are never recorded, so their stimuli
+# are never copied.
+@dataclass
+class RecordSpec:
+    # Record the stimuli together with their US, as in "AX+".
+    part_stimuli: bool = False
+
+    # With part_stimuli, also record every CS of a compound in the context of
+    # its trial, as in "A{AX+}".
+    compound_context: bool = False
+
+    # Names of the CS to record, either as "A" or "Group - A"; None records all.
+    stimuli: None | set[str] = None
+
+    # Summary statistics to record instead of the full history; see StimulusSummary.
+    summary: None | list[str] = None
+    block_size: int = 10
+
+    # Whether summaries keep the values of every trial, as in randomised phases.
+    summary_trials: bool = False
+
+    # Precision in which the results are stored ('float64' or 'float32'), and
+    # how often trials are kept. The simulation always runs in float64.
+    precision: str = 'float64'
+    stride: int = 1
+
+    def records(self, group: str, cs: str) -> bool:
+        if self.stimuli is None:
+            return True
+
+        name = cs.replace('(', 'q(')
+        return name in self.stimuli or f'{group} - {name}' in self.stimuli
+
+    # Return the (history key, stimulus) pairs recorded in a trial of `part`
+    # with US `plus`, in order. Several keys can record the same stimulus.
+    def trial_keys(self, group: str, part: str, plus: str, compounds: list[str]) -> list[tuple[str, str]]:
+        keys = []
+        if self.records(group, part):
+            keys.append((part, part))
+
+        if self.part_stimuli and self.records(group, part + plus):
+            keys.append((part + plus, part))
+
+        if len(compounds) > 1:
+            for cs in compounds:
+                if self.records(group, cs):
+                    keys.append((cs, cs))
+
+                context = f'{cs}{{{part + plus}}}'
+                if self.part_stimuli and self.compound_context and self.records(group, context):
+                    keys.append((context, cs))
+
+        return keys
+
+    # Histories where Group.runPhase records every trial.
+    def emptydict(self) -> dict[str, StimulusHistory] | dict[str, StimulusSummary]:
+        if self.summary is None:
+            return StimulusHistory.emptydict(self.stride)
+
+        return StimulusSummary.emptydict(self.block_size, self.summary_trials)
+
+    # Histories holding the final results of every phase.
+    def results_dict(self) -> dict[str, StimulusHistory]:
+        if self.precision == 'float64':
+            return StimulusHistory.emptydict(self.stride)
+
+        return CompactHistory.emptydict(self.precision, self.stride)
+
+class Environment:
     # Dictionary with all singular CS -> stimuli.
     # Values should be begotten with `env[cs]`, where `cs` can be singular
     # or multiple CSs together.
     s: dict[str, Stimulus]
 
-    def __init__(self, s: dict[str, Stimulus]):
+    # Whether compounds include their configural cue, as "(AB)" in "AB".
+    # Every environment carries it, so that groups with and without
+    # configural cues can run at the same time in a single process.
+    configural_cues: bool
+
+    def __init__(self, s: dict[str, Stimulus], configural_cues: bool = False):
         self.s = s
+        self.configural_cues = configural_cues
 
     def __repr__(self) -> str:
         return str(self.s)
 
     # fromHistories "transposes" a several histories of single CSs into a single list of many CSs.
     @staticmethod
-    def fromHistories(histories: dict[str, StimulusHistory]) -> list[Environment]:
+    def fromHistories(histories: dict[str, StimulusHistory], configural_cues: bool = False) -> list[Environment]:
         longest = max((len(x.hist) for x in histories.values()), default = 0)
         return [
             Environment(
@@ -204,6 +539,7 @@ class Environment:
                     for cs, h in histories.items()
                     if len(h.hist) > i
                 },
+                configural_cues = configural_cues,
             )
             for i in range(longest)
         ]
@@ -219,10 +555,10 @@ class Environment:
         return values
 
     # Same as split_cs, but adds configural cues if necessary.
-    @classmethod
-    def list_cs(cls, cs) -> list[str]:
-        values = cls.split_cs(cs)
-        if cls.configural_cues and len(values) > 1:
+    @staticmethod
+    def list_cs(cs, configural_cues: bool = False) -> list[str]:
+        values = Environment.split_cs(cs)
+        if configural_cues and len(values) > 1:
             values += [f'({cs})']
 
         return values
@@ -230,24 +566,48 @@ class Environment:
     # Get the individual values of either a single key (len(key) == 1), or
     # the combined values of a combination of keys (sum of values).
     def __getitem__(self, key: str) -> Stimulus:
+        Counters.current.get()['lookups'] += 1
         if key in self.s:
             return self.s[key]
 
-        items = [self.s[k] for k in self.list_cs(key)]
+        Counters.current.get()['compound_sums'] += 1
+        items = [self.s[k] for k in self.list_cs(key, self.configural_cues)]
         return sum(items[1:], items[0])
 
     def filter_keys(self, keys: list[str]) -> list[str]:
-        return [k for k in keys if all(t in self.s for t in self.list_cs(k))]
+        return [k for k in keys if all(t in self.s for t in self.list_cs(k, self.configural_cues))]
 
+    # Snapshots shared between several keys are only added and divided once,
+    # so the results keep sharing them.
     def __add__(self, other: Environment) -> Environment:
         cs = self.s.keys() | other.s.keys()
-        return Environment({k: self[k] + other[k] for k in cs})
+
+        # The operands are kept alongside each sum, so their ids can't be reused.
+        sums: dict[tuple[int, int], tuple[Stimulus, Stimulus, Stimulus]] = {}
+        ret = {}
+        for k in cs:
+            this, that = self[k], other[k]
+            ids = (id(this), id(that))
+            if ids not in sums:
+                sums[ids] = (this, that, this + that)
+
+            ret[k] = sums[ids][2]
+
+        return Environment(ret, self.configural_cues)
 
     def __truediv__(self, quot: int) -> Environment:
-        return Environment({k: self.s[k] / quot for k in self.s.keys()})
+        quots: dict[int, Stimulus] = {}
+        ret = {}
+        for k, v in self.s.items():
+            if id(v) not in quots:
+                quots[id(v)] = v / quot
+
+            ret[k] = quots[id(v)]
+
+        return Environment(ret, self.configural_cues)
 
     def copy(self) -> Environment:
-        return Environment({k: v.copy() for k, v in self.s.items()})
+        return Environment({k: v.copy() for k, v in self.s.items()}, self.configural_cues)
 
     # Convenience function: sum all elements of val.
     @staticmethod
@@ -0,0 +1,213 @@
+from __future__ import annotations
+
+import argparse
+import copy
+import importlib
+import random
+import sys
+from csv import DictWriter
+from dataclasses import asdict, dataclass
+from typing import Callable, TypeAlias
+
+import numpy
+
+import Simulator
+from BatchEngine import BatchEngine, PhasePlan
+from Environment import StimulusHistory
+from Experiment import Experiment, RWArgs
+from Models import Model
+
+# An engine runs a single group with the given parameters and seed, returning
+# its results as Experiment.run_all_phases.
+Engine: TypeAlias = Callable[[str, list[str], RWArgs, int], list[dict[str, StimulusHistory]]]
+
+# The reference semantics: Group.runPhase and Model.step, with the random
+# trials of randomised phases run in this process, so that the seed fixes them.
+def reference(name: str, phase_strs: list[str], args: RWArgs, seed: int) -> list[dict[str, StimulusHistory]]:
+    random.seed(seed)
+    return Experiment(name, phase_strs, max_workers = 1).run_all_phases(args)
+
+# Orders in which the reference runs the trials of every phase given a seed,
+# as positions in the unshuffled phase, with one row per random trial; or
+# None for phases that aren't randomised.
+def reference_orders(experiment: Experiment, num_trials: int, seed: int) -> list[None | numpy.ndarray]:
+    state = random.getstate()
+    random.seed(seed)
+
+    orders: list[None | numpy.ndarray] = []
+    for phase in experiment.phases:
+        if not phase.rand:
+            orders.append(None)
+            continue
+
+        rows = Experiment.random_orders(phase, num_trials)
+        orders.append(numpy.array(rows, dtype = int).reshape(num_trials, len(phase.elems)))
+
+    random.setstate(state)
+    return orders
+
+# BatchEngine running the random trials in the same orders as the reference.
+class ReplayEngine(BatchEngine):
+    replay: dict[int, numpy.ndarray]
+
+    def __init__(self, experiment: Experiment, args: list[RWArgs], seed: int):
+        super().__init__(experiment, args, shared_orders = True)
+        self.replay = {
+            id(plan): order
+            for plan, order in zip(self.plans, reference_orders(experiment, self.num_trials, seed))
+            if order is not None
+        }
+
+    def orders(self, plan: PhasePlan, num_rows: int) -> numpy.ndarray:
+        return self.replay[id(plan)]
+
+def batch(name: str, phase_strs: list[str], args: RWArgs, seed: int) -> list[dict[str, StimulusHistory]]:
+    engine = ReplayEngine(Experiment(name, phase_strs), [args], seed)
+    return engine.strengths(engine.run(), 0)
+
+engines: dict[str, Engine] = {
+    'reference': reference,
+    'batch': batch,
+}
+
+# An engine by name, or any function given as "module:function".
+def get_engine(name: str) -> Engine:
+    if name in engines:
+        return engines[name]
+
+    if ':' not in name:
+        raise argparse.ArgumentTypeError(f'Unknown engine {name}; use one of {", ".join(engines)}, or module:function.')
+
+    module, function = name.split(':', maxsplit = 1)
+    return getattr(importlib.import_module(module), function)
+
+@dataclass
+class Difference:
+    group: str
+    phase: int
+    cs: str
+    field: str
+    max_abs: float
+    max_rel: float
+    ok: bool
+
+fields = ['assoc', 'Ve', 'Vi', 'alpha', 'alpha_mack', 'alpha_hall', 'compound']
+
+# Largest absolute and relative differences of every field of every key of two
+# results, and whether every value is within `atol + rtol * |expected|`.
+# NaNs must be in the same places; keys or histories missing from either side
+# are reported with infinite differences under the field "keys" or "length".
+def compare(group: str, expected: list[dict[str, StimulusHistory]], actual: list[dict[str, StimulusHistory]], atol: float, rtol: float) -> list[Difference]:
+    differences = []
+    if len(expected) != len(actual):
+        return [Difference(group, 0, '', 'phases', numpy.inf, numpy.inf, False)]
+
+    for phase_num, (exp_phase, act_phase) in enumerate(zip(expected, actual), start = 1):
+        for key in exp_phase.keys() | act_phase.keys():
+            cs = key.rsplit(' - ', maxsplit = 1)[-1]
+            if key not in exp_phase or key not in act_phase:
+                differences.append(Difference(group, phase_num, cs, 'keys', numpy.inf, numpy.inf, False))
+                continue
+
+            if len(exp_phase[key]) != len(act_phase[key]):
+                differences.append(Difference(group, phase_num, cs, 'length', numpy.inf, numpy.inf, False))
+                continue
+
+            for field in fields:
+                x = numpy.array(getattr(exp_phase[key], field), dtype = float)
+                y = numpy.array(getattr(act_phase[key], field), dtype = float)
+
+                nan = numpy.isnan(x) | numpy.isnan(y)
+                if not numpy.array_equal(numpy.isnan(x), numpy.isnan(y)):
+                    differences.append(Difference(group, phase_num, cs, field, numpy.inf, numpy.inf, False))
+                    continue
+
+                x, y = x[~nan], y[~nan]
+                diff = numpy.abs(x - y)
+                scale = numpy.maximum(numpy.abs(x), numpy.abs(y))
+                with numpy.errstate(all = 'ignore'):
+                    rel = numpy.where(scale > 0, diff / scale, 0.)
+
+                differences.append(Difference(
+                    group, phase_num, cs, field,
+                    max_abs = float(diff.max(initial = 0.)),
+                    max_rel = float(rel.max(initial = 0.)),
+                    ok = bool(numpy.all(diff <= atol + rtol * numpy.abs(x))),
+                ))
+
+    return differences
+
+def parse_args() -> tuple[argparse.Namespace, argparse.Namespace]:
+    parser = argparse.ArgumentParser(
+        description = 'Check that an engine reproduces the results of the reference simulation.',
+        formatter_class = argparse.RawTextHelpFormatter,
+        epilog = f'''\
+Every group of the experiment file is run with both engines and the same
+seed, and the largest absolute and relative difference of every field of
+every CS in every phase is printed, or saved with --save-results. Exits with
+an error if any value is outside of the tolerances.
+
+Engines: {", ".join(engines)}, or any function given as module:function
+taking the name, phases, parameters and seed of a group.
+
+Example:
+  %(prog)s Experiments/LIrr-LePelley.rw --candidate batch --models "MLAB Model" "Le Pelley's Hybrid"
+''',
+    )
+    parser.add_argument('--expected', metavar = 'engine', type = get_engine, default = reference, help = 'Engine whose results are expected. Default: reference.')
+    parser.add_argument('--candidate', metavar = 'engine', type = get_engine, default = batch, help = 'Engine to check. Default: batch.')
+    parser.add_argument('--models', metavar = 'model', nargs = '*', choices = list(Model.types()), help = 'Run the experiment with each of these models, instead of the one of its parameters.')
+    parser.add_argument('--seed', type = int, default = 0, help = 'Seed for the random orders of randomised phases.')
+    parser.add_argument('--atol', type = float, default = 1e-12, help = 'Absolute tolerance.')
+    parser.add_argument('--rtol', type = float, default = 1e-9, help = 'Relative tolerance.')
+    parser.add_argument('--failures-only', action = 'store_true', help = 'Only list the values outside of the tolerances.')
+
+    args, rest = parser.parse_known_args()
+    sys.argv[1:] = rest
+    return args, Simulator.parse_args()
+
+def main():
+    eq_args, args = parse_args()
+
+    if args.summary is not None or args.store is not None or args.savefig is not None:
+        raise ValueError('The equivalence harness only writes a table of differences; --summary, --savefig and --store cannot be used.')
+
+    base = RWArgs(
+        **{k: v for k, v in args.__dict__.items() if k in set(RWArgs.__match_args__) and v is not None}
+    )
+
+    rows = []
+    for name, phase_strs in Simulator.parse_experiment_file(args.experiment_file, base):
+        if args.plot_experiments is not None and name not in args.plot_experiments:
+            continue
+
+        for model in eq_args.models or [base.model]:
+            group_args = copy.deepcopy(base)
+            group_args.model = model
+
+            expected = eq_args.expected(name, phase_strs, copy.deepcopy(group_args), eq_args.seed)
+            actual = eq_args.candidate(name, phase_strs, copy.deepcopy(group_args), eq_args.seed)
+            rows += [dict(model = model, **asdict(d)) for d in compare(name, expected, actual, eq_args.atol, eq_args.rtol)]
+
+    failures = [row for row in rows if not row['ok']]
+
+    def write(file):
+        writer = DictWriter(file, fieldnames = ['model', 'group', 'phase', 'cs', 'field', 'max_abs', 'max_rel', 'ok'])
+        writer.writeheader()
+        writer.writerows(failures if eq_args.failures_only else rows)
+
+    if args.save_results is not None:
+        with open(args.save_results, 'w') as file:
+            write(file)
+
+    if args.print_results or args.save_results is None:
+        write(sys.stdout)
+
+    worst = max((row['max_abs'] for row in rows), default = 0.)
+    print(f'{len(rows) - len(failures)}/{len(rows)} fields within tolerance; largest absolute difference {worst:.3g}.', file = sys.stderr)
+
+    if failures:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
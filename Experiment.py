@@ -1,16 +1,39 @@
 from __future__ import annotations
 
-from dataclasses import dataclass
-from typing import Any, get_type_hints, get_args, Optional, ClassVar
+import concurrent.futures
+from contextlib import nullcontext
+from dataclasses import dataclass, replace
+from typing import Any, get_type_hints, get_args, Optional, ClassVar, TYPE_CHECKING
 from types import UnionType
 
-from Group import Group
-from Environment import Stimulus, Environment, StimulusHistory
+from Group import Group, ParameterTable
+from Environment import Stimulus, Environment, StimulusHistory, StimulusSummary, RecordSpec
+from Profiler import Profiler
+from Counters import Counters
+from CostModel import CostModel
 
+import copy
 import os
+import pickle
 import random
 import re
 import logging
+import time
+
+if TYPE_CHECKING:
+    from concurrent.futures import Executor, ProcessPoolExecutor
+
+# Executors of the random trials of a randomised phase; see Experiment.run_phase.
+#   serial: one after another in this process.
+#   threads: threads of this process, which only run at the same time on
+#            free-threaded builds of Python.
+#   interpreters: subinterpreters of this process, on Python 3.14 or later,
+#                 if the installed NumPy supports them.
+#   processes: worker processes, or the shared pool if it was started.
+#   auto: serially, on threads or on processes, whichever CostModel estimates
+#         is fastest; threads only on free-threaded builds of Python.
+# A phase whose trials are a single task always runs serially.
+executors = ['auto', 'serial', 'threads', 'interpreters', 'processes']
 
 class Phase:
     # elems contains a list of ([CS], US) of an experiment.
@@ -28,11 +51,20 @@ class Phase:
     # String description of this phase.
     phase_str: str
 
-    # Return the set of single CS.
-    def cs(self) -> set[str]:
+    # Counts of the operations of the last run of this phase, including those
+    # of its workers; see Counters.
+    counters: None | dict[str, int]
+
+    # Keys of the results of this phase if every stimulus is recorded, which
+    # plots use so that every line keeps its colour whichever are recorded;
+    # see Experiment.result_keys.
+    keys: None | set[str]
+
+    # Return the set of single CS, and configural cues if enabled.
+    def cs(self, configural_cues: bool = False) -> set[str]:
         if not self.elems:
             return set()
-        return set.union(*[set(Environment.list_cs(x[0])) for x in self.elems])
+        return set.union(*[set(Environment.list_cs(part, configural_cues)) for part in {x[0] for x in self.elems}])
 
     # Return the list of applicable compound CS.
     # self.compound_cs() ⊇ self.cs()
@@ -46,6 +78,8 @@ class Phase:
         self.beta = None
         self.lamda = None
         self.elems = []
+        self.counters = None
+        self.keys = None
 
         for part in self.phase_str.strip().split('/'):
             if part == 'rand':
@@ -117,6 +151,21 @@ class RWArgs:
 
     configural_cues: bool = False
     part_stimuli: bool = False
+    compound_context: bool = False
+
+    # Stimuli to record; None records all of them. See RecordSpec.
+    record_stimuli: None | list[str] = None
+
+    # Storage of the results: 'float64' or 'float32', keeping every Nth trial.
+    history_precision: str = 'float64'
+    history_stride: int = 1
+
+    # Summary statistics to record instead of full histories; see StimulusSummary.
+    summary: None | list[str] = None
+    block_size: int = 10
+
+    # Executor of the random trials; see `executors`.
+    executor: str = 'auto'
 
 class Experiment:
     name: str
@@ -125,6 +174,17 @@ class Experiment:
     rest: list[str]
     phases: list[Phase]
 
+    # Pool of workers shared by the randomised phases of every experiment,
+    # once started with `start_pool`; otherwise, every randomised phase starts
+    # a pool of its own. Groups carry their own configural cues, so workers
+    # can run any experiment.
+    pool: ClassVar[None | ProcessPoolExecutor] = None
+    pool_workers: ClassVar[int] = 0
+
+    # Largest number of blocks in which the random trials of a phase are
+    # averaged; see run_phase.
+    max_blocks: ClassVar[int] = 64
+
     def __init__(self, name: str, phase_strs: list[str], max_workers: Optional[int] = None):
         self.name, *rest = name.split('/')
         self.force_configural_cues = False
@@ -139,36 +199,25 @@ class Experiment:
         self.phases = [Phase(phase_str) for phase_str in phase_strs]
 
     def run_all_phases(self, args: RWArgs) -> list[dict[str, StimulusHistory]]:
-        # Set the static configural_cues variable for the entire environment.
-        Environment.configural_cues = args.configural_cues
-
-        # Easter egg: force configural cues on group with certain postfixes.
-        reset_configural_cues = Environment.configural_cues
-        if self.force_configural_cues:
-            Environment.configural_cues = True
+        with Profiler.stage('simulate', simulation = True):
+            group = self.initial_group(args)
+            results = self.run_group_experiments(group, args.num_trials, args.executor)
 
-        group = self.initial_group(args)
-        results = self.run_group_experiments(group, args.num_trials)
-        strengths = self.group_results(results, args)
-
-        Environment.configural_cues = reset_configural_cues
+        with Profiler.stage('group_results'):
+            strengths = self.group_results(results, args)
 
         return strengths
 
+    # Easter egg: force configural cues on group with certain postfixes.
+    def configural_cues(self, args: RWArgs) -> bool:
+        return args.configural_cues or self.force_configural_cues
+
     def initial_group(self, args: RWArgs) -> Group:
-        stimuli = set.union(*[x.cs() for x in self.phases])
+        configural_cues = self.configural_cues(args)
+        stimuli = set.union(*[x.cs(configural_cues) for x in self.phases])
         g = Group(
             name = self.name,
-            alphas = args.alphas,
-            default_alpha = args.alpha,
-            alpha_macks = args.alpha_macks,
-            default_alpha_mack = args.alpha_mack,
-            alpha_halls = args.alpha_halls,
-            default_alpha_hall = args.alpha_hall,
-            saliences = args.saliences,
-            default_salience = args.salience,
-            habituations = args.habituations,
-            default_habituation = args.habituation,
+            parameters = ParameterTable.from_args(args),
             rho = args.rho,
             nu = args.nu,
             kay = args.kay,
@@ -181,67 +230,246 @@ class Experiment:
             cs = stimuli,
             model = args.model,
             xi_hall = args.xi_hall,
+            record = self.record_spec(args),
+            configural_cues = configural_cues,
         )
 
         return g
 
-    def run_random_trials(self, g: Group, phase: Phase, trials: int, total_trials: int) -> tuple[list[Environment], Environment]:
-        # Copy the configural cues to the global environment.
-        # This is necessary due to spawn issues in MacOS; we should
-        # ideally remove the class variable altogether.
-        Environment.configural_cues = g.configural_cues
-
-        initial_strengths = g.s.copy()
-
-        hists = []
-        final_strengths = []
-        confs = 0
-        for t in range(trials):
-            random.shuffle(phase.elems)
-
-            g.s = initial_strengths.copy()
-            confs += int(g.s.configural_cues)
+    def record_spec(self, args: RWArgs) -> RecordSpec:
+        return RecordSpec(
+            part_stimuli = args.part_stimuli,
+            compound_context = args.compound_context,
+            stimuli = None if args.record_stimuli is None else set(args.record_stimuli),
+            summary = args.summary,
+            block_size = args.block_size,
+            precision = args.history_precision,
+            stride = args.history_stride,
+        )
 
-            hists.append(g.runPhase(phase.elems, phase.beta, phase.lamda))
-            final_strengths.append(g.s)
+    # Keys of the results of every phase, as in group_results, if every
+    # stimulus were recorded.
+    def result_keys(self, args: RWArgs) -> list[set[str]]:
+        record = replace(self.record_spec(args), stimuli = None)
+        configural_cues = self.configural_cues(args)
+
+        keys = []
+        for phase in self.phases:
+            phase_keys = set()
+            for part, plus in phase.elems:
+                compounds = Environment.list_cs(part, configural_cues)
+                for cs, _ in record.trial_keys(self.name, part, plus, compounds):
+                    if ('+' in cs or '-' in cs) and not args.part_stimuli:
+                        continue
 
-        avg_hists = [
-            Environment.avg([h[x] for h in hists if x < len(h)], total_trials)
-            for x in range(max(len(h) for h in hists))
+                    phase_keys.add(f'{self.name} - {cs.replace("(", "q(")}')
+
+            keys.append(phase_keys)
+
+        return keys
+
+    # Orders of the trials of a randomised phase for every random trial, as
+    # positions in the phase. Every order shuffles the previous one.
+    # They're drawn before the trials run, so that with a fixed seed every
+    # executor runs the same trials.
+    @staticmethod
+    def random_orders(phase: Phase, num_trials: int) -> list[list[int]]:
+        positions = list(range(len(phase.elems)))
+        orders = []
+        for _ in range(num_trials):
+            random.shuffle(positions)
+            orders.append(list(positions))
+
+        return orders
+
+    # Run the random trials of a phase in the given blocks of orders,
+    # returning the averages of the histories and final strengths of every
+    # block, and the counts of their operations, which run_phase adds to
+    # those of the phase whichever thread or process they ran in.
+    def run_random_trials(self, g: Group, phase: Phase, blocks: list[list[list[int]]], total_trials: int) -> tuple[list[list[Environment]], list[Environment], dict[str, int]]:
+        with Counters.scope(include = False) as counters:
+            # The trials run on a copy of the group, with its own model, since
+            # the tasks of a phase can share the group in threads.
+            group = copy.copy(g)
+            group.model = copy.copy(g.model)
+            initial_strengths = g.s.copy()
+
+            # Summaries keep every trial, so that their extremes are taken
+            # once the random trials are averaged.
+            group.record = replace(g.record, summary_trials = True)
+
+            avg_hists = []
+            avg_strengths = []
+            for orders in blocks:
+                hists = []
+                final_strengths = []
+                for order in orders:
+                    group.s = initial_strengths.copy()
+
+                    hists.append(group.runPhase([phase.elems[i] for i in order], phase.beta, phase.lamda))
+                    final_strengths.append(group.s)
+
+                avg_hists.append([
+                    Environment.avg([h[x] for h in hists if x < len(h)], total_trials)
+                    for x in range(max(len(h) for h in hists))
+                ])
+                avg_strengths.append(Environment.avg(final_strengths, total_trials))
+
+        return avg_hists, avg_strengths, counters
+
+    # Number of workers of the pools of randomised phases, unless limited by
+    # their number of trials.
+    @staticmethod
+    def pool_size(max_workers: Optional[int]) -> int:
+        cpu_count = getattr(os, 'process_cpu_count', os.cpu_count)() or 1
+        return max_workers or 1 + cpu_count
+
+    # Start the shared pool, and its workers, ahead of the first randomised phase.
+    @classmethod
+    def start_pool(cls, max_workers: Optional[int] = None):
+        workers = cls.pool_size(max_workers)
+        if workers == 1 or cls.pool is not None and cls.pool_workers == workers:
+            return
+
+        cls.stop_pool()
+
+        cls.pool = concurrent.futures.ProcessPoolExecutor(max_workers = workers)
+        cls.pool_workers = workers
+
+        # Workers are started as tasks are submitted, so a task for every
+        # worker starts all of them. How long that takes is the cost of
+        # starting processes in the cost model.
+        started = time.perf_counter()
+        futures = [cls.pool.submit(os.getpid) for _ in range(workers)]
+        futures[-1].add_done_callback(lambda _: CostModel.observe_pool_start(workers, time.perf_counter() - started))
+
+    @classmethod
+    def stop_pool(cls):
+        if cls.pool is not None:
+            cls.pool.shutdown()
+            cls.pool = None
+            cls.pool_workers = 0
+
+    # Executor and number of tasks of the random trials of a phase, of at
+    # most `max_tasks`, with the lowest cost according to the cost model.
+    # The cost of a phase is its steps of a single CS over all random trials,
+    # and averaging the strengths of the group after every one of their trials.
+    def plan_phase(self, g: Group, phase: Phase, num_trials: int, max_tasks: int) -> tuple[str, int]:
+        steps = num_trials * sum(len(Environment.list_cs(part, g.configural_cues)) for part, _ in phase.elems)
+        stimuli = num_trials * len(phase.elems) * len(g.s.s)
+
+        # Every task gets the strengths of the group, and returns them and
+        # the environment after every trial.
+        transfer = len(g.s.s) * (len(phase.elems) + 2)
+
+        running = Experiment.pool_workers if Experiment.pool is not None else 0
+        executor, num_tasks, seconds = CostModel.choose(type(g.model), steps, stimuli, transfer, max_tasks, running)
+        logging.debug(f'{self.name}: {steps} steps on {executor} in {num_tasks} tasks, about {seconds:.4f}s')
+
+        return executor, num_tasks
+
+    # Executor that runs `num_tasks` tasks, once 'auto' is resolved by the
+    # cost model.
+    # A single task runs in this process, which avoids starting a pool inside
+    # of the workers of another pool.
+    @staticmethod
+    def resolve_executor(executor: str, num_tasks: int) -> str:
+        if executor not in executors:
+            raise ValueError(f'Unknown executor {executor}; use one of {", ".join(executors)}.')
+
+        if executor == 'interpreters' and not hasattr(concurrent.futures, 'InterpreterPoolExecutor'):
+            raise ValueError('The interpreters executor needs Python 3.14 or later.')
+
+        if num_tasks == 1:
+            return 'serial'
+
+        return executor
+
+    # Pool of the given executor with `max_workers` workers; the shared pool
+    # of processes is used if it's large enough.
+    @staticmethod
+    def executor_pool(executor: str, max_workers: int) -> Executor | nullcontext:
+        if executor == 'threads':
+            return concurrent.futures.ThreadPoolExecutor(max_workers = max_workers)
+
+        if executor == 'interpreters':
+            return concurrent.futures.InterpreterPoolExecutor(max_workers = max_workers) # type: ignore
+
+        if Experiment.pool is not None and Experiment.pool_workers >= max_workers:
+            return nullcontext(Experiment.pool)
+
+        return concurrent.futures.ProcessPoolExecutor(max_workers = max_workers)
+
+    # Run a single phase of the group, returning the environment after every trial.
+    # The random trials of a randomised phase are averaged in blocks of the
+    # same size, whose averages are then summed in order. The blocks are split
+    # in one task per worker; with the 'auto' executor, the cost model chooses
+    # the executor and how many workers are worth their overhead. The size of
+    # the blocks only depends on the number of random trials, so results
+    # don't depend on the executor nor on the number of workers.
+    def run_phase(self, g: Group, phase: Phase, num_trials: int, executor: str = 'auto') -> list[Environment]:
+        if not phase.rand:
+            return g.runPhase(phase.elems, phase.beta, phase.lamda)
+
+        orders = self.random_orders(phase, num_trials)
+        block_size = -(-num_trials // self.max_blocks)
+        blocks = [orders[start : start + block_size] for start in range(0, num_trials, block_size)]
+
+        max_workers = min(len(blocks), self.pool_size(self.max_workers))
+        if executor == 'auto' and max_workers > 1:
+            executor, max_workers = self.plan_phase(g, phase, num_trials, max_workers)
+
+        tasks = []
+        start = 0
+        for t in range(max_workers):
+            size = len(blocks) // max_workers + (1 if t < len(blocks) % max_workers else 0)
+            tasks.append((g, phase, blocks[start : start + size], num_trials))
+            start += size
+
+        executor = self.resolve_executor(executor, len(tasks))
+        if executor == 'serial':
+            results = [self.run_random_trials(*task) for task in tasks]
+        else:
+            with self.executor_pool(executor, max_workers) as pool:
+                with Profiler.stage('dispatch'):
+                    futures = [pool.submit(self.run_random_trials, *task) for task in tasks]
+
+                with Profiler.stage('gather'):
+                    results = [f.result() for f in futures]
+
+        hist = [h for block_hists, _, _ in results for h in block_hists]
+        final_strengths = [s for _, block_strengths, _ in results for s in block_strengths]
+        for _, _, c in results:
+            Counters.add(c)
+
+        if executor in ('processes', 'interpreters'):
+            counts = Counters.current.get()
+            counts['worker_tasks'] += len(tasks)
+            if Counters.measure_ipc:
+                counts['bytes_to_workers'] += sum(len(pickle.dumps((self.run_random_trials, task))) for task in tasks)
+                counts['bytes_from_workers'] += sum(len(pickle.dumps(result)) for result in results)
+
+        g.s = Environment.summ(final_strengths)
+
+        return [
+            Environment.summ([h[x] for h in hist if x < len(h)])
+            for x in range(max(len(h) for h in hist))
         ]
-        avg_strengths = Environment.avg(final_strengths, total_trials)
 
-        return avg_hists, avg_strengths
-
-    def run_group_experiments(self, g: Group, num_trials: int) -> list[list[Environment]]:
+    def run_group_experiments(self, g: Group, num_trials: int, executor: str = 'auto') -> list[list[Environment]]:
         results = []
 
         for trial, phase in enumerate(self.phases):
-            if not phase.rand:
-                strength_hist = g.runPhase(phase.elems, phase.beta, phase.lamda)
-                results.append(strength_hist)
-            else:
-
-                cpu_count = getattr(os, 'process_cpu_count', os.cpu_count)() or 1
-                max_workers = min(num_trials, self.max_workers or 1 + cpu_count)
-
-                from concurrent.futures import ProcessPoolExecutor
-                with ProcessPoolExecutor(max_workers = max_workers) as executor:
-                    trials_per_worker = lambda t: num_trials // max_workers + (1 if t < num_trials % max_workers else 0)
-                    futures = [executor.submit(self.run_random_trials, g, phase, trials_per_worker(t), num_trials) for t in range(max_workers)]
-                    hist, final_strengths = (list(x) for x in zip(*[f.result() for f in futures]))
-
-                results.append([
-                    Environment.summ([h[x] for h in hist if x < len(h)])
-                    for x in range(max(len(h) for h in hist))
-                ])
+            with Profiler.stage(f'phase {trial + 1}'), Counters.scope() as counters:
+                results.append(self.run_phase(g, phase, num_trials, executor))
 
-                g.s = Environment.summ(final_strengths)
+            phase.counters = counters
 
         return results
 
     def group_results(self, results: list[list[Environment]], args: RWArgs) -> list[dict[str, StimulusHistory]]:
-        group_strengths = [StimulusHistory.emptydict() for _ in results]
+        record = self.record_spec(args)
+        group_strengths = [record.results_dict() for _ in results]
         for phase_num, strength_hist in enumerate(results):
             for strengths in strength_hist:
                 for cs, stimulus in strengths.s.items():
@@ -249,6 +477,9 @@ class Experiment:
                         continue
 
                     full_name = cs.replace('(', 'q(')
-                    group_strengths[phase_num][f'{self.name} - {full_name}'].add(stimulus)
+                    if isinstance(stimulus, StimulusSummary):
+                        group_strengths[phase_num][f'{self.name} - {full_name}'] = stimulus
+                    else:
+                        group_strengths[phase_num][f'{self.name} - {full_name}'].append(stimulus)
 
         return group_strengths
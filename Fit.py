@@ -0,0 +1,268 @@
+from __future__ import annotations
+
+import argparse
+import copy
+import math
+import os
+import sys
+from csv import DictReader, DictWriter
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+
+import numpy
+
+import Simulator
+from BatchEngine import BatchEngine
+from Environment import StimulusHistory
+from Experiment import Experiment, RWArgs
+from HistoryStore import ArrayHistory, HistoryStore
+from Sweep import point_args
+
+# Loss between simulated and observed responses, given the residuals of
+# every candidate as an array with one row per candidate.
+losses = {
+    'sse': lambda r: (r ** 2).sum(axis = 1),
+    'mse': lambda r: (r ** 2).mean(axis = 1),
+    'mae': lambda r: abs(r).mean(axis = 1),
+}
+
+# Responses observed in an experiment, as a CSV with the columns Phase, Group,
+# CS and Trial of the exported results, and a column with the response.
+@dataclass
+class Observations:
+    # Observed trials, 1-based, and their responses, by (phase, group, CS).
+    series: dict[tuple[int, str, str], tuple[numpy.ndarray, numpy.ndarray]]
+
+    @classmethod
+    def read(cls, file, column: str = 'Response') -> Observations:
+        values: dict[tuple[int, str, str], list[tuple[int, float]]] = {}
+        for row in DictReader(file):
+            key = (int(row['Phase']), row['Group'], row['CS'])
+            values.setdefault(key, []).append((int(row['Trial']), float(row[column])))
+
+        series = {}
+        for key, points in values.items():
+            trials, responses = zip(*sorted(points))
+            series[key] = numpy.array(trials, dtype = int), numpy.array(responses, dtype = float)
+
+        return cls(series)
+
+    def groups(self) -> set[str]:
+        return {group for _, group, _ in self.series}
+
+    def stimuli(self, group: str) -> list[str]:
+        return sorted({cs for _, g, cs in self.series if g == group})
+
+    # Observations as histories named "Real-world Group - CS", to plot them alongside the results.
+    def strengths(self, num_phases: int) -> list[dict[str, StimulusHistory]]:
+        strengths: list[dict[str, StimulusHistory]] = [{} for _ in range(num_phases)]
+        for (phase, group, cs), (trials, responses) in self.series.items():
+            data = numpy.full((trials.max(), len(HistoryStore.fields)), numpy.nan)
+            data[:, -1] = 0
+            data[trials - 1, 0] = responses
+            strengths[phase - 1][f'Real-world {group} - {cs}'] = ArrayHistory(data, 0, len(data))
+
+        return strengths
+
+# Fit parameters of the experiment to the observations, minimising the loss.
+# Every evaluation runs a whole population of candidates as a single batch,
+# with the same random orders for every candidate so that the loss is a
+# deterministic function of the parameters.
+class Fitter:
+    # Observed groups of the experiment: their names in the experiment file,
+    # their phases, and their parameters.
+    groups: list[tuple[str, list[str], RWArgs]]
+    names: list[str]
+    lower: numpy.ndarray
+    upper: numpy.ndarray
+    observations: Observations
+    loss: str
+    seed: int
+
+    # Every group is given with the parameters set by the "@" lines before it.
+    # Observations name groups as the exported results, without the options
+    # of the experiment file such as "/cc".
+    def __init__(self, groups: list[tuple[str, list[str], RWArgs]], bounds: dict[str, tuple[float, float]], observations: Observations, loss: str = 'sse', seed: int = 0):
+        names = [Experiment(name, phase_strs).name for name, phase_strs, _ in groups]
+        missing = observations.groups() - set(names)
+        if missing:
+            raise ValueError(f'Observed groups not in the experiment: {", ".join(sorted(missing))}.')
+
+        self.groups = [group for name, group in zip(names, groups) if name in observations.groups()]
+        self.names = list(bounds)
+        self.lower = numpy.array([lo for lo, _ in bounds.values()])
+        self.upper = numpy.array([hi for _, hi in bounds.values()])
+        self.observations = observations
+        self.loss = loss
+        self.seed = seed
+
+    def candidate_args(self, base: RWArgs, candidates: numpy.ndarray, record_stimuli: None | list[str] = None) -> list[RWArgs]:
+        args = []
+        for candidate in candidates:
+            a = point_args(base, {name: repr(float(x)) for name, x in zip(self.names, candidate)})
+            a.history_stride = 1
+            a.record_stimuli = record_stimuli
+            args.append(a)
+
+        return args
+
+    # Loss of every candidate, given as an array with one row per candidate.
+    def evaluate(self, candidates: numpy.ndarray) -> numpy.ndarray:
+        residuals = []
+        for name, phase_strs, args in self.groups:
+            experiment = Experiment(name, phase_strs)
+            engine = BatchEngine(experiment, self.candidate_args(args, candidates, self.observations.stimuli(experiment.name)), seed = self.seed)
+            results = engine.run()
+
+            for (phase, group, cs), (trials, responses) in self.observations.series.items():
+                if group != experiment.name:
+                    continue
+
+                hist = results[phase - 1][cs.replace('q(', '(')]
+                if trials.max() > hist.shape[1]:
+                    raise ValueError(f'{group} - {cs} only has {hist.shape[1]} trials in phase {phase}.')
+
+                residuals.append(hist[:, trials - 1, 0] - responses)
+
+        return losses[self.loss](numpy.concatenate(residuals, axis = 1))
+
+    # A single restart of the cross-entropy method: sample a population around
+    # the current estimate, and move towards the best candidates.
+    def run_restart(self, seed: int, iterations: int = 30, population: int = 32, elite: float = .2) -> tuple[numpy.ndarray, float]:
+        rng = numpy.random.default_rng(seed)
+        mean = rng.uniform(self.lower, self.upper)
+        std = (self.upper - self.lower) / 4
+
+        best, best_loss = mean, math.inf
+        num_elite = max(2, math.ceil(elite * population))
+        for _ in range(iterations):
+            candidates = numpy.clip(mean + std * rng.standard_normal((population, len(self.names))), self.lower, self.upper)
+            candidates[0] = best
+
+            loss = self.evaluate(candidates)
+            order = numpy.argsort(loss)
+            if loss[order[0]] < best_loss:
+                best, best_loss = candidates[order[0]], float(loss[order[0]])
+
+            elites = candidates[order[:num_elite]]
+            mean = elites.mean(axis = 0)
+            std = .7 * elites.std(axis = 0) + .3 * std
+
+            if numpy.all(std < 1e-6 * (self.upper - self.lower)):
+                break
+
+        return best, best_loss
+
+    # Fitted trajectories of the candidate, in the same form as Simulator.runExperiment.
+    def strengths(self, candidate: numpy.ndarray) -> tuple[list[dict[str, StimulusHistory]], dict]:
+        strengths: None | list[dict[str, StimulusHistory]] = None
+        phases = {}
+        for name, phase_strs, args in self.groups:
+            engine = BatchEngine(Experiment(name, phase_strs), self.candidate_args(args, candidate[None, :]), seed = self.seed)
+            local = engine.strengths(engine.run(), 0)
+            strengths = local if strengths is None else [a | b for a, b in zip(strengths, local)]
+            phases[engine.experiment.name] = engine.experiment.phases
+
+        return strengths or [], phases
+
+def parse_bounds(param: str) -> tuple[str, tuple[float, float]]:
+    if '=' not in param or param.count(':') != 1:
+        raise argparse.ArgumentTypeError(f'Fitted parameters must be given as name=lower:upper, not "{param}".')
+
+    name, bounds = param.split('=', maxsplit = 1)
+    lower, upper = bounds.split(':')
+    return name.strip(), (float(lower), float(upper))
+
+def parse_args() -> tuple[argparse.Namespace, argparse.Namespace]:
+    parser = argparse.ArgumentParser(
+        description = 'Fit parameters of an experiment to observed responses.',
+        formatter_class = argparse.RawTextHelpFormatter,
+        epilog = '''\
+Any other option of the command-line interface sets the parameters that are
+not fitted. The fitted parameters of every restart are printed; the fitted
+trajectories are saved with --save-results, and plotted alongside the
+observations with --savefig.
+
+Example:
+  %(prog)s Experiments/LIrr-LePelley.rw --data observed.csv --fit beta=0:1 --fit alpha_A=0.05:1
+''',
+    )
+    parser.add_argument('--data', metavar = 'filename', type = argparse.FileType('r'), required = True, help = 'CSV of observed responses, with columns Phase, Group, CS, Trial and the response.')
+    parser.add_argument('--response-column', metavar = 'column', default = 'Response', help = 'Column of --data with the observed responses.')
+    parser.add_argument('--fit', metavar = 'name=lower:upper', type = parse_bounds, action = 'append', default = [], help = 'Parameter to fit and its bounds, named as in the "@" lines of experiment files: beta, betan, alpha_A, ...')
+    parser.add_argument('--loss', choices = losses.keys(), default = 'sse', help = 'Loss minimised between simulated and observed responses.')
+    parser.add_argument('--restarts', type = int, default = 4, help = 'Number of random restarts, run in parallel.')
+    parser.add_argument('--iterations', type = int, default = 30, help = 'Maximum number of iterations of every restart.')
+    parser.add_argument('--population', type = int, default = 32, help = 'Number of candidates evaluated together in every iteration.')
+    parser.add_argument('--seed', type = int, default = 0, help = 'Seed for the restarts and the random orders of randomised phases.')
+
+    args, rest = parser.parse_known_args()
+    if not args.fit:
+        raise ValueError('At least one --fit is needed.')
+
+    sys.argv[1:] = rest
+    return args, Simulator.parse_args()
+
+def main():
+    fit_args, args = parse_args()
+
+    if args.summary is not None or args.store is not None:
+        raise ValueError('Fits cannot be used with --summary or --store.')
+
+    base = RWArgs(
+        **{k: v for k, v in args.__dict__.items() if k in set(RWArgs.__match_args__) and v is not None}
+    )
+    # The "@" lines of the file only affect the groups after them.
+    groups = [
+        (name, phase_strs, copy.deepcopy(base))
+        for name, phase_strs in Simulator.parse_experiment_file(args.experiment_file, base)
+    ]
+
+    fitter = Fitter(
+        groups,
+        bounds = dict(fit_args.fit),
+        observations = Observations.read(fit_args.data, fit_args.response_column),
+        loss = fit_args.loss,
+        seed = fit_args.seed,
+    )
+
+    seeds = numpy.random.SeedSequence(fit_args.seed).generate_state(fit_args.restarts).tolist()
+    cpu_count = getattr(os, 'process_cpu_count', os.cpu_count)() or 1
+    with ProcessPoolExecutor(max_workers = min(fit_args.restarts, args.max_workers or cpu_count)) as executor:
+        futures = [executor.submit(fitter.run_restart, seed, fit_args.iterations, fit_args.population) for seed in seeds]
+        restarts = sorted([f.result() for f in futures], key = lambda x: x[1])
+
+    writer = DictWriter(sys.stdout, fieldnames = ['Restart', 'Loss'] + fitter.names)
+    writer.writeheader()
+    for num, (candidate, loss) in enumerate(restarts, start = 1):
+        writer.writerow({'Restart': num, 'Loss': loss, **dict(zip(fitter.names, candidate.tolist()))})
+
+    best = restarts[0][0]
+    if args.save_results is None and args.savefig is None:
+        return
+
+    strengths, phases = fitter.strengths(best)
+    if args.save_results is not None:
+        with open(args.save_results, 'w') as file:
+            StimulusHistory.exportData(strengths, file = file, should_plot_macknhall = args.plot_macknhall)
+
+    if args.savefig is not None:
+        from Plots import save_plots
+
+        observed = fitter.observations.strengths(len(strengths))
+        save_plots(
+            [a | b for a, b in zip(strengths, observed)],
+            phases = phases,
+            filename = args.savefig,
+            plot_phase = args.plot_phase,
+            plot_alpha = args.plot_alpha,
+            plot_macknhall = args.plot_macknhall,
+            show_title = args.show_title,
+            plot_stimuli = args.plot_stimuli,
+            singular_legend = args.singular_legend,
+            dpi = args.dpi,
+            plot_width = args.output_width,
+        )
+
+if __name__ == '__main__':
+    main()
@@ -7,7 +7,7 @@ import re
 from typing import cast
 
 from PySide6.QtCore import Qt, QSize
-from PySide6.QtGui import QIcon
+from PySide6.QtGui import QFont, QIcon
 from PySide6.QtWidgets import *
 
 from PIL import Image
@@ -15,6 +15,7 @@ from pathlib import Path
 from datetime import datetime
 from Models import Model
 from Environment import StimulusHistory
+from Profiler import Profiler
 
 # Putting this here so mypy stops complaining.
 from PySide6.QtWidgets import QFormLayout, QGroupBox, QPushButton, QWidget, QScrollArea
@@ -203,10 +204,35 @@ class ActionButtons(QWidget):
         toggleLegendButton.clicked.connect(self.toggleLegend)
         toggleLegendButton.setCheckable(True)
 
+        float32Button = QPushButton('Float32 History')
+        float32Button.setFocusPolicy(Qt.FocusPolicy.NoFocus)
+        float32Button.setStyleSheet(checkedStyle)
+        float32Button.setSizePolicy(QSizePolicy.Policy.Expanding, QSizePolicy.Policy.Preferred)
+        float32Button.setToolTip('Store the results in single precision, which takes less memory. The simulation always runs in double precision.')
+        float32Button.clicked.connect(self.toggleFloat32History)
+        float32Button.setCheckable(True)
+
+        strideOptionsLayout = QHBoxLayout()
+        strideLabel = QLabel('Every Nth trial')
+        strideLabel.setToolTip('Only store and plot every Nth trial of each stimulus.')
+        self.strideBox = QSpinBox()
+        self.strideBox.setRange(1, 1000)
+        self.strideBox.setValue(self.parent.history_stride)
+        self.strideBox.setFocusPolicy(Qt.FocusPolicy.ClickFocus)
+        self.strideBox.editingFinished.connect(self.changeHistoryStride)
+        strideOptionsLayout.addWidget(strideLabel)
+        strideOptionsLayout.addWidget(self.strideBox)
+        strideOptionsLayout.setSpacing(0)
+
         exportDataButton = QPushButton("Export Data")
         exportDataButton.clicked.connect(self.exportData)
         exportDataButton.setFocusPolicy(Qt.FocusPolicy.NoFocus)
 
+        profileButton = QPushButton('Profile Refresh')
+        profileButton.setToolTip('Refresh the experiment and show the time spent in every stage.')
+        profileButton.clicked.connect(self.profileRefresh)
+        profileButton.setFocusPolicy(Qt.FocusPolicy.NoFocus)
+
         # refreshButton = QPushButton("Refresh")
         # refreshButton.clicked.connect(parent.refreshExperiment)
         # refreshButton.setFocusPolicy(Qt.FocusPolicy.NoFocus)
@@ -268,6 +294,8 @@ class ActionButtons(QWidget):
         plotOptionsLayout.addWidget(plotAlphaButton)
         plotOptionsLayout.addWidget(partStimuliButton)
         plotOptionsLayout.addWidget(toggleLegendButton)
+        plotOptionsLayout.addWidget(float32Button)
+        plotOptionsLayout.addLayout(strideOptionsLayout)
         plotOptionsLayout.addWidget(printButton)
         plotOptionsLayout.addWidget(savePlotButton)
         plotOptionsLayout.addWidget(hideButton)
@@ -286,6 +314,7 @@ class ActionButtons(QWidget):
         fileOptionsLayout.addWidget(fileButton)
         fileOptionsLayout.addWidget(saveButton)
         fileOptionsLayout.addWidget(exportDataButton)
+        fileOptionsLayout.addWidget(profileButton)
         # fileOptionsLayout.setAlignment(Qt.AlignmentFlag.AlignTop)
         fileOptionsLayout.addStretch(1)
         fileOptionsLayout.setSpacing(1)
@@ -456,6 +485,17 @@ class ActionButtons(QWidget):
         self.parent.plot_part_stimuli = not self.parent.plot_part_stimuli
         self.parent.refreshExperiment()
 
+    def toggleFloat32History(self):
+        self.parent.history_float32 = not self.parent.history_float32
+        self.parent.refreshExperiment()
+
+    def changeHistoryStride(self):
+        if self.strideBox.value() == self.parent.history_stride:
+            return
+
+        self.parent.history_stride = self.strideBox.value()
+        self.parent.refreshExperiment()
+
     def toggleLegend(self):
         self.parent.show_legend = not self.parent.show_legend
         self.parent.refreshExperiment()
@@ -469,6 +509,27 @@ class ActionButtons(QWidget):
         with open(fileName, 'w') as file:
             StimulusHistory.exportData(self.parent.strengths, file, args.should_plot_macknhall)
 
+    def profileRefresh(self):
+        with Profiler(profile_simulation = True) as profiler:
+            self.parent.refreshExperiment()
+
+        font = QFont('Monospace')
+        font.setStyleHint(QFont.StyleHint.TypeWriter)
+
+        box = QMessageBox(QMessageBox.Information, 'Profile', profiler.table(), parent = self)
+        box.setTextFormat(Qt.TextFormat.PlainText)
+        box.setFont(font)
+        saveButton = box.addButton('Save cProfile', QMessageBox.ButtonRole.ActionRole)
+        box.addButton(QMessageBox.StandardButton.Close)
+        box.exec()
+
+        if box.clickedButton() is not saveButton:
+            return
+
+        fileName, _ = QFileDialog.getSaveFileName(self, 'Save cProfile', 'simulation.prof', 'cProfile files (*.prof);;All Files (*)')
+        if fileName:
+            profiler.dump(fileName)
+
     def savePlotDialog(self):
         dialog = QDialog(self)
         dialog.setWindowTitle("Save Plots")
@@ -866,14 +927,22 @@ class ModelButtons(QGroupBox):
 
         parent.refreshExperiment()
 
+# Stands in for the canvas of the figures until Matplotlib is imported, with
+# the same size as an empty canvas so that the window keeps its size.
+class PlotPlaceholder(QWidget):
+    def sizeHint(self):
+        return QSize(640, 480)
+
 class PlotBox(QGroupBox):
     def __init__(self, parent):
         super().__init__('Plot', parent = parent)
         # self.setContentsMargins(0, 0, 0, 0)
         self.parent = parent
 
-        from matplotlib.backends.backend_qtagg import FigureCanvasQTAgg
-        self.plotCanvas = FigureCanvasQTAgg()
+        # Matplotlib is imported in the background once the window is shown,
+        # so the canvas is a placeholder until the first figure; see loadCanvas.
+        self.plotCanvas = PlotPlaceholder()
+        self.canvasLoaded = False
 
         self.phaseBox = PhaseBox(parent, screenshot_ready = False)
 
@@ -886,6 +955,19 @@ class PlotBox(QGroupBox):
         layout.setSpacing(0)
         self.setLayout(layout)
 
+    def loadCanvas(self):
+        if self.canvasLoaded:
+            return
+
+        from matplotlib.backends.backend_qtagg import FigureCanvasQTAgg
+        canvas = FigureCanvasQTAgg()
+        canvas.resize(self.plotCanvas.size())
+
+        self.layout().replaceWidget(self.plotCanvas, canvas)
+        self.plotCanvas.deleteLater()
+        self.plotCanvas = canvas
+        self.canvasLoaded = True
+
     def setInitialSize(self):
         diff = 800 - self.plotCanvas.width()
         if diff <= 0:
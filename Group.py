@@ -1,43 +1,133 @@
 from __future__ import annotations
 
-from math import prod
+import copy
+import threading
+from typing import ClassVar, TYPE_CHECKING
 
-from Environment import Environment, StimulusHistory, Stimulus
+import numpy
+
+from Counters import Counters
+from Environment import Environment, RecordSpec, Stimulus
 from Models import Model, RunParameters
 
+if TYPE_CHECKING:
+    from Experiment import RWArgs
+
+# Values of the parameters of every CS that can be given for single CS, with
+# one row per CS and one column per parameter.
+# A CS takes the value given for it, or otherwise the product of the values of
+# every character of its name, each defaulting to the value for all stimuli;
+# so the configural cue "(AB)" takes alpha_A * alpha_B. Parameters without a
+# default must be given for every CS.
+# Tables are shared by every group run with the same parameters, including
+# those of other threads, and the rows of the CS of a group are only resolved
+# the first time they're needed.
+class ParameterTable:
+    # Parameters of a Stimulus, and the RWArgs fields of their values for single
+    # CS and of their default.
+    params: ClassVar[dict[str, tuple[str, str]]] = {
+        'alpha': ('alphas', 'alpha'),
+        'salience': ('saliences', 'salience'),
+        'alpha_mack': ('alpha_macks', 'alpha_mack'),
+        'alpha_hall': ('alpha_halls', 'alpha_hall'),
+        'habituation': ('habituations', 'habituation'),
+    }
+
+    # Tables by their parameters; see `from_args`.
+    shared: ClassVar[dict[tuple, ParameterTable]] = {}
+    max_shared: ClassVar[int] = 256
+    shared_lock: ClassVar[threading.Lock] = threading.Lock()
+
+    given: list[dict[str, float]]
+    defaults: list[None | float]
+
+    rows: dict[str, int]
+    values: numpy.ndarray
+    lock: threading.Lock
+
+    def __init__(self, given: list[dict[str, float]], defaults: list[None | float]):
+        self.given = given
+        self.defaults = defaults
+        self.rows = {}
+        self.values = numpy.empty((0, len(self.params)))
+        self.lock = threading.Lock()
+
+    # The table of the parameters of `args`. The values of `args` are copied,
+    # so changing them later doesn't change the table.
+    @classmethod
+    def from_args(cls, args: RWArgs) -> ParameterTable:
+        given = [getattr(args, vals) for vals, _ in cls.params.values()]
+        defaults = [getattr(args, default) for _, default in cls.params.values()]
+
+        key = tuple(
+            (default, tuple(sorted(vals.items())), getattr(vals, 'default_factory', None))
+            for vals, default in zip(given, defaults)
+        )
+        with cls.shared_lock:
+            if key not in cls.shared:
+                if len(cls.shared) >= cls.max_shared:
+                    cls.shared.clear()
+
+                cls.shared[key] = cls([copy.copy(vals) for vals in given], defaults)
+
+            return cls.shared[key]
+
+    # CS that have a value given for any parameter.
+    def given_cs(self) -> set[str]:
+        return set().union(*(vals.keys() for vals in self.given))
+
+    # Rows of the given CS, resolving those that aren't in the table yet.
+    def resolve(self, cs: list[str]) -> numpy.ndarray:
+        with self.lock:
+            new = [k for k in dict.fromkeys(cs) if k not in self.rows]
+            if new:
+                self.values = numpy.concatenate([self.values, self.compute(new)])
+                self.rows |= {k: len(self.rows) + e for e, k in enumerate(new)}
+
+            return self.values[[self.rows[k] for k in cs]]
+
+    def compute(self, cs: list[str]) -> numpy.ndarray:
+        names = [k.strip('()') for k in cs]
+        symbols = sorted(set(''.join(names)))
+
+        # Characters of every CS as indices into the values of the symbols,
+        # where 0 is a factor of 1 for the padding of shorter names.
+        index = {c: e + 1 for e, c in enumerate(symbols)}
+        chars = numpy.zeros((len(cs), max(len(x) for x in names)), dtype = int)
+        for e, name in enumerate(names):
+            chars[e, :len(name)] = [index[c] for c in name]
+
+        values = numpy.empty((len(cs), len(self.params)))
+        for p, (vals, default) in enumerate(zip(self.given, self.defaults)):
+            if default is None:
+                values[:, p] = [vals[k] for k in cs]
+                continue
+
+            # Multiplied in the order of the characters of the names.
+            factors = numpy.array([1.] + [vals.get(c, default) for c in symbols])
+            column = numpy.ones(len(cs))
+            for k in range(chars.shape[1]):
+                column = column * factors[chars[:, k]]
+
+            explicit = [e for e, k in enumerate(cs) if k in vals]
+            column[explicit] = [vals[cs[e]] for e in explicit]
+            values[:, p] = column
+
+        return values
+
 class Group:
     name: str
 
     s: Environment
     configural_cues: bool
+    record: RecordSpec
 
     model: Model
 
-    @staticmethod
-    def set_vals(cs: set[str], vals: dict[str, float], default: None | float) -> dict[str, float]:
-        if default is None:
-            return vals
-
-        for k in cs:
-            if k not in vals:
-                vals[k] = prod(vals.get(x, default) for x in k.strip('()'))
-
-        return vals
-
     def __init__(
         self,
         name: str,
-
-        alphas: dict[str, float],
-        default_alpha: float,
-        alpha_macks: dict[str, float],
-        default_alpha_mack: None | float,
-        alpha_halls: dict[str, float],
-        default_alpha_hall: None | float,
-        saliences: dict[str, float],
-        default_salience: float,
-        habituations: dict[str, float],
-        default_habituation: float,
+        parameters: ParameterTable,
 
         rho: float,
         nu: float,
@@ -51,38 +141,30 @@ class Group:
         cs: set[str] = set(),
         model: None | str = None,
         xi_hall: None | float = None,
+        record: None | RecordSpec = None,
+        configural_cues: bool = False,
     ):
-        cs = cs | alphas.keys() | saliences.keys() | habituations.keys() | alpha_macks.keys() | alpha_halls.keys()
-
-        alphas = self.set_vals(cs, alphas, default_alpha)
-        saliences = self.set_vals(cs, saliences, default_salience)
-        alpha_macks = self.set_vals(cs, alpha_macks, default_alpha_mack)
-        alpha_halls = self.set_vals(cs, alpha_halls, default_alpha_hall)
-        habituations = self.set_vals(cs, habituations, default_habituation)
+        cs = list(cs | parameters.given_cs())
+        values = parameters.resolve(cs).tolist()
 
         self.name = name
 
-
         self.s = Environment(
             s = {
                 k: Stimulus(
                     name = k,
-                    alpha = alphas[k],
-                    salience = saliences[k],
-                    habituation = habituations[k],
-                    alpha_mack = alpha_macks[k],
-                    alpha_hall = alpha_halls[k],
                     rho = rho,
                     nu = nu,
+                    **dict(zip(ParameterTable.params, row)),
                 )
-                for k in cs
-            }
+                for k, row in zip(cs, values)
+            },
+            configural_cues = configural_cues,
         )
 
-        # Copy configural cues from global environment.
-        # This is necessary due to spawn issues in MacOS; we should
-        # ideally remove the class variable altogether.
-        self.configural_cues = Environment.configural_cues
+        self.configural_cues = configural_cues
+
+        self.record = record or RecordSpec()
 
         self.model = Model.get(
             model,
@@ -96,13 +178,24 @@ class Group:
             kay = kay,
         )
 
+    # Return the current state of `cs` to be recorded. Compounds are already a
+    # new Stimulus, and summaries only read the values, so neither is copied.
+    def snapshot(self, cs: str) -> Stimulus:
+        if cs not in self.s.s or self.record.summary is not None:
+            return self.s[cs]
+
+        return self.s.s[cs].copy()
+
     # runPhase runs a single trial of a phase, in order, and returns a list of the Strength values
     # of its CS at every step.
     # It also modifies `self.s` to account for all the strengths modified in this phase.
+    # In summary mode, the result is a single Environment of StimulusSummary values.
     def runPhase(self, parts: list[tuple[str, str]], phase_beta: None | float, phase_lamda: None | float) -> list[Environment]:
-        hist = StimulusHistory.emptydict()
+        hist: dict = self.record.emptydict()
 
         for e, (part, plus) in enumerate(parts, start = 1):
+            Counters.current.get()['trials'] += 1
+
             if plus == '++':
                 beta, lamda, sign = 2 * (phase_beta or self.model.betap), phase_lamda or self.model.lamda, 1
             elif plus == '+':
@@ -110,7 +203,7 @@ class Group:
             else:
                 beta, lamda, sign = self.model.betan, 0., -1
 
-            compounds = Environment.list_cs(part)
+            compounds = Environment.list_cs(part, self.configural_cues)
 
             rp = RunParameters(
                 beta = beta,
@@ -129,17 +222,22 @@ class Group:
             secondMaxAssoc = max([self.s[x].assoc for x in compounds if x != argmaxAssoc], default = 0)
 
             # This is a predictive model. Do not include the last stimulus in the plot.
-            hist[part].add(self.s[part])
-            hist[part + plus].add(self.s[part])
+            # Every state is snapshotted at most once per trial, and all the
+            # histories recording it share that snapshot.
+            snapshots: dict[str, Stimulus] = {}
+            for key, cs in self.record.trial_keys(self.name, part, plus, compounds):
+                if cs not in snapshots and hist[key].due():
+                    snapshots[cs] = self.snapshot(cs)
 
-            for cs in compounds:
-                if len(compounds) > 1:
-                    hist[cs].add(self.s[cs])
-                    hist[f'{cs}{{{part + plus}}}'].add(self.s[cs])
+                hist[key].record(snapshots.get(cs))
 
+            for cs in compounds:
                 # We need to calculate max_{i != cs} V_i.
                 # This is always either the maximum V_i, or the second maximum when i = cs.
                 rp.maxAssocRest = maxAssoc if cs != argmaxAssoc else secondMaxAssoc
                 self.model.run_step(self.s[cs], rp)
 
-        return Environment.fromHistories(hist)
+        if self.record.summary is not None:
+            return [Environment(s = dict(hist), configural_cues = self.configural_cues)]
+
+        return Environment.fromHistories(hist, self.configural_cues)
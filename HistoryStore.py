@@ -0,0 +1,153 @@
+from __future__ import annotations
+
+import json
+from pathlib import Path
+from typing import Any, ClassVar
+
+import numpy
+
+from Environment import CompactHistory, StimulusHistory
+from Experiment import Phase
+
+# A history whose values are views into a numpy array with one row per
+# recorded trial and one column per HistoryStore field, such as the memory map
+# of a HistoryStore or the results of the BatchEngine.
+# Values are only read from the array when they are plotted or exported.
+class ArrayHistory(CompactHistory):
+    def __init__(self, data: numpy.ndarray, start: int, length: int, stride: int = 1):
+        StimulusHistory.__init__(self, stride = stride)
+
+        view = data[start : start + length]
+        self.values = {f: view[:, e] for e, f in enumerate(CompactHistory.fields)} # type: ignore
+        self.compounds = view[:, len(CompactHistory.fields)] # type: ignore
+
+    def __getattr__(self, key):
+        if key == 'compound':
+            return [bool(x) for x in self.compounds]
+
+        if key not in self.fields:
+            raise AttributeError(key)
+
+        return self.values[key].tolist()
+
+# Results of a simulation stored on disk, for runs whose histories don't fit in memory.
+# A store is a directory with two files:
+#   data.bin: every recorded trial of every series, as a row of `fields`.
+#   index.json: the schema, the phases of every group, and where every
+#               (phase, group, CS) series starts in data.bin and its length.
+# Series are appended as soon as each group finishes, and are read back
+# through a memory map, so a store can be reopened later for replotting.
+# Groups are written whole by the main process, so every group must still fit
+# in memory by itself.
+class HistoryStore:
+    fields: ClassVar[list[str]] = CompactHistory.fields + ['compound']
+
+    path: Path
+    precision: str
+    stride: int
+
+    # Phase strings of every group, by the name used in the experiment file.
+    groups: dict[str, list[str]]
+
+    # One entry per series, with keys phase, group, cs, start and length.
+    series: list[dict[str, Any]]
+
+    num_rows: int
+    file: Any
+
+    def __init__(self, path: str | Path, precision: str = 'float64', stride: int = 1):
+        self.path = Path(path)
+        self.precision = precision
+        self.stride = stride
+        self.groups = {}
+        self.series = []
+        self.num_rows = 0
+        self.file = None
+
+    @classmethod
+    def create(cls, path: str | Path, precision: str = 'float64', stride: int = 1) -> HistoryStore:
+        store = cls(path, precision, stride)
+        store.path.mkdir(parents = True, exist_ok = True)
+        store.file = open(store.path / 'data.bin', 'wb')
+        store.write_index()
+        return store
+
+    @classmethod
+    def open(cls, path: str | Path) -> HistoryStore:
+        path = Path(path)
+        with open(path / 'index.json') as file:
+            index = json.load(file)
+
+        if index['fields'] != cls.fields:
+            raise ValueError(f'Unknown fields in {path}: {index["fields"]}')
+
+        store = cls(path, index['precision'], index['stride'])
+        store.groups = index['groups']
+        store.series = index['series']
+        store.num_rows = index['num_rows']
+        return store
+
+    # Append the results of a single group, as returned by Experiment.run_all_phases.
+    def write_group(self, name: str, phase_strs: list[str], strengths: list[dict[str, StimulusHistory]]):
+        if self.file is None:
+            raise ValueError(f'History store {self.path} is not open for writing.')
+
+        self.groups[name] = phase_strs
+        for phase_num, phase in enumerate(strengths, start = 1):
+            for group_cs, hist in phase.items():
+                if not isinstance(hist, StimulusHistory):
+                    raise ValueError('Summaries cannot be written to a history store.')
+
+                group, cs = group_cs.rsplit(' - ', maxsplit = 1)
+                rows = numpy.array(
+                    [[getattr(s, f) for f in self.fields] for s in hist],
+                    dtype = object,
+                ).reshape(-1, len(self.fields))
+                rows = numpy.where(rows == None, numpy.nan, rows).astype(self.precision)
+                rows.tofile(self.file)
+
+                self.series.append(dict(phase = phase_num, group = group, cs = cs, start = self.num_rows, length = len(rows)))
+                self.num_rows += len(rows)
+
+        self.file.flush()
+        self.write_index()
+
+    def write_index(self):
+        index = dict(
+            fields = self.fields,
+            precision = self.precision,
+            stride = self.stride,
+            num_rows = self.num_rows,
+            groups = self.groups,
+            series = self.series,
+        )
+
+        with open(self.path / 'index.json', 'w') as file:
+            json.dump(index, file)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+        self.write_index()
+
+    def data(self) -> numpy.ndarray:
+        if self.num_rows == 0:
+            return numpy.empty((0, len(self.fields)), dtype = self.precision)
+
+        return numpy.memmap(self.path / 'data.bin', dtype = self.precision, mode = 'r', shape = (self.num_rows, len(self.fields)))
+
+    # Results in the same form as Simulator.runExperiment, backed by the memory map.
+    def strengths(self) -> list[dict[str, StimulusHistory]]:
+        data = self.data()
+        num_phases = max((s['phase'] for s in self.series), default = 0)
+
+        strengths: list[dict[str, StimulusHistory]] = [{} for _ in range(num_phases)]
+        for s in self.series:
+            strengths[s['phase'] - 1][f'{s["group"]} - {s["cs"]}'] = ArrayHistory(data, s['start'], s['length'], self.stride)
+
+        return strengths
+
+    def phases(self) -> dict[str, list[Phase]]:
+        return {name: [Phase(x) for x in phase_strs] for name, phase_strs in self.groups.items()}
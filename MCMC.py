@@ -0,0 +1,209 @@
+from __future__ import annotations
+
+import argparse
+import copy
+import os
+import sys
+from csv import DictWriter
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy
+
+import Simulator
+from BatchEngine import BatchEngine
+from Experiment import Experiment, RWArgs
+from Fit import Fitter, Observations, parse_bounds
+
+# Affine-invariant ensemble sampler (Goodman & Weare, 2010) of the posterior
+# of the parameters of a Fitter, given its observations.
+# The prior is uniform within the bounds of the Fitter, and the responses
+# are assumed to have gaussian noise of the given standard deviation.
+# Each step moves every half of the walkers towards or away from walkers of
+# the other half, so the proposals of a half are evaluated as a single batch.
+class EnsembleSampler:
+    fitter: Fitter
+    noise: float
+    walkers: int
+
+    # Scale of the stretch move.
+    a: float
+
+    def __init__(self, fitter: Fitter, noise: float = .1, walkers: int = 32, a: float = 2.):
+        if walkers < 2 * len(fitter.names):
+            raise ValueError(f'At least {2 * len(fitter.names)} walkers are needed for {len(fitter.names)} parameters.')
+
+        self.fitter = fitter
+        self.noise = noise
+        self.walkers = walkers
+        self.a = a
+
+    def log_prob(self, candidates: numpy.ndarray) -> numpy.ndarray:
+        inside = numpy.all((candidates >= self.fitter.lower) & (candidates <= self.fitter.upper), axis = 1)
+
+        log_prob = numpy.full(len(candidates), -numpy.inf)
+        if inside.any():
+            log_prob[inside] = -.5 * self.fitter.evaluate(candidates[inside]) / self.noise ** 2
+
+        return log_prob
+
+    # Run a single chain of the ensemble, starting from the prior. Returns the
+    # positions of every walker at every step, their log probabilities, and
+    # the fraction of accepted proposals of every walker.
+    def run_chain(self, seed: int, steps: int) -> tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+        rng = numpy.random.default_rng(seed)
+        num_params = len(self.fitter.names)
+
+        pos = rng.uniform(self.fitter.lower, self.fitter.upper, (self.walkers, num_params))
+        log_prob = self.log_prob(pos)
+
+        chain = numpy.empty((steps, self.walkers, num_params))
+        log_probs = numpy.empty((steps, self.walkers))
+        accepted = numpy.zeros(self.walkers)
+
+        halves = numpy.arange(self.walkers) % 2
+        for step in range(steps):
+            for half in (0, 1):
+                walkers = numpy.flatnonzero(halves == half)
+                others = numpy.flatnonzero(halves != half)
+
+                z = ((self.a - 1) * rng.random(len(walkers)) + 1) ** 2 / self.a
+                partners = pos[rng.choice(others, len(walkers))]
+                proposals = partners + z[:, None] * (pos[walkers] - partners)
+
+                proposal_log_prob = self.log_prob(proposals)
+                log_accept = (num_params - 1) * numpy.log(z) + proposal_log_prob - log_prob[walkers]
+                accept = numpy.log(rng.random(len(walkers))) < log_accept
+
+                pos[walkers[accept]] = proposals[accept]
+                log_prob[walkers[accept]] = proposal_log_prob[accept]
+                accepted[walkers[accept]] += 1
+
+            chain[step] = pos
+            log_probs[step] = log_prob
+
+        return chain, log_probs, accepted / steps
+
+# Potential scale reduction factor of every parameter, given samples with
+# shape (steps, sequences, parameters).
+def rhat(samples: numpy.ndarray) -> numpy.ndarray:
+    n = samples.shape[0]
+    means = samples.mean(axis = 0)
+    within = samples.var(axis = 0, ddof = 1).mean(axis = 0)
+    between = n * means.var(axis = 0, ddof = 1)
+
+    return numpy.sqrt(((n - 1) / n * within + between / n) / within)
+
+# Percentiles of the associative strength of every key over the given
+# parameter sets, by group, phase and key: an array with one row per trial,
+# and one column per percentile.
+def predictive_bands(fitter: Fitter, samples: numpy.ndarray, percentiles: list[float]) -> dict[tuple[int, str, str], numpy.ndarray]:
+    bands = {}
+    for name, phase_strs, args in fitter.groups:
+        engine = BatchEngine(Experiment(name, phase_strs), fitter.candidate_args(args, samples), seed = fitter.seed)
+        for phase_num, phase in enumerate(engine.run(), start = 1):
+            for key, hist in phase.items():
+                bands[phase_num, engine.experiment.name, key.replace('(', 'q(')] = numpy.percentile(hist[:, :, 0], percentiles, axis = 0).T
+
+    return bands
+
+def parse_args() -> tuple[argparse.Namespace, argparse.Namespace]:
+    parser = argparse.ArgumentParser(
+        description = 'Sample the posterior of parameters of an experiment given observed responses.',
+        formatter_class = argparse.RawTextHelpFormatter,
+        epilog = '''\
+Any other option of the command-line interface sets the parameters that are
+not sampled. A summary of the posterior and its convergence is printed; the
+chains are saved with --save-chains, and the posterior-predictive bands of
+every CS with --save-results.
+''',
+    )
+    parser.add_argument('--data', metavar = 'filename', type = argparse.FileType('r'), required = True, help = 'CSV of observed responses, with columns Phase, Group, CS, Trial and the response.')
+    parser.add_argument('--response-column', metavar = 'column', default = 'Response', help = 'Column of --data with the observed responses.')
+    parser.add_argument('--param', metavar = 'name=lower:upper', type = parse_bounds, action = 'append', default = [], help = 'Parameter to sample and the bounds of its uniform prior, named as in the "@" lines of experiment files.')
+    parser.add_argument('--noise', type = float, default = .1, help = 'Standard deviation of the gaussian noise of the responses.')
+    parser.add_argument('--walkers', type = int, default = 32, help = 'Number of walkers of every chain, evaluated together.')
+    parser.add_argument('--steps', type = int, default = 500, help = 'Number of steps of every chain.')
+    parser.add_argument('--burn-in', type = int, default = 100, help = 'Number of initial steps discarded from the summary and bands.')
+    parser.add_argument('--chains', type = int, default = 4, help = 'Number of independent chains, run in parallel.')
+    parser.add_argument('--predictive', type = int, default = 100, help = 'Number of posterior samples simulated for the posterior-predictive bands.')
+    parser.add_argument('--save-chains', metavar = 'filename', help = 'Save every step of every walker.')
+    parser.add_argument('--seed', type = int, default = 0, help = 'Seed for the chains and the random orders of randomised phases.')
+
+    args, rest = parser.parse_known_args()
+    if not args.param:
+        raise ValueError('At least one --param is needed.')
+
+    if args.burn_in >= args.steps:
+        raise ValueError('--burn-in must be smaller than --steps.')
+
+    sys.argv[1:] = rest
+    return args, Simulator.parse_args()
+
+def main():
+    mcmc_args, args = parse_args()
+
+    if args.summary is not None or args.store is not None or args.savefig is not None:
+        raise ValueError('MCMC only writes tables of results; --summary, --savefig and --store cannot be used.')
+
+    base = RWArgs(
+        **{k: v for k, v in args.__dict__.items() if k in set(RWArgs.__match_args__) and v is not None}
+    )
+    # The "@" lines of the file only affect the groups after them.
+    groups = [
+        (name, phase_strs, copy.deepcopy(base))
+        for name, phase_strs in Simulator.parse_experiment_file(args.experiment_file, base)
+    ]
+
+    fitter = Fitter(
+        groups,
+        bounds = dict(mcmc_args.param),
+        observations = Observations.read(mcmc_args.data, mcmc_args.response_column),
+        loss = 'sse',
+        seed = mcmc_args.seed,
+    )
+    sampler = EnsembleSampler(fitter, noise = mcmc_args.noise, walkers = mcmc_args.walkers)
+
+    seeds = numpy.random.SeedSequence(mcmc_args.seed).generate_state(mcmc_args.chains).tolist()
+    cpu_count = getattr(os, 'process_cpu_count', os.cpu_count)() or 1
+    with ProcessPoolExecutor(max_workers = min(mcmc_args.chains, args.max_workers or cpu_count)) as executor:
+        futures = [executor.submit(sampler.run_chain, seed, mcmc_args.steps) for seed in seeds]
+        chains, log_probs, acceptances = (numpy.array(x) for x in zip(*[f.result() for f in futures]))
+
+    if mcmc_args.save_chains is not None:
+        with open(mcmc_args.save_chains, 'w') as file:
+            writer = DictWriter(file, fieldnames = ['Chain', 'Step', 'Walker', 'LogProb'] + fitter.names)
+            writer.writeheader()
+            for chain_num, (chain, log_prob) in enumerate(zip(chains, log_probs), start = 1):
+                for step, (pos, lp) in enumerate(zip(chain, log_prob), start = 1):
+                    for walker, (x, l) in enumerate(zip(pos, lp), start = 1):
+                        writer.writerow({'Chain': chain_num, 'Step': step, 'Walker': walker, 'LogProb': l, **dict(zip(fitter.names, x.tolist()))})
+
+    # Every walker of every chain is a sequence for the convergence diagnostics.
+    kept = chains[:, mcmc_args.burn_in:]
+    sequences = kept.transpose(1, 0, 2, 3).reshape(kept.shape[1], -1, len(fitter.names))
+    samples = sequences.reshape(-1, len(fitter.names))
+
+    writer = DictWriter(sys.stdout, fieldnames = ['Parameter', 'Mean', 'SD', 'Q5', 'Median', 'Q95', 'Rhat'])
+    writer.writeheader()
+    for name, column, r in zip(fitter.names, samples.T, rhat(sequences)):
+        q5, median, q95 = numpy.percentile(column, [5, 50, 95])
+        writer.writerow({'Parameter': name, 'Mean': column.mean(), 'SD': column.std(), 'Q5': q5, 'Median': median, 'Q95': q95, 'Rhat': r})
+
+    print(f'Acceptance fraction: {acceptances.mean():.3f} (chains: {", ".join(f"{x:.3f}" for x in acceptances.mean(axis = 1))})', file = sys.stderr)
+
+    if args.save_results is None:
+        return
+
+    rng = numpy.random.default_rng(mcmc_args.seed)
+    predictive = samples[rng.choice(len(samples), min(mcmc_args.predictive, len(samples)), replace = False)]
+    bands = predictive_bands(fitter, predictive, [5, 50, 95])
+
+    with open(args.save_results, 'w') as file:
+        writer = DictWriter(file, fieldnames = ['Phase', 'Group', 'CS', 'Trial', 'Q5', 'Median', 'Q95'])
+        writer.writeheader()
+        for (phase, group, cs), band in bands.items():
+            for trial, (q5, median, q95) in enumerate(band.tolist(), start = 1):
+                writer.writerow({'Phase': phase, 'Group': group, 'CS': cs, 'Trial': trial, 'Q5': q5, 'Median': median, 'Q95': q95})
+
+if __name__ == '__main__':
+    main()
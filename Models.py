@@ -7,8 +7,11 @@ from __future__ import annotations
 from dataclasses import dataclass
 
 import math
-from typing import Type, ClassVar
+from typing import Any, Type, ClassVar
 
+import numpy
+
+from Counters import Counters
 from Environment import Stimulus
 
 @dataclass
@@ -61,6 +64,23 @@ class Model:
     def step(self, s: Stimulus, rp: RunParameters):
         raise NotImplementedError('Step method not overloaded.')
 
+    # Vectorised version of `step`, used by the BatchEngine to simulate many
+    # parameter sets and random trials at once. This is optional; models
+    # without it can only be run through Group.runPhase.
+    # Arguments:
+    #   s: StimulusBatch, the same fields as a Stimulus but as arrays with one
+    #      row per simulation and one column per CS of its trial, padded up
+    #      to the largest compound. Fields must be replaced or modified by the class.
+    #  rp: RunParameters, whose values are arrays with one row per simulation.
+    #      Only maxAssocRest has one column per CS of the trial.
+    # The model parameters (self.betan, self.gamma, ...) are also arrays with one row per simulation.
+    def step_batch(self, s: Any, rp: RunParameters):
+        raise NotImplementedError(f'{type(self).__name__} has no batched step.')
+
+    @classmethod
+    def has_step_batch(cls) -> bool:
+        return cls.step_batch is not Model.step_batch
+
     # List of parameters enabled by this model. Parameters not enabled will
     # be marked as gray on the GUI.
     # By default, enable all parameters.
@@ -154,6 +174,7 @@ class Model:
 
     def run_step(self, s: Stimulus, rp: RunParameters):
         assert rp.maxAssocRest != -1
+        Counters.current.get()['model_steps'] += 1
 
         self.delta_v_factor = rp.beta * (rp.lamda - rp.sigma)
         try:
@@ -165,6 +186,13 @@ class Model:
         for prop, (lower, upper) in self.bounds().items():
             setattr(s, prop, min(upper, max(lower, getattr(s, prop))))
 
+    def run_step_batch(self, s: Any, rp: RunParameters):
+        self.delta_v_factor = rp.beta * (rp.lamda - rp.sigma)
+        self.step_batch(s, rp)
+
+        for prop, (lower, upper) in self.bounds().items():
+            setattr(s, prop, numpy.clip(getattr(s, prop), lower, upper))
+
 class RescorlaWagner(Model):
     image_filename: ClassVar[str] = 'RW.png'
 
@@ -183,6 +211,9 @@ class RescorlaWagner(Model):
     def step(self, s: Stimulus, rp: RunParameters):
         s.assoc += s.alpha * self.delta_v_factor
 
+    def step_batch(self, s: Any, rp: RunParameters):
+        s.assoc = s.assoc + s.alpha * self.delta_v_factor
+
 class PearceKayeHall(Model):
     image_filename: ClassVar[str] = 'PKH.png'
 
@@ -212,6 +243,16 @@ class PearceKayeHall(Model):
         s.alpha = self.gamma * abs(rho) + (1 - self.gamma) * s.alpha
         s.assoc = s.Ve - s.Vi
 
+    def step_batch(self, s: Any, rp: RunParameters):
+        rho = rp.lamda - (rp.sigmaE - rp.sigmaI)
+        positive = rho >= 0
+
+        s.Ve = numpy.where(positive, s.Ve + rp.beta * s.alpha * rp.lamda * s.salience, s.Ve)
+        s.Vi = numpy.where(positive, s.Vi, s.Vi + self.betan * s.alpha * abs(rho) * s.salience)
+
+        s.alpha = self.gamma * abs(rho) + (1 - self.gamma) * s.alpha
+        s.assoc = s.Ve - s.Vi
+
 class MackExtended(Model):
     image_filename: ClassVar[str] = 'Extended_Mack.png'
 
@@ -253,6 +294,27 @@ class MackExtended(Model):
         s.Vi += DVi
         s.assoc = s.Ve - s.Vi
 
+    def step_batch(self, s: Any, rp: RunParameters):
+        rho = rp.lamda - (rp.sigmaE - rp.sigmaI)
+        betap = numpy.where(rp.sign == 1, rp.beta, self.betap)
+
+        LomE = rp.sigmaE - s.Ve
+        LomI = rp.sigmaI - s.Vi
+
+        positive = rho > 0
+        negative = rho < 0
+
+        DVe = numpy.where(positive, s.alpha * betap * (1 - s.Ve + s.Vi) * abs(rho), 0.)
+        DVi = numpy.where(negative, s.alpha * self.betan * (1 - s.Vi + s.Ve) * abs(rho), 0.)
+
+        alpha = numpy.where(positive, s.alpha - self.thetaE * (abs(rp.lamda - s.Ve + s.Vi) - abs(rp.lamda - LomE + LomI)), s.alpha)
+        alpha = numpy.where(negative, s.alpha - self.thetaI * (abs(abs(rho) - s.Vi + s.Ve) - abs(abs(rho) - LomI + LomE)), alpha)
+        s.alpha = numpy.clip(alpha, 0.05, 1)
+
+        s.Ve = s.Ve + DVe
+        s.Vi = s.Vi + DVi
+        s.assoc = s.Ve - s.Vi
+
 class LePelleyHybrid(Model):
     image_filename: ClassVar[str] = 'LePelley.png'
 
@@ -310,6 +372,37 @@ class LePelleyHybrid(Model):
         s.Vi += DVi
         s.assoc = s.Ve - s.Vi
 
+    def step_batch(self, s: Any, rp: RunParameters):
+        # Ignore likely dummy stimuli
+        dummy = (s.assoc == 0) & (s.alpha_mack == 0) & (s.alpha_hall == 0)
+
+        rho = rp.lamda - (rp.sigmaE - rp.sigmaI)
+
+        VXe = rp.sigmaE - s.Ve
+        VXi = rp.sigmaI - s.Vi
+
+        betap = numpy.where(rp.sign == 1, rp.beta, self.betap)
+
+        positive = rho >= 0
+        DVe = numpy.where(positive, s.alpha_mack * s.alpha_hall * betap * (1 - s.Ve + s.Vi) * abs(rho), 0.)
+        DVi = numpy.where(positive, 0., s.alpha_mack * s.alpha_hall * self.betan * (1 - s.Vi + s.Ve) * abs(rho))
+
+        alpha_mack = numpy.where(rho > 0, s.alpha_mack - self.thetaE * (abs(rp.lamda - s.Ve + s.Vi) - abs(rp.lamda - VXe + VXi)), s.alpha_mack)
+        alpha_mack = numpy.where(positive, alpha_mack, s.alpha_mack - self.thetaI * (abs(abs(rho) - s.Vi + s.Ve) - abs(abs(rho) - VXi + VXe)))
+        alpha_hall = self.gamma * (rp.lamda - rp.sigma) + (1 - self.gamma) * s.alpha_hall
+
+        alpha_mack = numpy.clip(alpha_mack, 0.05, 1)
+        alpha_hall = numpy.clip(alpha_hall, 0.5, 1)
+
+        Ve = s.Ve + DVe
+        Vi = s.Vi + DVi
+
+        s.alpha_mack = numpy.where(dummy, s.alpha_mack, alpha_mack)
+        s.alpha_hall = numpy.where(dummy, s.alpha_hall, alpha_hall)
+        s.Ve = numpy.where(dummy, s.Ve, Ve)
+        s.Vi = numpy.where(dummy, s.Vi, Vi)
+        s.assoc = numpy.where(dummy, s.assoc, Ve - Vi)
+
 class MlabHybrid(Model):
     @classmethod
     def parameters(cls) -> list[str]:
@@ -334,6 +427,13 @@ class MlabHybrid(Model):
 
         s.assoc = s.assoc + DV
 
+    def step_batch(self, s: Any, rp: RunParameters):
+        s.habituation = s.habituation * numpy.exp(-self.kay * s.salience)
+        DV = s.alpha * s.salience * (rp.lamda - rp.sigma)
+        s.alpha = (1-s.habituation) * (rp.lamda - rp.sigma)**2 * (s.nu + s.rho * ((rp.sigma - s.assoc) + (rp.sigma - rp.maxAssocRest))) + s.habituation * s.alpha
+
+        s.assoc = s.assoc + DV
+
 class MLABModel(Model):
     image_filename: ClassVar[str] = 'RW-Linear.png'
 
@@ -360,6 +460,15 @@ class MLABModel(Model):
         s.alpha = min(max(s.alpha, 0.05), 1)
         s.assoc += s.alpha * self.delta_v_factor
 
+    def step_batch(self, s: Any, rp: RunParameters):
+        d = 0.05
+
+        change = s.alpha_0 * s.assoc * (rp.lamda - rp.sigma)
+        alpha = numpy.where(rp.lamda > 0, s.alpha * (1 - d) + change, s.alpha * (1 - d) - change)
+
+        s.alpha = numpy.clip(alpha, 0.05, 1)
+        s.assoc = s.assoc + s.alpha * self.delta_v_factor
+
 # Extra models, not used in the simulator.
 # These can be added by adding an extra line to the `types` class method in the `Model` class.
 class Mack(Model):
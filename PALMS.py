@@ -7,17 +7,19 @@ import sys
 import logging
 
 from argparse import ArgumentParser
-from PySide6.QtWidgets import QApplication
-from PySide6.QtGui import QFont
-from PySide6.QtGui import QGuiApplication
-
-import Simulator
-from PavlovianApp import PavlovianApp
+from typing import TYPE_CHECKING
 
 from version import __version__
 
+# Qt and the GUI are only imported when the GUI runs, so that the command-line
+# interface starts without loading them.
+if TYPE_CHECKING:
+    from PySide6.QtWidgets import QApplication
+    from PySide6.QtGui import QFont
+
 def parse_args():
     if len(sys.argv) > 1 and sys.argv[1].lower() == 'cli':
+        import Simulator
         sys.argv[0] = f'{sys.argv[0]} {sys.argv[1]}'
         sys.argv[1:] = sys.argv[2:]
         Simulator.main()
@@ -47,12 +49,15 @@ def parse_args():
 
     args = gui_parser.parse_args()
     if args.version:
+        from PavlovianApp import PavlovianApp
         print(PavlovianApp.aboutMessage())
         exit(0)
 
     return args
 
 def logScreenInfo(app: QApplication):
+    from PySide6.QtGui import QGuiApplication
+
     logging.info(f'Logical DPI: {app.primaryScreen().logicalDotsPerInch()}.')
     logging.info(f'Platform name: {QGuiApplication.platformName()}')
     logging.info(f'Primary screen height: {app.primaryScreen().size().height()}')
@@ -66,6 +71,8 @@ def logScreenInfo(app: QApplication):
         logging.info(f'Env {envvar}: {os.environ.get(envvar)}')
 
 def defineFont(app: QApplication, fontScale: None | float, fontSize: None | int) -> QFont:
+    from PySide6.QtGui import QFont
+
     fontSize = app.font().pointSizeF()
 
     if fontScale:
@@ -88,6 +95,9 @@ def main():
         import multiprocessing
         multiprocessing.set_start_method("spawn", force = True)
 
+    from PySide6.QtWidgets import QApplication
+    from PavlovianApp import PavlovianApp
+
     app = QApplication(sys.argv)
 
     app.setFont(defineFont(app, args.fontscale, args.fontsize))
@@ -105,6 +115,9 @@ def main():
 
     code = app.exec()
 
+    from Experiment import Experiment
+    Experiment.stop_pool()
+
     sys.exit(code)
 
 if __name__ == '__main__':
@@ -4,23 +4,33 @@ from collections import defaultdict
 from itertools import zip_longest
 from pathlib import Path
 from typing import Optional
+import importlib
 import logging
 import datetime
+import threading
 
 from PySide6.QtCore import QTimer, Qt, QSize
 from PySide6.QtGui import QFont, QPixmap, QGuiApplication, QCursor
 from PySide6.QtWidgets import *
 
 from Experiment import RWArgs, Experiment, Phase
-from Plots import generate_figures, save_plots
 from Environment import StimulusHistory, Stimulus
 from Models import Model
+from Profiler import Profiler
 from CoolTable import CoolTable
 from GUIUtils import *
 from PySide6.QtWidgets import QLabel, QLineEdit, QMainWindow, QMessageBox, QWidget
 
 from version import __version__
 
+# Modules needed to draw figures, imported in the background after the window
+# is shown; see PavlovianApp.preloadPlotting.
+plotting_modules = [
+    'matplotlib.backends.backend_qtagg',
+    'matplotlib.pyplot',
+    'Plots',
+]
+
 class PavlovianApp(QMainWindow):
     models: list[str]
     current_model: str
@@ -45,6 +55,9 @@ class PavlovianApp(QMainWindow):
     plot_part_stimuli: bool
     show_legend: bool
 
+    history_float32: bool
+    history_stride: int
+
     out_of_range: dict[str, tuple[float, float, float]]
 
     max_workers: Optional[int]
@@ -52,6 +65,7 @@ class PavlovianApp(QMainWindow):
     dpi: int
 
     initial_file: None | str
+    plotting: None | threading.Thread
 
     def __init__(
         self,
@@ -67,6 +81,7 @@ class PavlovianApp(QMainWindow):
         self.called_refresh = False
 
         self.initial_file = initial_file
+        self.plotting = None
 
         self.models = list(Model.types().keys())
         self.current_model = None
@@ -95,6 +110,9 @@ class PavlovianApp(QMainWindow):
         self.plot_part_stimuli = False
         self.show_legend = True
 
+        self.history_float32 = False
+        self.history_stride = 1
+
         self.out_of_range = {}
 
         self.legend_page = 0
@@ -104,6 +122,7 @@ class PavlovianApp(QMainWindow):
         self.screenshot_ready = screenshot_ready
 
         self.initUI()
+        QTimer.singleShot(0, self.preloadPlotting)
         QTimer.singleShot(100, self.updateWidgets)
 
         if smoke_test:
@@ -351,6 +370,10 @@ class PavlovianApp(QMainWindow):
 
             configural_cues = self.configural_cues,
             part_stimuli = self.plot_part_stimuli,
+            compound_context = self.plot_part_stimuli,
+
+            history_precision = 'float32' if self.history_float32 else 'float64',
+            history_stride = self.history_stride,
 
             alphas = self.csPercDict('alpha'),
             alpha_macks = self.csPercDict('alpha_mack'),
@@ -399,28 +422,54 @@ class PavlovianApp(QMainWindow):
             if not any(phase_strs):
                 continue
 
-            try:
-                experiment = Experiment(name, phase_strs, max_workers = self.max_workers)
-            except ValueError as e:
-                error = str(e)
-                if len(error) > 250:
-                    error = error[:250] + '…'
-                QMessageBox.critical(self, 'Syntax Error', str(error))
+            with Profiler.stage(f'group {name}'):
+                try:
+                    with Profiler.stage('construct'):
+                        experiment = Experiment(name, phase_strs, max_workers = self.max_workers)
+                except ValueError as e:
+                    error = str(e)
+                    if len(error) > 250:
+                        error = error[:250] + '…'
+                    QMessageBox.critical(self, 'Syntax Error', str(error))
 
-                # Apologies for the Go-like code. This should be a sum type!
-                return [], {}
+                    # Apologies for the Go-like code. This should be a sum type!
+                    return [], {}
 
-            local_strengths = experiment.run_all_phases(args)
+                local_strengths = experiment.run_all_phases(args)
 
             strengths = [a | b for a, b in zip_longest(strengths, local_strengths, fillvalue = StimulusHistory.emptydict())]
             phases[name] = experiment.phases
 
         return strengths, phases
 
+    # Start the workers of randomised phases and import the plotting modules
+    # while the window is already shown. The pool is started first, so that
+    # its workers aren't forked in the middle of an import.
+    def preloadPlotting(self):
+        Experiment.start_pool(self.max_workers)
+
+        def load():
+            for module in plotting_modules:
+                importlib.import_module(module)
+
+        self.plotting = threading.Thread(target = load, daemon = True)
+        self.plotting.start()
+
+    # Wait for the plotting modules and replace the placeholder canvas.
+    def loadPlotting(self):
+        if self.plotting is not None:
+            self.plotting.join()
+
+        self.plotBox.loadCanvas()
+        self.plotCanvas = self.plotBox.plotCanvas
+
     def plotExperiment(self):
         if len(self.phases) == 0:
             return
 
+        self.loadPlotting()
+        from Plots import generate_figures
+
         # Get the locations of the legends of all axes of all figures.
         self.legend_locs = [[ax.get_legend()._loc for ax in fig.get_axes()] for fig in self.figures]
         self.legend_locs = (self.legend_locs + self.numPhases * [[]])[:self.numPhases]
@@ -483,16 +532,26 @@ class PavlovianApp(QMainWindow):
         self.refreshFigures()
 
     def refreshFigures(self):
-        from matplotlib import pyplot
         if len(self.phases) == 0:
             self.alphasBox.clear()
             self.numPhases = 1
             self.phaseNum = 1
-            self.figures = [pyplot.Figure()]
+
+            # An empty figure replaces the previous one, but there's nothing
+            # to draw on the placeholder.
+            self.figures = []
+            if self.plotBox.canvasLoaded:
+                from matplotlib import pyplot
+                self.figures = [pyplot.Figure()]
+
             self.refreshCurrentFigure()
             return
 
-        self.css = set.union(*[phase.cs() for group in self.phases.values() for phase in group])
+        self.loadPlotting()
+        from matplotlib import pyplot
+        from Plots import generate_figures
+
+        self.css = set.union(*[phase.cs(self.configural_cues) for group in self.phases.values() for phase in group])
         self.alphasBox.refresh(self.css)
 
         self.numPhases = max(len(v) for v in self.phases.values())
@@ -506,15 +565,16 @@ class PavlovianApp(QMainWindow):
             pyplot.close(fig)
 
         args = self.packArgs()
-        self.figures = generate_figures(
-            self.strengths,
-            plot_V = not args.plot_alpha and not args.plot_macknhall,
-            plot_alpha = args.plot_alpha and not Model.types()[self.current_model].should_plot_macknhall(),
-            plot_macknhall = args.plot_macknhall and Model.types()[self.current_model].should_plot_macknhall(),
-            dpi = self.dpi,
-            singular_legend = not self.show_legend,
-            legend_locs = self.legend_locs,
-        )
+        with Profiler.stage('generate_figures'):
+            self.figures = generate_figures(
+                self.strengths,
+                plot_V = not args.plot_alpha and not args.plot_macknhall,
+                plot_alpha = args.plot_alpha and not Model.types()[self.current_model].should_plot_macknhall(),
+                plot_macknhall = args.plot_macknhall and Model.types()[self.current_model].should_plot_macknhall(),
+                dpi = self.dpi,
+                singular_legend = not self.show_legend,
+                legend_locs = self.legend_locs,
+            )
 
         line_names = set.union(*[set(x.keys()) for x in self.strengths])
         self.line_hidden = {k: self.line_hidden.get(k, False) for k in line_names}
@@ -522,6 +582,11 @@ class PavlovianApp(QMainWindow):
         self.refreshCurrentFigure()
 
     def refreshCurrentFigure(self):
+        if not self.figures:
+            self.tableWidget.selectColumn(self.phaseNum - 1)
+            self.plotBox.phaseBox.setInfo(self.phaseNum, self.numPhases)
+            return
+
         current_figure = self.figures[self.phaseNum - 1]
         self.plotCanvas.figure = current_figure
         current_figure.set_canvas(self.plotCanvas)
@@ -547,7 +612,8 @@ class PavlovianApp(QMainWindow):
         self.plotCanvas.resize(self.plotCanvas.width() + 1, self.plotCanvas.height() + 1)
         self.plotCanvas.resize(self.plotCanvas.width() - 1, self.plotCanvas.height() - 1)
 
-        self.plotCanvas.draw()
+        with Profiler.stage('draw'):
+            self.plotCanvas.draw()
 
         self.tableWidget.selectColumn(self.phaseNum - 1)
         self.plotBox.phaseBox.setInfo(self.phaseNum, self.numPhases)
@@ -637,6 +703,9 @@ class PavlovianApp(QMainWindow):
         self.legend_locs = [[ax.get_legend()._loc for ax in fig.get_axes()] for fig in self.figures]
         self.legend_locs = (self.legend_locs + self.numPhases * [[]])[:self.numPhases]
 
+        self.loadPlotting()
+        from Plots import save_plots
+
         args = self.packArgs()
         save_plots(
             self.strengths,
@@ -5,10 +5,13 @@ import re
 import math
 import logging
 import colorsys
+from functools import cache
 from itertools import islice, cycle, chain
+from pathlib import Path
 
 from Environment import StimulusHistory
 from Experiment import Phase
+from Profiler import Profiler
 from itertools import chain
 from typing import Any, TypeAlias
 
@@ -43,9 +46,34 @@ def titleify(title: None | str, phases: dict[str, list[Phase]], phase_num: int)
     
     return ''
 
-def get_css(data: list[dict[str, StimulusHistory]]) -> tuple[list[str], dict[str, Color], dict[str, str]]:
-    import seaborn
-    css = sorted(set(chain.from_iterable([x.keys() for x in data])), key = lambda x: (len(x), x))
+# Colors of the real-world data, as given by seaborn.husl_palette(2).
+real_world_colors: tuple[Color, Color] = (
+    (0.9677975592919913, 0.44127456009157356, 0.5358103155058701),
+    (0.21044753832183283, 0.6773105080456748, 0.6433941168468681),
+)
+
+# Keys of every phase of the results if every stimulus were recorded, from
+# the phases of every group, or None if they're unknown; see Phase.keys.
+def phase_keys(data: list[dict[str, StimulusHistory]], phases: None | dict[str, list[Phase]]) -> None | list[set[str]]:
+    if phases is None:
+        return None
+
+    keys: list[set[str]] = [set() for _ in data]
+    for group_phases in phases.values():
+        for phase_num, phase in enumerate(group_phases[:len(data)]):
+            if phase.keys is not None:
+                keys[phase_num] |= phase.keys
+
+    return keys
+
+# Colours and markers of every key, given by its place among the keys of the
+# results and the given keys, so that they don't depend on which are recorded.
+def get_css(data: list[dict[str, StimulusHistory]], keys: None | list[set[str]] = None) -> tuple[list[str], dict[str, Color], dict[str, str]]:
+    css = set(chain.from_iterable([x.keys() for x in data]))
+    if keys is not None:
+        css |= set.union(set(), *keys)
+
+    css = sorted(css, key = lambda x: (len(x), x))
 
     color_list = list(islice(cycle(colorcet.glasbey), len(css)))
     colors = dict(zip(css, color_list))
@@ -53,16 +81,17 @@ def get_css(data: list[dict[str, StimulusHistory]]) -> tuple[list[str], dict[str
     markers = ['o', 's', 'D', '^', 'v', '<', '>', 'p', '*', 'h', 'X', 'd']
     marker_dict = dict(zip(css, [markers[i % len(markers)] for i in range(len(css))]))
 
-    colors['Real-world Group - X'], colors['Real-world Group - Y'] = seaborn.husl_palette(2)
+    colors['Real-world Group - X'], colors['Real-world Group - Y'] = real_world_colors
     return css, colors, marker_dict
 
 # Plot a complex marker with an invisible square around it for rediability.
-def plot_around_marker(data, char, label, color, ax, **kwargs):
+def plot_around_marker(x, data, char, label, color, ax, **kwargs):
     bg = ax.get_facecolor()
     marker = f'${char}$'
     size = 6
 
     ax.plot(
+        x,
         data,
         color = color,
         zorder = 1,
@@ -70,6 +99,7 @@ def plot_around_marker(data, char, label, color, ax, **kwargs):
         **kwargs,
     )
     ax.plot(
+        x,
         data,
         markersize = size + .5,
         color = bg,
@@ -79,6 +109,7 @@ def plot_around_marker(data, char, label, color, ax, **kwargs):
         label = '_' + label,
     )
     ax.plot(
+        x,
         data,
         markersize = size,
         linestyle = 'None',
@@ -114,6 +145,13 @@ def shade_hls(color, factor: float):
     l = max(0.0, min(1.0, l * factor))
     return colorsys.hls_to_rgb(h, l, s)
 
+# Style of every figure, from resources/palms.mplstyle. It's kept in the
+# rcParams of Matplotlib, so it only needs to be applied before the first figure.
+@cache
+def apply_style():
+    from matplotlib import pyplot
+    pyplot.style.use(Path(__file__).resolve().parent / 'resources' / 'palms.mplstyle')
+
 def generate_figures(
         data: list[dict[str, StimulusHistory]],
         *,
@@ -127,27 +165,37 @@ def generate_figures(
         dpi: None | float = None,
         singular_legend: bool = False,
         legend_locs: None | list[list[tuple[float, float]]] = None,
+        keys: None | list[set[str]] = None,
+        reuse_figures: None | list = None,
     ) -> list: # list[pyplot.Figure]
     from matplotlib import pyplot
     from matplotlib.ticker import MaxNLocator, FuncFormatter
-    import seaborn
-    seaborn.set()
+    apply_style()
+
+    if keys is None:
+        keys = phase_keys(data, phases)
 
     if plot_phase is not None:
         data = [data[plot_phase - 1]]
+        keys = None if keys is None else [keys[plot_phase - 1]]
 
-    experiment_css, colors, markers = get_css(data)
+    experiment_css, colors, markers = get_css(data, keys)
     max_x = max([max([len(hist) for hist in exp.values()], default = 0) for exp in data], default = 0)
 
     figures = []
     for phase_num, experiments in enumerate(data, start = 1):
-        multiple = False
-        if not plot_V or not plot_alpha and not plot_macknhall:
-            fig, axes_ = pyplot.subplots(1, 1, figsize = (8, 6), dpi = dpi)
-            axes = [axes_]
+        multiple = plot_V and (plot_alpha or plot_macknhall)
+        ncols = 2 if multiple else 1
+
+        # Figures given in reuse_figures are cleared and drawn again, one per
+        # phase, so that their windows stay open where they are.
+        if reuse_figures is not None and phase_num <= len(reuse_figures):
+            fig = reuse_figures[phase_num - 1]
+            fig.clear()
         else:
-            fig, axes = pyplot.subplots(1, 2, figsize = (16, 6), dpi = dpi)
-            multiple = True
+            fig = pyplot.figure(figsize = (8 * ncols, 6), dpi = dpi)
+
+        axes = list(fig.subplots(1, ncols, squeeze = False)[0])
 
         def sort_key(key):
             group, cs = key.split(' - ')
@@ -170,16 +218,21 @@ def generate_figures(
 
             return group, plus, caller, priority, prescript, superscript, cs
 
-        sorted_exp = sorted(experiments, key = sort_key)
+        # Keys that weren't recorded still count for the alpha of the others.
+        all_keys = experiments.keys() if keys is None else experiments.keys() | keys[phase_num - 1]
+        sorted_exp = sorted(all_keys, key = sort_key)
         for num, key in enumerate(sorted_exp):
+            if key not in experiments:
+                continue
+
             hist = experiments[key]
             stimulus = key.split(' ')[-1]
             if plot_stimuli is not None and stimulus not in plot_stimuli and key not in plot_stimuli:
                 continue
 
             ratio = 0.
-            if len(experiments) > 1:
-                ratio = num / (len(experiments.items()) - 1)
+            if len(sorted_exp) > 1:
+                ratio = num / (len(sorted_exp) - 1)
 
             plot_options = dict(
                 marker = markers[key],
@@ -192,19 +245,19 @@ def generate_figures(
             ax_V = axes[0]
             ax_alpha = axes[0] if not multiple else axes[1]
             if plot_V:
-                ax_V.plot(hist.assoc, label = key, **plot_options) # type: ignore
+                ax_V.plot(hist.trials(), hist.assoc, label = key, **plot_options) # type: ignore
 
             if not hist.compound[0] and plot_alpha and not plot_macknhall:
-                ax_alpha.plot(hist.alpha, label='α: '+str(key), **plot_options) # type: ignore
+                ax_alpha.plot(hist.trials(), hist.alpha, label='α: '+str(key), **plot_options) # type: ignore
 
             if not hist.compound[0] and plot_macknhall:
                 color_mack, color_hall = shade_hls(colors[key], 1.25), shade_hls(colors[key], 0.75)
                 if max_x <= 100:
-                    plot_around_marker(hist.alpha_mack, ax = ax_alpha, label = f'Mack: {key}', char = 'M', color = color_mack)
-                    plot_around_marker(hist.alpha_hall, ax = ax_alpha, label = f'Hall: {key}', char = 'H', color = color_hall)
+                    plot_around_marker(hist.trials(), hist.alpha_mack, ax = ax_alpha, label = f'Mack: {key}', char = 'M', color = color_mack)
+                    plot_around_marker(hist.trials(), hist.alpha_hall, ax = ax_alpha, label = f'Hall: {key}', char = 'H', color = color_hall)
                 else:
-                    ax_alpha.plot(hist.alpha_mack, marker = 'o', markersize = 1, markerfacecolor = 'None', label = f'Mack: {key}', color = color_mack)
-                    ax_alpha.plot(hist.alpha_hall, marker = '^', markersize = 1, label = f'Hall: {key}', color = color_hall)
+                    ax_alpha.plot(hist.trials(), hist.alpha_mack, marker = 'o', markersize = 1, markerfacecolor = 'None', label = f'Mack: {key}', color = color_mack)
+                    ax_alpha.plot(hist.trials(), hist.alpha_hall, marker = '^', markersize = 1, label = f'Hall: {key}', color = color_hall)
 
         longFormat = lambda x, _: f'{x:.0e}' if abs(x) >= 1000 else f'{x:.2f}'
 
@@ -360,10 +413,10 @@ class PaginatedLegend:
             text.set_picker(5)
             text.set_label(text.get_text())
 
-def generate_singular_legend(data, plot_stimuli, dpi):
+def generate_singular_legend(data, plot_stimuli, dpi, keys = None):
     from matplotlib import pyplot
 
-    css, colors, markers = get_css(data)
+    css, colors, markers = get_css(data, keys)
     fig = pyplot.figure(dpi = dpi)
     pyplot.axis('off')
     for exp in css:
@@ -398,39 +451,44 @@ def save_plots(
     if filename is not None:
         filename = filename.removesuffix('.png')
 
+    keys = phase_keys(data, phases)
+
     title = None
     if show_title:
         title = filename
     else:
         phases = None
 
-    figures = generate_figures(
-        data = data,
-        phases = phases,
-        plot_phase = plot_phase,
-        plot_stimuli = plot_stimuli,
-        plot_V = plot_V,
-        plot_alpha = plot_alpha,
-        plot_macknhall = plot_macknhall,
-        title = title,
-        dpi = dpi,
-        singular_legend = singular_legend,
-        legend_locs = legend_locs,
-    )
+    with Profiler.stage('generate_figures'):
+        figures = generate_figures(
+            data = data,
+            phases = phases,
+            plot_phase = plot_phase,
+            plot_stimuli = plot_stimuli,
+            plot_V = plot_V,
+            plot_alpha = plot_alpha,
+            plot_macknhall = plot_macknhall,
+            title = title,
+            dpi = dpi,
+            singular_legend = singular_legend,
+            legend_locs = legend_locs,
+            keys = keys,
+        )
 
-    if singular_legend:
-        legend_fig = generate_singular_legend(data, plot_stimuli, dpi)
-        legend_fig.set_size_inches(plot_width, .1)
-        legend_fig.savefig(f'{filename}_legend.png', bbox_inches = 'tight', pad_inches = 0)
-
-    for phase_num, fig in enumerate(figures, start = plot_phase or 1):
-        dep = 1.3
-        # if plot_phase is None and phase_num > 1:
-        #     fig.axes[0].set_title('')
-        #     fig.axes[0].set_ylabel('')
-        #     fig.axes[0].set_yticklabels([])
-
-        fig.set_size_inches(plot_width / dep, plot_height / dep)
-        # widths = {1: 5, 2: 2, 3: 5}
-        # fig.set_size_inches(widths[phase_num] / dep, 2 / dep)
-        fig.savefig(f'{filename}_{phase_num}.png', bbox_inches = 'tight')
+    with Profiler.stage('draw'):
+        if singular_legend:
+            legend_fig = generate_singular_legend(data, plot_stimuli, dpi, keys)
+            legend_fig.set_size_inches(plot_width, .1)
+            legend_fig.savefig(f'{filename}_legend.png', bbox_inches = 'tight', pad_inches = 0)
+
+        for phase_num, fig in enumerate(figures, start = plot_phase or 1):
+            dep = 1.3
+            # if plot_phase is None and phase_num > 1:
+            #     fig.axes[0].set_title('')
+            #     fig.axes[0].set_ylabel('')
+            #     fig.axes[0].set_yticklabels([])
+
+            fig.set_size_inches(plot_width / dep, plot_height / dep)
+            # widths = {1: 5, 2: 2, 3: 5}
+            # fig.set_size_inches(widths[phase_num] / dep, 2 / dep)
+            fig.savefig(f'{filename}_{phase_num}.png', bbox_inches = 'tight')
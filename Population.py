@@ -0,0 +1,165 @@
+from __future__ import annotations
+
+import argparse
+import sys
+from csv import DictWriter
+
+import numpy
+
+import Simulator
+from BatchEngine import BatchEngine
+from Environment import StimulusHistory
+from Experiment import Experiment, RWArgs
+from HistoryStore import ArrayHistory
+from Sweep import point_args
+
+# Distributions of the parameters of virtual subjects around a value, given a scale:
+#   normal: standard deviation.
+#   uniform: half of the width of the interval.
+#   lognormal: standard deviation of the logarithm, keeping the median.
+distributions = {
+    'normal': lambda rng, value, scale, n: rng.normal(value, scale, n),
+    'uniform': lambda rng, value, scale, n: rng.uniform(value - scale, value + scale, n),
+    'lognormal': lambda rng, value, scale, n: value * rng.lognormal(0, scale, n),
+}
+
+# Parameters of `subjects` virtual subjects, drawing every jittered parameter
+# from its distribution around its value in `args`. Parameters are never negative.
+def subject_args(args: RWArgs, subjects: int, jitter: dict[str, tuple[str, float]], rng: numpy.random.Generator) -> list[RWArgs]:
+    values = {}
+    for name, (distribution, scale) in jitter.items():
+        param, cs = Simulator.experiment_arg_name(name)
+        value = Simulator.get_experiment_arg(args, name)
+        if value is None and cs is not None:
+            value = args.get(param.removesuffix('s'))
+
+        if value is None:
+            raise ValueError(f'Parameter {name} has no value.')
+
+        values[name] = numpy.maximum(distributions[distribution](rng, float(value), scale, subjects), 0)
+
+    return [point_args(args, {name: repr(float(x[num])) for name, x in values.items()}) for num in range(subjects)]
+
+# Simulate a population of virtual subjects for a single group, as one batch.
+# Every subject has its own random orders in randomised phases, so subjects
+# and random trials are run together. Returns the histories of every phase,
+# as BatchEngine.run, with one row per subject.
+def population(experiment: Experiment, args: RWArgs, subjects: int, jitter: dict[str, tuple[str, float]], seed: None | int = None) -> list[dict[str, numpy.ndarray]]:
+    rng = numpy.random.default_rng(seed)
+    engine = BatchEngine(experiment, subject_args(args, subjects, jitter, rng), seed = rng.integers(2 ** 32), shared_orders = False)
+    return engine.run()
+
+def parse_jitter(jitter: str) -> tuple[str, tuple[str, float]]:
+    if '=' not in jitter or jitter.count(':') != 1:
+        raise argparse.ArgumentTypeError(f'Jitter must be given as name=distribution:scale, not "{jitter}".')
+
+    name, spec = jitter.split('=', maxsplit = 1)
+    distribution, scale = spec.split(':')
+    if distribution not in distributions:
+        raise argparse.ArgumentTypeError(f'Unknown distribution {distribution}; use one of {", ".join(distributions)}.')
+
+    return name.strip(), (distribution, float(scale))
+
+def parse_args() -> tuple[argparse.Namespace, argparse.Namespace]:
+    parser = argparse.ArgumentParser(
+        description = 'Simulate every group for a population of virtual subjects with individual differences.',
+        formatter_class = argparse.RawTextHelpFormatter,
+        epilog = '''\
+Any other option of the command-line interface sets the parameters around
+which subjects are drawn. The mean, standard deviation and 5-95%% range of
+the associative strength of every CS are printed, or saved with
+--save-results; --savefig plots the mean trajectories.
+
+Example:
+  %(prog)s Experiments/LIrr-LePelley.rw --subjects 50 --jitter beta=normal:0.05 --jitter alpha_A=lognormal:0.2
+''',
+    )
+    parser.add_argument('--subjects', type = int, default = 20, help = 'Number of virtual subjects in every group.')
+    parser.add_argument('--jitter', metavar = 'name=distribution:scale', type = parse_jitter, action = 'append', default = [], help = f'Distribution of a parameter across subjects, named as in the "@" lines of experiment files.\nDistributions: {", ".join(distributions)}.')
+    parser.add_argument('--seed', type = int, help = 'Seed for the parameters of the subjects and their random orders.')
+
+    args, rest = parser.parse_known_args()
+    sys.argv[1:] = rest
+    return args, Simulator.parse_args()
+
+def main():
+    pop_args, args = parse_args()
+
+    if args.summary is not None or args.store is not None:
+        raise ValueError('Populations cannot be used with --summary or --store.')
+
+    base = RWArgs(
+        **{k: v for k, v in args.__dict__.items() if k in set(RWArgs.__match_args__) and v is not None}
+    )
+    if args.save_results is None and not args.print_results:
+        base.record_stimuli = args.plot_stimuli
+
+    seeds = numpy.random.SeedSequence(pop_args.seed)
+
+    rows = []
+    means: None | list[dict[str, StimulusHistory]] = None
+    phases = {}
+    for name, phase_strs in Simulator.parse_experiment_file(args.experiment_file, base):
+        if args.plot_experiments is not None and name not in args.plot_experiments:
+            continue
+
+        experiment = Experiment(name, phase_strs)
+        results = population(experiment, base, pop_args.subjects, dict(pop_args.jitter), seeds.spawn(1)[0].generate_state(1)[0])
+        phases[experiment.name] = experiment.phases
+
+        stride = base.history_stride
+        local: list[dict[str, StimulusHistory]] = []
+        for phase_num, phase in enumerate(results, start = 1):
+            local.append({})
+            for key, hist in phase.items():
+                cs = key.replace('(', 'q(')
+                mean = hist.mean(axis = 0)
+                local[-1][f'{experiment.name} - {cs}'] = ArrayHistory(mean, 0, len(mean), stride)
+
+                std = hist[:, :, 0].std(axis = 0)
+                q5, q95 = numpy.percentile(hist[:, :, 0], [5, 95], axis = 0)
+                for trial in range(hist.shape[1]):
+                    rows.append({
+                        'Phase': phase_num,
+                        'Group': experiment.name,
+                        'CS': cs,
+                        'Trial': trial * stride + 1,
+                        'Mean': mean[trial, 0],
+                        'SD': std[trial],
+                        'Q5': q5[trial],
+                        'Q95': q95[trial],
+                    })
+
+        means = local if means is None else [a | b for a, b in zip(means, local)]
+
+    def write(file):
+        writer = DictWriter(file, fieldnames = ['Phase', 'Group', 'CS', 'Trial', 'Mean', 'SD', 'Q5', 'Q95'])
+        writer.writeheader()
+        writer.writerows(rows)
+
+    if args.save_results is not None:
+        with open(args.save_results, 'w') as file:
+            write(file)
+
+    if args.print_results or args.save_results is None and args.savefig is None:
+        write(sys.stdout)
+
+    if args.savefig is not None:
+        from Plots import save_plots
+
+        save_plots(
+            means or [],
+            phases = phases,
+            filename = args.savefig,
+            plot_phase = args.plot_phase,
+            plot_alpha = args.plot_alpha,
+            plot_macknhall = args.plot_macknhall,
+            show_title = args.show_title,
+            plot_stimuli = args.plot_stimuli,
+            singular_legend = args.singular_legend,
+            dpi = args.dpi,
+            plot_width = args.output_width,
+        )
+
+if __name__ == '__main__':
+    main()
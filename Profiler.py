@@ -0,0 +1,101 @@
+from __future__ import annotations
+
+import time
+from contextlib import contextmanager
+from typing import Any, ClassVar, Iterator
+
+# Wall time spent in every stage of a run, such as parsing, simulating every
+# phase of every group, or drawing the figures. Stages nest, and the time of a
+# stage includes that of the stages inside it.
+# Stages are only timed while a Profiler is active, so the rest of the code
+# marks its stages unconditionally with `Profiler.stage`.
+class Profiler:
+    active: ClassVar[None | Profiler] = None
+
+    # Total time and number of calls of every stage, by its path of nested
+    # stages, in the order they were first entered.
+    times: dict[tuple[str, ...], float]
+    calls: dict[tuple[str, ...], int]
+    stack: list[str]
+
+    start: float
+    total: float
+    previous: None | Profiler
+
+    # cProfile of the simulation stages only, if requested.
+    simulation: Any
+    profiling: bool
+
+    def __init__(self, profile_simulation: bool = False):
+        self.times = {}
+        self.calls = {}
+        self.stack = []
+        self.total = 0.
+        self.previous = None
+        self.profiling = False
+
+        self.simulation = None
+        if profile_simulation:
+            import cProfile
+            self.simulation = cProfile.Profile()
+
+    def __enter__(self) -> Profiler:
+        self.previous = Profiler.active
+        Profiler.active = self
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.total += time.perf_counter() - self.start
+        Profiler.active = self.previous
+
+    # Time the code inside of this stage in the active Profiler, if any.
+    # Simulation stages are also recorded by cProfile, if requested.
+    @classmethod
+    @contextmanager
+    def stage(cls, name: str, simulation: bool = False) -> Iterator[None]:
+        profiler = cls.active
+        if profiler is None:
+            yield
+            return
+
+        profiler.stack.append(name)
+        path = tuple(profiler.stack)
+        profiler.times.setdefault(path, 0.)
+
+        profile = simulation and profiler.simulation is not None and not profiler.profiling
+        if profile:
+            profiler.profiling = True
+            profiler.simulation.enable()
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            profiler.times[path] += time.perf_counter() - start
+            profiler.calls[path] = profiler.calls.get(path, 0) + 1
+
+            if profile:
+                profiler.simulation.disable()
+                profiler.profiling = False
+
+            profiler.stack.pop()
+
+    def table(self) -> str:
+        total = self.total or sum(t for path, t in self.times.items() if len(path) == 1)
+        width = max((2 * (len(path) - 1) + len(path[-1]) for path in self.times), default = 5)
+
+        lines = [f'{"Stage":{width}} {"Calls":>7} {"Seconds":>10} {"%":>6}']
+        for path, seconds in self.times.items():
+            name = '  ' * (len(path) - 1) + path[-1]
+            lines.append(f'{name:{width}} {self.calls[path]:7} {seconds:10.4f} {100 * seconds / total if total else 0:6.1f}')
+
+        lines.append(f'{"Total":{width}} {"":7} {total:10.4f} {100:6.1f}')
+        return '\n'.join(lines)
+
+    # Write the cProfile statistics of the simulation, readable with pstats.
+    def dump(self, filename: str):
+        if self.simulation is None:
+            raise ValueError('The simulation was not profiled.')
+
+        self.simulation.dump_stats(filename)
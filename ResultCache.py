@@ -0,0 +1,80 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import pickle
+import tempfile
+from dataclasses import asdict
+from pathlib import Path
+from typing import ClassVar
+
+from Environment import StimulusHistory
+from Experiment import RWArgs
+from version import __version__
+
+# On-disk cache of the results of single groups, keyed by the definition of
+# the group, every parameter that affects its results, and the source of the
+# simulation, so that editing the models invalidates it.
+# Results of randomised phases are cached as well; a cached group returns the
+# same random sample every time.
+class ResultCache:
+    # RWArgs fields that only affect plotting, or how the simulation runs.
+    ignored: ClassVar[set[str]] = {
+        'plot_phase', 'plot_experiments', 'plot_stimuli', 'plot_alpha',
+        'plot_macknhall', 'should_plot_macknhall', 'title_suffix', 'savefig',
+        'executor',
+    }
+
+    # Modules whose source determines the results.
+    sources: ClassVar[list[str]] = ['Environment.py', 'Experiment.py', 'Group.py', 'Models.py']
+
+    path: Path
+    hits: int
+    misses: int
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        self.path.mkdir(parents = True, exist_ok = True)
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def code_version(cls) -> str:
+        digest = hashlib.sha256(__version__.encode())
+        for source in cls.sources:
+            digest.update((Path(__file__).parent / source).read_bytes())
+
+        return digest.hexdigest()
+
+    @classmethod
+    def key(cls, name: str, phase_strs: list[str], args: RWArgs) -> str:
+        params = {k: v for k, v in asdict(args).items() if k not in cls.ignored}
+        definition = json.dumps([cls.code_version(), name, phase_strs, params], sort_keys = True, default = sorted)
+        return hashlib.sha256(definition.encode()).hexdigest()
+
+    def get(self, key: str) -> None | list[dict[str, StimulusHistory]]:
+        try:
+            with open(self.path / f'{key}.pickle', 'rb') as file:
+                strengths = pickle.load(file)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return strengths
+
+    def put(self, key: str, strengths: list[dict[str, StimulusHistory]]):
+        # Write to a temporary file first, so that concurrent readers never see
+        # a partial result. Every writer has its own, even threads of a
+        # process; when several write the same key, the last one replaces the
+        # others' identical results.
+        with tempfile.NamedTemporaryFile(dir = self.path, prefix = f'{key}.', suffix = '.tmp', delete = False) as file:
+            temp = Path(file.name)
+            try:
+                pickle.dump(strengths, file, protocol = pickle.HIGHEST_PROTOCOL)
+            except BaseException:
+                file.close()
+                temp.unlink(missing_ok = True)
+                raise
+
+        temp.replace(self.path / f'{key}.pickle')
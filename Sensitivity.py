@@ -0,0 +1,135 @@
+from __future__ import annotations
+
+import argparse
+import sys
+from csv import DictWriter
+
+import numpy
+
+import Simulator
+from BatchEngine import BatchEngine
+from Environment import StimulusHistory
+from Experiment import Experiment, RWArgs
+from Models import Model
+from Sweep import point_args
+
+# Sensitivity of the associative strengths of an experiment to its parameters,
+# by central finite differences: d(V_cs(t))/d(param) ≈ (V(p + h) - V(p - h)) / 2h.
+# The parameters default to those of the model that have a value. The
+# unperturbed parameters and the two perturbations of every parameter are run
+# as a single batch, sharing the random orders of randomised phases.
+# Returns the trajectories, as Experiment.run_all_phases, and for every
+# parameter the sensitivity of every key in every phase, with one value per trial.
+def sensitivity(
+        experiment: Experiment,
+        args: RWArgs,
+        params: None | list[str] = None,
+        rel_step: float = 1e-4,
+        seed: None | int = None,
+    ) -> tuple[list[dict[str, StimulusHistory]], dict[str, list[dict[str, numpy.ndarray]]]]:
+    if params is None:
+        params = [p for p in Model.base(args.model).parameters() if Simulator.get_experiment_arg(args, p) is not None]
+
+    # Parameters of a single CS that are not set take the default value.
+    values = {}
+    for p in params:
+        name, cs = Simulator.experiment_arg_name(p)
+        value = Simulator.get_experiment_arg(args, p)
+        if value is None and cs is not None:
+            value = args.get(name.removesuffix('s'))
+
+        if value is None:
+            raise ValueError(f'Parameter {p} has no value.')
+
+        values[p] = float(value)
+
+    steps = {p: rel_step * (abs(x) or 1.) for p, x in values.items()}
+
+    points = [{}]
+    points += [{p: repr(values[p] + steps[p])} for p in params]
+    points += [{p: repr(values[p] - steps[p])} for p in params]
+
+    engine = BatchEngine(experiment, [point_args(args, point) for point in points], seed = seed)
+    results = engine.run()
+
+    sensitivities = {
+        p: [
+            {
+                f'{experiment.name} - {key.replace("(", "q(")}': (hist[1 + e, :, 0] - hist[1 + len(params) + e, :, 0]) / (2 * steps[p])
+                for key, hist in phase.items()
+            }
+            for phase in results
+        ]
+        for e, p in enumerate(params)
+    }
+
+    return engine.strengths(results, 0), sensitivities
+
+def parse_args() -> tuple[argparse.Namespace, argparse.Namespace]:
+    parser = argparse.ArgumentParser(
+        description = 'Print the sensitivity of the associative strength of every CS to every parameter of the model.',
+        formatter_class = argparse.RawTextHelpFormatter,
+        epilog = '''\
+Any other option of the command-line interface sets the parameters of the
+experiment. The table has the trajectories of every CS and, for every
+parameter, a "dAssoc/dparam" column. Results are printed, or saved with
+--save-results.
+''',
+    )
+    parser.add_argument('--params', metavar = 'name', nargs = '*', help = 'Parameters, named as in the "@" lines of experiment files. Defaults to every parameter of the model.')
+    parser.add_argument('--rel-step', type = float, default = 1e-4, help = 'Step of the finite differences, relative to the value of each parameter.')
+    parser.add_argument('--seed', type = int, default = 0, help = 'Seed for the random orders of randomised phases.')
+
+    args, rest = parser.parse_known_args()
+    sys.argv[1:] = rest
+    return args, Simulator.parse_args()
+
+def main():
+    sens_args, args = parse_args()
+
+    if args.summary is not None or args.store is not None or args.savefig is not None:
+        raise ValueError('Sensitivities only write a table of results; --summary, --savefig and --store cannot be used.')
+
+    base = RWArgs(
+        **{k: v for k, v in args.__dict__.items() if k in set(RWArgs.__match_args__) and v is not None}
+    )
+    base.record_stimuli = args.plot_stimuli
+
+    rows = []
+    params: list[str] = []
+    for name, phase_strs in Simulator.parse_experiment_file(args.experiment_file, base):
+        if args.plot_experiments is not None and name not in args.plot_experiments:
+            continue
+
+        strengths, sensitivities = sensitivity(Experiment(name, phase_strs), base, sens_args.params, sens_args.rel_step, sens_args.seed)
+        params += [p for p in sensitivities if p not in params]
+
+        for phase_num, phase in enumerate(strengths, start = 1):
+            for group_cs, hist in phase.items():
+                group, cs = group_cs.rsplit(' - ', maxsplit = 1)
+                for e, (trial, stimulus) in enumerate(zip(hist.trials(), hist)):
+                    rows.append({
+                        'Phase': phase_num,
+                        'Group': group,
+                        'CS': cs,
+                        'Trial': trial + 1,
+                        'Assoc': stimulus.assoc,
+                        **{f'dAssoc/d{p}': sensitivities[p][phase_num - 1][group_cs][e] for p in sensitivities},
+                    })
+
+    fieldnames = ['Phase', 'Group', 'CS', 'Trial', 'Assoc'] + [f'dAssoc/d{p}' for p in params]
+
+    def write(file):
+        writer = DictWriter(file, fieldnames = fieldnames, extrasaction = 'ignore')
+        writer.writeheader()
+        writer.writerows(rows)
+
+    if args.save_results is not None:
+        with open(args.save_results, 'w') as file:
+            write(file)
+
+    if args.print_results or args.save_results is None:
+        write(sys.stdout)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,427 @@
+from __future__ import annotations
+
+import argparse
+import copy
+import io
+import json
+import math
+import multiprocessing
+import os
+import signal
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any
+from urllib.parse import parse_qs, urlparse
+
+import BatchDirectory
+import Simulator
+from Environment import StimulusHistory
+from Experiment import Phase, RWArgs
+from HistoryStore import HistoryStore
+
+# Formats of the results of /simulate.
+formats = {
+    'json': 'application/json',
+    'csv': 'text/csv',
+    'store': 'application/zip',
+}
+
+fields = ['assoc', 'Ve', 'Vi', 'alpha', 'alpha_mack', 'alpha_hall', 'compound']
+
+# Counts of the requests served, in the text format of Prometheus.
+class Metrics:
+    # Upper bounds of the buckets of the histogram of request latencies, in seconds.
+    buckets = [.005, .01, .05, .1, .5, 1, 5, 10, 60]
+
+    lock: threading.Lock
+    requests: dict[int, int]
+    latency_buckets: list[int]
+    latency_sum: float
+    latency_count: int
+    in_flight: int
+
+    trials: int
+    simulation_seconds: float
+    cache_hits: int
+    cache_misses: int
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.latency_buckets = [0] * len(self.buckets)
+        self.latency_sum = 0.
+        self.latency_count = 0
+        self.in_flight = 0
+
+        self.trials = 0
+        self.simulation_seconds = 0.
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def observe_request(self, status: int, seconds: float):
+        with self.lock:
+            self.requests[int(status)] = self.requests.get(int(status), 0) + 1
+            self.latency_sum += seconds
+            self.latency_count += 1
+            for e, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    self.latency_buckets[e] += 1
+
+    # Record a group run by a worker; cached groups count as hits, without trials.
+    def observe_group(self, trials: int, seconds: float, cached: bool):
+        with self.lock:
+            if cached:
+                self.cache_hits += 1
+            else:
+                self.cache_misses += 1
+                self.trials += trials
+                self.simulation_seconds += seconds
+
+    def text(self) -> str:
+        with self.lock:
+            lookups = self.cache_hits + self.cache_misses
+            lines = [
+                '# TYPE palms_requests_total counter',
+                *(f'palms_requests_total{{status="{status}"}} {count}' for status, count in sorted(self.requests.items())),
+                '# TYPE palms_requests_in_flight gauge',
+                f'palms_requests_in_flight {self.in_flight}',
+                '# TYPE palms_request_seconds histogram',
+                *(f'palms_request_seconds_bucket{{le="{bound}"}} {count}' for bound, count in zip(self.buckets, self.latency_buckets)),
+                f'palms_request_seconds_bucket{{le="+Inf"}} {self.latency_count}',
+                f'palms_request_seconds_sum {self.latency_sum}',
+                f'palms_request_seconds_count {self.latency_count}',
+                '# TYPE palms_trials_total counter',
+                f'palms_trials_total {self.trials}',
+                '# TYPE palms_simulation_seconds_total counter',
+                f'palms_simulation_seconds_total {self.simulation_seconds}',
+                '# TYPE palms_trials_per_second gauge',
+                f'palms_trials_per_second {self.trials / self.simulation_seconds if self.simulation_seconds else 0}',
+                '# TYPE palms_cache_hits_total counter',
+                f'palms_cache_hits_total {self.cache_hits}',
+                '# TYPE palms_cache_misses_total counter',
+                f'palms_cache_misses_total {self.cache_misses}',
+                '# TYPE palms_cache_hit_ratio gauge',
+                f'palms_cache_hit_ratio {self.cache_hits / lookups if lookups else 0}',
+            ]
+
+        return '\n'.join(lines) + '\n'
+
+# Server keeping a pool of workers and a result cache across requests.
+# Every group of a request runs in a worker of the pool, as in --batch.
+class SimulationServer(ThreadingHTTPServer):
+    base: RWArgs
+    max_workers: int
+    executor: ProcessPoolExecutor
+    cache_path: str
+    slots: threading.BoundedSemaphore
+    max_body: int
+    metrics: Metrics
+    quiet: bool
+
+    def __init__(self, address: tuple[str, int], base: RWArgs, max_workers: int, max_requests: int, cache_path: str, max_body: int = 1 << 20, quiet: bool = False):
+        super().__init__(address, RequestHandler)
+        self.base = base
+        self.max_workers = max_workers
+        self.cache_path = cache_path
+        self.slots = threading.BoundedSemaphore(max_requests)
+        self.max_body = max_body
+        self.metrics = Metrics()
+        self.quiet = quiet
+        self.start_pool()
+
+    # The workers are started right away, before any thread serves a request,
+    # so that they aren't forked in the middle of one.
+    # Forked workers get a copy of the listening socket, which would keep the
+    # port taken after the server stops, so they close theirs first.
+    def start_pool(self):
+        initializer = self.socket.close if multiprocessing.get_start_method() == 'fork' else None
+        self.executor = ProcessPoolExecutor(max_workers = self.max_workers, initializer = initializer)
+        for _ in range(self.max_workers):
+            self.executor.submit(os.getpid)
+
+    # Run every group in the pool, returning the results of each one and the
+    # phases of all of them.
+    def simulate(self, groups: list[tuple[str, list[str], RWArgs]]) -> tuple[list[list[dict[str, StimulusHistory]]], dict[str, list[Phase]]]:
+        try:
+            futures = [self.executor.submit(BatchDirectory.run_group, name, phase_strs, args, self.cache_path) for name, phase_strs, args in groups]
+            results = [f.result() for f in futures]
+        except BrokenProcessPool:
+            # A worker died; later requests get a new pool.
+            self.executor.shutdown(wait = False)
+            self.start_pool()
+            raise
+
+        phases = {}
+        for (name, _, args), (_, group_phases, seconds, cached) in zip(groups, results):
+            phases[name] = group_phases
+
+            trials = sum(len(p.elems) * (args.num_trials if p.rand else 1) for p in group_phases)
+            self.metrics.observe_group(trials, seconds, cached)
+
+        return [local for local, _, _, _ in results], phases
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown()
+
+# Groups of a request, and the requested format.
+# The body is either the text of an experiment file, or a JSON object with
+#   "design": the text of an experiment file, or
+#   "groups": the phases of every group by name, as a list or a "|"-separated string;
+#   "params": parameters applied before the design, named as in its "@" lines;
+#   "format": one of `formats`.
+def parse_request(body: bytes, content_type: str, query: dict[str, list[str]], base: RWArgs) -> tuple[list[tuple[str, list[str], RWArgs]], str]:
+    args = copy.deepcopy(base)
+
+    if content_type.split(';')[0].strip() == 'application/json':
+        spec = json.loads(body)
+        for name, value in spec.get('params', {}).items():
+            Simulator.set_experiment_arg(args, name, value)
+
+        if 'design' in spec:
+            lines = spec['design']
+        else:
+            lines = '\n'.join(
+                f'{name}|{phases if isinstance(phases, str) else "|".join(phases)}'
+                for name, phases in spec['groups'].items()
+            )
+
+        fmt = spec.get('format', 'json')
+    else:
+        lines = body.decode()
+        fmt = 'json'
+
+    fmt = query.get('format', [fmt])[0]
+    if fmt not in formats:
+        raise ValueError(f'Unknown format {fmt}; use one of {", ".join(formats)}.')
+
+    groups = [
+        (name, phase_strs, copy.deepcopy(args))
+        for name, phase_strs in Simulator.parse_experiment_file(io.StringIO(lines), args)
+    ]
+    if not groups:
+        raise ValueError('The design has no groups.')
+
+    return groups, fmt
+
+# Results as JSON: the phases of every group, and the values of every field of
+# every CS in every phase, with missing values as null.
+def results_json(strengths: list[dict[str, StimulusHistory]], phases: dict[str, list[Phase]]) -> dict[str, Any]:
+    def values(hist: StimulusHistory, field: str) -> list[Any]:
+        return [None if x is None or isinstance(x, float) and math.isnan(x) else x for x in getattr(hist, field)]
+
+    return dict(
+        groups = {name: [p.phase_str for p in group_phases] for name, group_phases in phases.items()},
+        phases = [
+            {
+                key: dict(trials = [t + 1 for t in hist.trials()], **{f: values(hist, f) for f in fields})
+                for key, hist in phase.items()
+            }
+            for phase in strengths
+        ],
+    )
+
+# Results as a zip file of a HistoryStore, readable with HistoryStore.open once extracted.
+# A store has a single precision and stride, which every group must share;
+# see check_store.
+def results_store(groups: list[tuple[str, list[str], RWArgs]], group_strengths: list[list[dict[str, StimulusHistory]]]) -> bytes:
+    args = groups[0][2]
+    with tempfile.TemporaryDirectory() as directory:
+        store = HistoryStore.create(directory, args.history_precision, args.history_stride)
+        for (name, phase_strs, _), local in zip(groups, group_strengths):
+            store.write_group(name, phase_strs, local)
+
+        store.close()
+
+        output = io.BytesIO()
+        with zipfile.ZipFile(output, 'w') as archive:
+            for filename in ('index.json', 'data.bin'):
+                archive.write(os.path.join(directory, filename), filename)
+
+    return output.getvalue()
+
+def check_store(groups: list[tuple[str, list[str], RWArgs]]):
+    if len({(args.history_precision, args.history_stride) for _, _, args in groups}) > 1:
+        raise ValueError('Every group of a store must use the same history_precision and history_stride.')
+
+class RequestHandler(BaseHTTPRequestHandler):
+    server: SimulationServer
+
+    def send(self, status: int, body: bytes, content_type: str, headers: None | dict[str, str] = None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_error_json(self, status: int, message: str, headers: None | dict[str, str] = None):
+        self.send(status, json.dumps(dict(error = message)).encode(), 'application/json', headers)
+
+    def do_GET(self):
+        if urlparse(self.path).path == '/metrics':
+            self.send(HTTPStatus.OK, self.server.metrics.text().encode(), 'text/plain; version=0.0.4')
+        else:
+            self.send_error_json(HTTPStatus.NOT_FOUND, f'Unknown path {self.path}; use POST /simulate or GET /metrics.')
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/simulate':
+            self.send_error_json(HTTPStatus.NOT_FOUND, f'Unknown path {self.path}; use POST /simulate or GET /metrics.')
+            return
+
+        start = time.perf_counter()
+        metrics = self.server.metrics
+
+        if not self.server.slots.acquire(blocking = False):
+            self.send_error_json(HTTPStatus.SERVICE_UNAVAILABLE, 'Too many simulations running; try again later.', {'Retry-After': '1'})
+            metrics.observe_request(HTTPStatus.SERVICE_UNAVAILABLE, time.perf_counter() - start)
+            return
+
+        with metrics.lock:
+            metrics.in_flight += 1
+
+        try:
+            status = self.simulate(url)
+        finally:
+            with metrics.lock:
+                metrics.in_flight -= 1
+
+            self.server.slots.release()
+
+        metrics.observe_request(status, time.perf_counter() - start)
+
+    # Serve a single simulation, returning the status of the response.
+    def simulate(self, url) -> int:
+        # The body isn't read after an error, so the connection can't be reused.
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            if length < 0:
+                raise ValueError
+        except ValueError:
+            self.close_connection = True
+            self.send_error_json(HTTPStatus.BAD_REQUEST, f'Invalid Content-Length: {self.headers["Content-Length"]}.')
+            return HTTPStatus.BAD_REQUEST
+
+        if length > self.server.max_body:
+            self.close_connection = True
+            self.send_error_json(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, f'Requests can have at most {self.server.max_body} bytes.')
+            return HTTPStatus.REQUEST_ENTITY_TOO_LARGE
+
+        body = self.rfile.read(length)
+
+        try:
+            groups, fmt = parse_request(body, self.headers.get('Content-Type', 'text/plain'), parse_qs(url.query), self.server.base)
+            if fmt == 'store':
+                check_store(groups)
+
+            group_strengths, phases = self.server.simulate(groups)
+        except (ValueError, json.JSONDecodeError) as e:
+            self.send_error_json(HTTPStatus.BAD_REQUEST, str(e))
+            return HTTPStatus.BAD_REQUEST
+        except KeyError as e:
+            self.send_error_json(HTTPStatus.BAD_REQUEST, f'Unknown parameter, model or field: {e.args[0]}.')
+            return HTTPStatus.BAD_REQUEST
+        except Exception as e:
+            self.send_error_json(HTTPStatus.INTERNAL_SERVER_ERROR, f'{type(e).__name__}: {e}')
+            return HTTPStatus.INTERNAL_SERVER_ERROR
+
+        strengths: list[dict[str, StimulusHistory]] = []
+        for local in group_strengths:
+            strengths = local if not strengths else [a | b for a, b in zip(strengths, local)]
+
+        if fmt == 'json':
+            output = json.dumps(results_json(strengths, phases)).encode()
+        elif fmt == 'csv':
+            text = io.StringIO()
+            StimulusHistory.exportData(strengths, file = text, should_plot_macknhall = groups[0][2].plot_macknhall)
+            output = text.getvalue().encode()
+        else:
+            output = results_store(groups, group_strengths)
+
+        self.send(HTTPStatus.OK, output, formats[fmt])
+        return HTTPStatus.OK
+
+    def log_message(self, format: str, *args: Any):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+def parse_args() -> tuple[argparse.Namespace, argparse.Namespace]:
+    parser = argparse.ArgumentParser(
+        description = 'Serve simulations over HTTP on this machine.',
+        formatter_class = argparse.RawTextHelpFormatter,
+        epilog = f'''\
+POST /simulate runs a design and returns its results. The body is either the
+text of an experiment file, or a JSON object (Content-Type: application/json)
+with "design" as the text of an experiment file or "groups" as the phases of
+every group by name, "params" as parameters named as in the "@" lines of
+experiment files, and "format". Formats: {", ".join(formats)}, also given as
+?format=...; "store" is a zip of a history store.
+
+GET /metrics returns the number and latency of requests, the trials per
+second simulated and the hit rate of the cache, in the Prometheus format.
+
+Any other option of the command-line interface sets the default parameters.
+
+Example:
+  %(prog)s --port 8000 --cache cache
+  curl --data-binary @Experiments/LIrr-LePelley.rw localhost:8000/simulate?format=csv
+  curl -H 'Content-Type: application/json' -d '{{"groups": {{"G": ["10A+", "10A-"]}}, "params": {{"beta": 0.5}}}}' localhost:8000/simulate
+''',
+    )
+    parser.add_argument('--host', default = '127.0.0.1', help = 'Address to listen on. Default: 127.0.0.1.')
+    parser.add_argument('--port', type = int, default = 8000, help = 'Port to listen on. Default: 8000.')
+    parser.add_argument('--max-requests', type = int, default = 4, help = 'Number of simulations run at once; further requests get a 503 response.')
+    parser.add_argument('--max-body', metavar = 'bytes', type = int, default = 1 << 20, help = 'Largest request accepted, in bytes; larger ones get a 413 response. Default: 1 MiB.')
+    parser.add_argument('--quiet', action = 'store_true', help = 'Do not log every request.')
+
+    args, rest = parser.parse_known_args()
+    sys.argv[1:] = rest
+    return args, Simulator.parse_args()
+
+def main():
+    server_args, args = parse_args()
+
+    if args.summary is not None or args.store is not None or args.savefig is not None:
+        raise ValueError('The server returns the results of every request; --summary, --savefig and --store cannot be used.')
+
+    base = RWArgs(
+        **{k: v for k, v in args.__dict__.items() if k in set(RWArgs.__match_args__) and v is not None}
+    )
+
+    cpu_count = getattr(os, 'process_cpu_count', os.cpu_count)() or 1
+
+    # Without --cache, results are cached for as long as the server runs.
+    with tempfile.TemporaryDirectory() as directory:
+        server = SimulationServer(
+            (server_args.host, server_args.port),
+            base = base,
+            max_workers = args.max_workers or cpu_count,
+            max_requests = server_args.max_requests,
+            cache_path = args.cache or directory,
+            max_body = server_args.max_body,
+            quiet = server_args.quiet,
+        )
+
+        print(f'Serving on http://{server_args.host}:{server.server_address[1]}; cache in {server.cache_path}.', file = sys.stderr)
+
+        # Stop as on Ctrl-C when terminated, so that the workers are shut down too.
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+
+if __name__ == '__main__':
+    main()
@@ -4,10 +4,14 @@ import argparse
 import random
 import re
 import sys
-from Experiment import Experiment, Phase, RWArgs
-from Environment import StimulusHistory
-from Plots import generate_figures, save_plots
+from typing import Any, Callable, Iterator
+from Experiment import Experiment, Phase, RWArgs, executors
+from Environment import StimulusHistory, StimulusSummary
 from Models import Model
+from HistoryStore import HistoryStore
+from ResultCache import ResultCache
+from Profiler import Profiler
+from Counters import Counters
 
 from version import __version__
 
@@ -27,7 +31,9 @@ def match_args(name: str, args: list[str]) -> tuple[dict[str, float], list[str]]
 
     return values, rest
 
-def parse_args():
+# Parser of the command-line arguments; its defaults are also the defaults of
+# the parameters of the Python API, see default_args.
+def make_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(
         description="Behold! My Rescorla-Wagnerinator!",
         formatter_class = argparse.RawTextHelpFormatter,
@@ -48,6 +54,20 @@ def parse_args():
     output.add_argument('--show-title', action = 'store_true', help = 'Show title and phases to saved output.')
     output.add_argument('--dpi', type = int, default = 200, help = 'Dots per inch.')
     output.add_argument('--output-width', type = int, default = 11, help = 'Width of the output')
+    output.add_argument('--summary', action = 'store_true', help = 'Only record summary statistics instead of the full history of every trial. Results are printed, or saved with --save-results.')
+    output.add_argument('--summary-stats', metavar = 'statistics', type = lambda x: x.split(','), default = StimulusSummary.stats, help = f'Comma-separated statistics recorded by --summary. In randomised phases, every statistic is that of the trials averaged over the random trials, which keeps a value for every trial. Default: {",".join(StimulusSummary.stats)}.')
+    output.add_argument('--history-precision', choices = ['float64', 'float32'], default = 'float64', help = 'Precision in which the results are stored. The simulation always runs in float64.')
+    output.add_argument('--history-stride', metavar = 'N', type = int, default = 1, help = 'Only store every Nth trial of each stimulus.')
+    output.add_argument('--store', metavar = 'directory', type = str, help = 'Write the results to an on-disk history store as each group finishes, rather than keeping them in memory. The results of a single group are still kept in memory until it finishes, so this bounds the memory of experiments with many groups, not that of a single long group.')
+    output.add_argument('--from-store', metavar = 'directory', type = str, help = 'Plot or export the results of a history store written with --store, instead of running an experiment.')
+    output.add_argument('--cache', metavar = 'directory', type = str, help = 'Reuse the results of groups already run with the same parameters, stored in this directory.')
+    output.add_argument('--batch', metavar = 'directory', type = str, help = 'Run every .rw file of a directory on a single pool of workers, writing the results and plots of each file to --out along with a manifest.json. The results are cached in --cache, or in the cache directory of --out.')
+    output.add_argument('--out', metavar = 'directory', type = str, default = 'results', help = 'Output directory of --batch.')
+    output.add_argument('--watch', action = 'store_true', help = 'Keep running, and rerun the groups that changed whenever the experiment file is saved, refreshing the figures or output files.')
+    output.add_argument('--profile', action = 'store_true', help = 'Print the wall time of every stage of the run: parsing, simulating every phase of every group, exporting and plotting.')
+    output.add_argument('--profile-dump', metavar = 'filename', type = str, help = 'Also save a cProfile of the simulation, readable with pstats. Implies --profile.')
+    output.add_argument('--stats', action = 'store_true', help = 'Print the number of trials, model steps, lookups, Stimulus allocations and bytes sent to workers of every phase of every group.')
+    output.add_argument('--block-size', type = int, default = 10, help = 'Number of trials in each block of --summary block.')
 
     plot = parser.add_argument_group('Plotting parameters')
     plot.add_argument('--plot-phase', type = int, metavar = 'phase_num', help = 'Plot a single phase')
@@ -57,6 +77,7 @@ def parse_args():
     plot.add_argument('--plot-macknhall', default = False, action = argparse.BooleanOptionalAction, help = 'Whether to plot the alpha Mack and alpha Hall.')
     plot.add_argument('--plot-alphas', default = False, action = argparse.BooleanOptionalAction, help = 'Whether to plot all the alphas, including total alpha, alpha Mack, and alpha Hall.')
     plot.add_argument('--part-stimuli', default = False, action = argparse.BooleanOptionalAction, help = 'Whether to plot part stimuli with US in addition to the regular plot.')
+    plot.add_argument('--compound-context', default = False, action = argparse.BooleanOptionalAction, help = 'With --part-stimuli, also plot every CS of a compound in the context of its trial, as in "A{AX+}".')
 
     experiment = parser.add_argument_group('Experiment Parameters')
     experiment.add_argument("--model", choices = Model.types().keys(), default = 'Rescorla Wagner', help = 'Type of adaptive attention mode to use')
@@ -78,6 +99,7 @@ def parse_args():
     experiment.add_argument("--nu", metavar = 'ν', type = float, default = .25)
     experiment.add_argument("--kay", metavar = 'κ', type = float, default = 2)
     experiment.add_argument('--max-workers', type = int, help = 'Maximum number of multiprocessing cores used in randomised phases. This is constrained by the total CPU count and number of trials.')
+    experiment.add_argument('--executor', choices = executors, default = 'auto', help = 'How the random trials of randomised phases run in parallel: serial, in threads, in subinterpreters (Python 3.14+) or in processes. The default runs each phase in whichever way a cost model, calibrated on the first randomised phase, estimates is fastest, so that small phases never start a pool. Every executor and number of workers gives the same results.')
 
     parser.add_argument('--version', action = 'store_true', help = 'Show program version and exit.')
 
@@ -89,6 +111,11 @@ def parse_args():
         help = "Path to the experiment file."
     )
 
+    return parser
+
+def parse_args():
+    parser = make_parser()
+
     # Accept parameters for alphas, saliences, and habituations.
     args, rest = parser.parse_known_args()
 
@@ -104,82 +131,313 @@ def parse_args():
     if rest:
         raise KeyError(f"Arguments not recognised: {' '.join(rest)}.")
 
+    if args.block_size < 1:
+        raise ValueError('--block-size must be at least 1.')
+
+    if args.history_stride < 1:
+        raise ValueError('--history-stride must be at least 1.')
+
     args.use_adaptive = args.model is not None
 
     if args.plot_alphas:
         args.plot_alpha = True
         args.plot_macknhall = True
 
-    return args
+    if not args.summary:
+        args.summary = None
+    else:
+        unknown = set(args.summary_stats) - set(StimulusSummary.stats)
+        if unknown:
+            raise KeyError(f"Unknown summary statistics: {', '.join(sorted(unknown))}.")
 
-def runExperiment(experiment_file, experiment_args, plot_experiments = None, max_workers = None):
-    groups_strengths = None
-    phases: dict[str, list[Phase]] = dict()
+        args.summary = args.summary_stats
 
-    for e, experiment in enumerate(experiment_file.readlines()):
-        experiment = experiment.strip()
+        if args.savefig is not None:
+            raise ValueError('--savefig cannot be used with --summary, since no history is recorded.')
 
-        if not experiment or experiment.startswith('#'):
-            continue
+        if args.store is not None or args.from_store is not None:
+            raise ValueError('History stores cannot be used with --summary, since no history is recorded.')
 
-        if experiment.startswith('@'):
-            for prop in experiment.strip('@').split(';'):
-                name, value = prop.split('=')
-                replacements = {'adaptive_type': 'model', 'betap': 'beta', 'betan': 'beta_neg', 'lambda': 'lamda'}
-                name = replacements.get(name, name)
-
-                if '_' in name and name.split('_')[-1].isupper():
-                    perc, cs = name.rsplit('_', 1)
-                    getattr(experiment_args, perc + 's')[cs] = float(value)
-                else:
-                    experiment_args.set_value(name, value)
-            continue
+    if args.watch:
+        if args.experiment_file is sys.stdin:
+            raise ValueError('--watch needs an experiment file.')
+
+        if args.store is not None or args.from_store is not None or args.batch is not None:
+            raise ValueError('--watch cannot be used with history stores or --batch.')
+
+    return args
 
-        name, *phase_strs = experiment.strip().split('|')
-        name = name.strip()
+# Parameters of an experiment with every default of the command line, and no
+# parameters for single CS.
+def default_args() -> RWArgs:
+    args = make_parser().parse_known_args([])[0]
+    args.summary = None
+    return RWArgs(
+        alphas = {}, alpha_macks = {}, alpha_halls = {}, saliences = {}, habituations = {},
+        **{k: v for k, v in args.__dict__.items() if k in set(RWArgs.__match_args__) and v is not None},
+    )
 
+# Name of a parameter given as in the "@" lines of an experiment file in
+# RWArgs, along with the CS it applies to, if any.
+def experiment_arg_name(name: str) -> tuple[str, None | str]:
+    replacements = {'adaptive_type': 'model', 'betap': 'beta', 'betan': 'beta_neg', 'lambda': 'lamda'}
+    name = replacements.get(name, name)
+
+    if '_' in name and name.split('_')[-1].isupper():
+        perc, cs = name.rsplit('_', 1)
+        return perc + 's', cs
+
+    return name, None
+
+# Set a parameter given as in the "@" lines of an experiment file, such as
+# "beta", "betan", or "alpha_A" for a single CS.
+def set_experiment_arg(experiment_args: RWArgs, name: str, value: str):
+    name, cs = experiment_arg_name(name)
+    if cs is not None:
+        getattr(experiment_args, name)[cs] = float(value)
+    else:
+        experiment_args.set_value(name, value)
+
+def get_experiment_arg(experiment_args: RWArgs, name: str) -> Any:
+    name, cs = experiment_arg_name(name)
+    if cs is not None:
+        return getattr(experiment_args, name).get(cs)
+
+    return experiment_args.get(name)
+
+# Yield the name and phases of every group of an experiment file, in order.
+# Parameter lines starting with "@" are applied to experiment_args as they are
+# read, so they affect the groups after them.
+def parse_experiment_file(experiment_file, experiment_args: RWArgs) -> Iterator[tuple[str, list[str]]]:
+    for experiment in experiment_file.readlines():
+        with Profiler.stage('parse'):
+            experiment = experiment.strip()
+
+            if not experiment or experiment.startswith('#'):
+                continue
+
+            if experiment.startswith('@'):
+                for prop in experiment.strip('@').split(';'):
+                    name, value = prop.split('=')
+                    set_experiment_arg(experiment_args, name, value)
+                continue
+
+            name, *phase_strs = experiment.strip().split('|')
+
+        yield name.strip(), phase_strs
+
+# Run a single group, or read its results from the cache. Returns the results
+# and the phases of the group.
+def runGroup(name: str, phase_strs: list[str], experiment_args: RWArgs, max_workers: None | int = None, cache: None | ResultCache = None) -> tuple[list[dict[str, StimulusHistory]], list[Phase]]:
+    with Profiler.stage(f'group {name}'):
+        with Profiler.stage('construct'):
+            experiment = Experiment(name, phase_strs, max_workers = max_workers)
+            for phase, keys in zip(experiment.phases, experiment.result_keys(experiment_args)):
+                phase.keys = keys
+
+        if cache is None:
+            return experiment.run_all_phases(experiment_args), experiment.phases
+
+        key = cache.key(name, phase_strs, experiment_args)
+        strengths = cache.get(key)
+        if strengths is None:
+            strengths = experiment.run_all_phases(experiment_args)
+            cache.put(key, strengths)
+
+        return strengths, experiment.phases
+
+# Run every group of an experiment file. If a HistoryStore is given, the results
+# of each group are written to it as soon as they finish and the returned
+# results are read back from it.
+def runExperiment(experiment_file, experiment_args, plot_experiments = None, max_workers = None, store: None | HistoryStore = None, cache: None | ResultCache = None):
+    groups_strengths = None
+    phases: dict[str, list[Phase]] = dict()
+
+    for name, phase_strs in parse_experiment_file(experiment_file, experiment_args):
         if groups_strengths is None:
             groups_strengths = [StimulusHistory.emptydict() for _ in phase_strs]
 
         if plot_experiments is not None and name not in plot_experiments:
             continue
 
-        experiment = Experiment(name, phase_strs, max_workers = max_workers)
-        local_strengths = experiment.run_all_phases(experiment_args)
+        local_strengths, phases[name] = runGroup(name, phase_strs, experiment_args, max_workers, cache)
+
+        if store is not None:
+            store.write_group(name, phase_strs, local_strengths)
+            continue
+
         groups_strengths = [a | b for a, b in zip(groups_strengths, local_strengths)]
-        phases[name] = experiment.phases
+
+    if store is not None:
+        store.close()
+        return store.strengths(), store.phases()
 
     return groups_strengths, phases
 
+# Main function of a mode of the command-line interface, as "cli mode", or
+# None if there's no such mode. Every module is imported by name, rather
+# than from a string, so that PyInstaller bundles them.
+def mode_main(mode: str) -> None | Callable[[], None]:
+    if mode == 'sweep':
+        import Sweep
+        return Sweep.main
+
+    if mode == 'fit':
+        import Fit
+        return Fit.main
+
+    if mode == 'sensitivity':
+        import Sensitivity
+        return Sensitivity.main
+
+    if mode == 'mcmc':
+        import MCMC
+        return MCMC.main
+
+    if mode == 'population':
+        import Population
+        return Population.main
+
+    if mode == 'benchmark':
+        import Benchmark
+        return Benchmark.main
+
+    if mode == 'equivalence':
+        import Equivalence
+        return Equivalence.main
+
+    if mode == 'serve':
+        import Server
+        return Server.main
+
+    return None
+
 def main() -> None:
+    mode = mode_main(sys.argv[1]) if len(sys.argv) > 1 else None
+    if mode is not None:
+        sys.argv[0] = f'{sys.argv[0]} {sys.argv[1]}'
+        sys.argv[1:] = sys.argv[2:]
+        mode()
+        return
+
     args = parse_args()
+
+    if args.profile or args.profile_dump is not None:
+        with Profiler(profile_simulation = args.profile_dump is not None) as profiler:
+            figures = run(args)
+
+        print(profiler.table(), file = sys.stderr)
+        if args.profile_dump is not None:
+            profiler.dump(args.profile_dump)
+    else:
+        figures = run(args)
+
+    # Wait for the shown figures to be closed, outside of the profiled run.
+    if figures:
+        input('Press any key to continue...')
+
+# Run an experiment with the given arguments, writing its outputs. Returns the
+# figures shown, if any.
+def run(args) -> None | list[Any]:
     experiment_args = RWArgs(
         **{k: v for k, v in args.__dict__.items() if k in set(RWArgs.__match_args__) and v is not None}
     )
 
-    groups_strengths, phases = runExperiment(
-        experiment_file = args.experiment_file,
-        experiment_args = experiment_args,
-        plot_experiments = args.plot_experiments,
-        max_workers = args.max_workers,
+    if args.batch is not None:
+        import BatchDirectory
+        manifest = BatchDirectory.run_directory(args, experiment_args)
+        print(f'Ran {len(manifest["files"])} files in {manifest["total_seconds"]:.2f}s; results in {args.out}.')
+        return None
+
+    # Only record the stimuli that will be plotted, unless the results are also exported.
+    if args.save_results is None and not args.print_results:
+        experiment_args.record_stimuli = args.plot_stimuli
+
+    if args.watch:
+        import Watch
+        Watch.watch(args, experiment_args)
+        return None
+
+    Counters.measure_ipc = args.stats
+
+    if args.from_store is not None:
+        store = HistoryStore.open(args.from_store)
+        groups_strengths, phases = store.strengths(), store.phases()
+    else:
+        groups_strengths, phases = runExperiment(
+            experiment_file = args.experiment_file,
+            experiment_args = experiment_args,
+            plot_experiments = args.plot_experiments,
+            max_workers = args.max_workers,
+            store = None if args.store is None else HistoryStore.create(args.store, args.history_precision, args.history_stride),
+            cache = None if args.cache is None else ResultCache(args.cache),
+        )
+
+    if args.stats:
+        print(stats_table(phases), file = sys.stderr)
+
+    if args.summary is None and args.savefig is None and args.save_results is None and not args.print_results:
+        # Plots imports Matplotlib, which is only loaded when figures are drawn.
+        from Plots import generate_figures
+
+        with Profiler.stage('generate_figures'):
+            figures = generate_figures(
+                groups_strengths,
+                phases = phases,
+                plot_phase = args.plot_phase,
+                plot_alpha = args.plot_alpha,
+                plot_macknhall = args.plot_macknhall,
+                plot_stimuli = args.plot_stimuli,
+                dpi = args.dpi,
+            )
+
+        with Profiler.stage('draw'):
+            for fig in figures:
+                fig.show()
+
+        return figures
+
+    write_results(args, groups_strengths, phases)
+    return None
+
+# Table of the counts of the operations of every phase of every group, as
+# recorded in the phases by the last run; see Counters.
+def stats_table(phases: dict[str, list[Phase]]) -> str:
+    names = list(Counters.totals)
+    header = ['Group', 'Phase'] + names + ['stimuli/trial']
+
+    rows = []
+    for name, group_phases in phases.items():
+        for phase_num, phase in enumerate(group_phases, start = 1):
+            if phase.counters is None:
+                rows.append([name, str(phase_num)] + ['-'] * (len(names) + 1))
+                continue
+
+            per_trial = phase.counters['stimuli'] / phase.counters['trials'] if phase.counters['trials'] else 0
+            rows.append([name, str(phase_num)] + [str(phase.counters[k]) for k in names] + [f'{per_trial:.1f}'])
+
+    widths = [max(len(row[e]) for row in [header] + rows) for e in range(len(header))]
+    return '\n'.join(
+        ' '.join(x.ljust(w) if e < 2 else x.rjust(w) for e, (x, w) in enumerate(zip(row, widths)))
+        for row in [header] + rows
     )
 
-    if args.savefig is None and args.save_results is None and not args.print_results:
-        figures = generate_figures(
-            groups_strengths,
-            phases = phases,
-            plot_phase = args.plot_phase,
-            plot_alpha = args.plot_alpha,
-            plot_macknhall = args.plot_macknhall,
-            plot_stimuli = args.plot_stimuli,
-            dpi = args.dpi,
-        )
-        for fig in figures:
-            fig.show()
-        input('Press any key to continue...')
+# Write the results of an experiment to every output given in the arguments:
+# summaries, figures, and saved or printed results.
+def write_results(args, groups_strengths: list[dict[str, StimulusHistory]], phases: dict[str, list[Phase]]):
+    if args.summary is not None:
+        with Profiler.stage('export'):
+            if args.save_results is not None:
+                with open(args.save_results, 'w') as file:
+                    StimulusSummary.exportData(groups_strengths, file = file, stats = args.summary, should_plot_macknhall = args.plot_macknhall)
+
+            if args.print_results or args.save_results is None:
+                StimulusSummary.exportData(groups_strengths, file = sys.stdout, stats = args.summary, should_plot_macknhall = args.plot_macknhall)
+
         return
 
     if args.savefig is not None:
+        from Plots import save_plots
         save_plots(
             groups_strengths,
             phases = phases,
@@ -194,20 +452,21 @@ def main() -> None:
             plot_width = args.output_width,
         )
 
-    if args.save_results is not None:
-        with open(args.save_results, 'w') as file:
+    with Profiler.stage('export'):
+        if args.save_results is not None:
+            with open(args.save_results, 'w') as file:
+                StimulusHistory.exportData(
+                    groups_strengths,
+                    file = file,
+                    should_plot_macknhall = args.plot_macknhall,
+                )
+
+        if args.print_results:
             StimulusHistory.exportData(
                 groups_strengths,
-                file = file,
+                file = sys.stdout,
                 should_plot_macknhall = args.plot_macknhall,
             )
 
-    if args.print_results:
-        StimulusHistory.exportData(
-            groups_strengths,
-            file = sys.stdout,
-            should_plot_macknhall = args.plot_macknhall,
-        )
-
 if __name__ == '__main__':
     main()
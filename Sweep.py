@@ -0,0 +1,175 @@
+from __future__ import annotations
+
+import argparse
+import copy
+import itertools
+import os
+import sys
+from csv import DictWriter
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any
+
+import numpy
+
+import Simulator
+from BatchEngine import BatchEngine
+from Experiment import Experiment, RWArgs
+from HistoryStore import HistoryStore
+
+# Parse the values of a swept parameter: either a comma-separated list
+# "0.1,0.2,0.5", or an inclusive range "start:stop:num" of num values.
+def parse_values(values: str) -> list[str]:
+    if values.count(':') == 2:
+        start, stop, num = values.split(':')
+        return [repr(float(x)) for x in numpy.linspace(float(start), float(stop), int(num))]
+
+    return [x.strip() for x in values.split(',')]
+
+def parse_param(param: str) -> tuple[str, list[str]]:
+    if '=' not in param:
+        raise argparse.ArgumentTypeError(f'Parameters must be given as name=values, not "{param}".')
+
+    name, values = param.split('=', maxsplit = 1)
+    return name.strip(), parse_values(values)
+
+def parse_args() -> tuple[argparse.Namespace, argparse.Namespace]:
+    parser = argparse.ArgumentParser(
+        description = 'Run an experiment for every combination of the swept parameters, and write one table of results.',
+        formatter_class = argparse.RawTextHelpFormatter,
+        epilog = '''\
+Any other option of the command-line interface sets the parameters that are
+not swept. Results are printed, or saved with --save-results.
+
+Example:
+  %(prog)s Experiments/LIrr-LePelley.rw --param beta=0.1:0.9:9 --param alpha_A=0.1,0.5
+''',
+    )
+    parser.add_argument('--param', metavar = 'name=values', type = parse_param, action = 'append', default = [], help = 'Parameter to sweep, named as in the "@" lines of experiment files: beta, betan, alpha_A, model, ...\nValues are either "a,b,c" or an inclusive range "start:stop:num".')
+    parser.add_argument('--chunk-size', type = int, default = 64, help = 'Number of parameter sets simulated together by each worker.')
+    parser.add_argument('--seed', type = int, help = 'Seed for the random orders of randomised phases, which are shared by all parameter sets.')
+    parser.add_argument('--trajectories', action = 'store_true', help = 'Write every trial, rather than only the last trial of each phase.')
+
+    args, rest = parser.parse_known_args()
+    if not args.param:
+        raise ValueError('At least one --param is needed.')
+
+    sys.argv[1:] = rest
+    return args, Simulator.parse_args()
+
+# Every combination of the swept parameters, in order.
+def sweep_points(params: list[tuple[str, list[str]]]) -> list[dict[str, str]]:
+    names = [name for name, _ in params]
+    return [dict(zip(names, values)) for values in itertools.product(*[values for _, values in params])]
+
+def point_args(base: RWArgs, point: dict[str, str]) -> RWArgs:
+    args = copy.deepcopy(base)
+    for name, value in point.items():
+        Simulator.set_experiment_arg(args, name, value)
+
+    return args
+
+# Run a single group for a chunk of parameter sets, returning the rows of the results table.
+def run_chunk(name: str, phase_strs: list[str], points: list[tuple[int, dict[str, str]]], args: list[RWArgs], seed: int, trajectories: bool) -> list[dict[str, Any]]:
+    experiment = Experiment(name, phase_strs)
+    engine = BatchEngine(experiment, args, seed = seed)
+    results = engine.run()
+
+    fields = HistoryStore.fields
+    rows = []
+    for num, (point, values) in enumerate(points):
+        for phase_num, phase in enumerate(results, start = 1):
+            for key, hist in phase.items():
+                trials = range(0, hist.shape[1]) if trajectories else range(hist.shape[1] - 1, hist.shape[1])
+                for trial in trials:
+                    row = dict(zip(fields, hist[num, trial].tolist()))
+                    rows.append({
+                        'Point': point,
+                        **values,
+                        'Phase': phase_num,
+                        'Group': experiment.name,
+                        'CS': key.replace('(', 'q('),
+                        'Trial': trial * engine.record.stride + 1,
+                        'Assoc': row['assoc'],
+                        'Ve': row['Ve'],
+                        'Vi': row['Vi'],
+                        'Alpha': row['alpha'],
+                        'Alpha Mack': row['alpha_mack'],
+                        'Alpha Hall': row['alpha_hall'],
+                    })
+
+    return rows
+
+def main():
+    sweep_args, args = parse_args()
+
+    if args.summary is not None or args.savefig is not None or args.store is not None:
+        raise ValueError('Sweeps only write a table of results; --summary, --savefig and --store cannot be used.')
+
+    base = RWArgs(
+        **{k: v for k, v in args.__dict__.items() if k in set(RWArgs.__match_args__) and v is not None}
+    )
+    base.record_stimuli = args.plot_stimuli
+
+    # The "@" lines of the file only affect the groups after them, so every
+    # group keeps a copy of the parameters as they were when it was read.
+    groups = [
+        (name, phase_strs, copy.deepcopy(base))
+        for name, phase_strs in Simulator.parse_experiment_file(args.experiment_file, base)
+        if args.plot_experiments is None or name in args.plot_experiments
+    ]
+
+    points = sweep_points(sweep_args.param)
+
+    # All chunks share the same random orders, so that differences between
+    # parameter sets are not due to the orders of the trials.
+    seed = sweep_args.seed
+    if seed is None:
+        seed = int(numpy.random.SeedSequence().generate_state(1)[0])
+
+    # Parameter sets of a group are batched together when they use the same
+    # model, number of random trials and configural cues.
+    tasks = []
+    for name, phase_strs, group_args in groups:
+        experiment = Experiment(name, phase_strs)
+        point_argss = [point_args(group_args, point) for point in points]
+
+        batches: dict[tuple[str, int, bool], list[int]] = {}
+        for num, a in enumerate(point_argss):
+            batches.setdefault((a.model, a.num_trials, experiment.configural_cues(a)), []).append(num)
+
+        for nums in batches.values():
+            for start in range(0, len(nums), sweep_args.chunk_size):
+                chunk = nums[start : start + sweep_args.chunk_size]
+                tasks.append((name, phase_strs, [(num + 1, points[num]) for num in chunk], [point_argss[num] for num in chunk]))
+
+    cpu_count = getattr(os, 'process_cpu_count', os.cpu_count)() or 1
+    max_workers = min(len(tasks) or 1, args.max_workers or cpu_count)
+    with ProcessPoolExecutor(max_workers = max_workers) as executor:
+        futures = [
+            executor.submit(run_chunk, name, phase_strs, chunk_points, chunk_args, seed, sweep_args.trajectories)
+            for name, phase_strs, chunk_points, chunk_args in tasks
+        ]
+        rows = [row for f in futures for row in f.result()]
+
+    rows.sort(key = lambda row: row['Point'])
+
+    fieldnames = ['Point'] + [name for name, _ in sweep_args.param] + ['Phase', 'Group', 'CS', 'Trial', 'Assoc', 'Ve', 'Vi']
+    if not args.plot_macknhall:
+        fieldnames += ['Alpha']
+    else:
+        fieldnames += ['Alpha Mack', 'Alpha Hall']
+
+    def write(file):
+        writer = DictWriter(file, fieldnames = fieldnames, extrasaction = 'ignore')
+        writer.writeheader()
+        writer.writerows(rows)
+
+    if args.save_results is not None:
+        with open(args.save_results, 'w') as file:
+            write(file)
+
+    if args.print_results or args.save_results is None:
+        write(sys.stdout)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+from __future__ import annotations
+
+import copy
+import os
+import sys
+import time
+from argparse import Namespace
+from typing import Any
+
+import Simulator
+from Environment import StimulusHistory
+from Experiment import Phase, RWArgs
+from ResultCache import ResultCache
+
+# Keeps the results of every group of an experiment file, and reruns only the
+# groups whose phases or parameters changed whenever the file is updated.
+# A group is identified by its name, and its parameters include every "@" line
+# above it, so editing a parameter line reruns only the groups after it.
+class Watcher:
+    path: str
+    args: Namespace
+    experiment_args: RWArgs
+    cache: None | ResultCache
+
+    # Results of every group by name, along with the key of the definition
+    # they were run with.
+    results: dict[str, tuple[str, list[dict[str, StimulusHistory]], list[Phase]]]
+
+    def __init__(self, path: str, args: Namespace, experiment_args: RWArgs, cache: None | ResultCache = None):
+        self.path = path
+        self.args = args
+        self.experiment_args = experiment_args
+        self.cache = cache
+        self.results = {}
+
+    # Groups of the file, by name, with their phases and the parameters that apply to them.
+    def read_groups(self) -> dict[str, tuple[list[str], RWArgs]]:
+        file_args = copy.deepcopy(self.experiment_args)
+        with open(self.path) as file:
+            return {
+                name: (phase_strs, copy.deepcopy(file_args))
+                for name, phase_strs in Simulator.parse_experiment_file(file, file_args)
+                if self.args.plot_experiments is None or name in self.args.plot_experiments
+            }
+
+    # Rerun the groups that changed since the last update. Returns the names
+    # of the groups that were rerun and of those that were removed.
+    def update(self) -> tuple[list[str], list[str]]:
+        groups = self.read_groups()
+
+        removed = [name for name in self.results if name not in groups]
+        for name in removed:
+            del self.results[name]
+
+        rerun = []
+        for name, (phase_strs, args) in groups.items():
+            key = ResultCache.key(name, phase_strs, args)
+            if name in self.results and self.results[name][0] == key:
+                continue
+
+            strengths, phases = Simulator.runGroup(name, phase_strs, args, self.args.max_workers, self.cache)
+            self.results[name] = key, strengths, phases
+            rerun.append(name)
+
+        # Keep the order of the file.
+        self.results = {name: self.results[name] for name in groups}
+
+        return rerun, removed
+
+    # Results of every group, as Simulator.runExperiment.
+    def strengths(self) -> tuple[list[dict[str, StimulusHistory]], dict[str, list[Phase]]]:
+        groups_strengths: list[dict[str, StimulusHistory]] = []
+        for _, local, _ in self.results.values():
+            if not groups_strengths:
+                groups_strengths = [StimulusHistory.emptydict() for _ in local]
+
+            groups_strengths = [a | b for a, b in zip(groups_strengths, local)]
+
+        return groups_strengths, {name: phases for name, (_, _, phases) in self.results.items()}
+
+# Write or draw the results of every group again, returning the figures.
+# Figures already shown are redrawn in their windows; only those of new
+# phases are opened, and those of removed phases are closed.
+def refresh(args: Namespace, watcher: Watcher, figures: list[Any], interactive: bool) -> list[Any]:
+    groups_strengths, phases = watcher.strengths()
+    if not interactive:
+        Simulator.write_results(args, groups_strengths, phases)
+        return figures
+
+    from matplotlib import pyplot
+    from Plots import generate_figures
+
+    # Windows closed by the user are opened again.
+    figures = [fig for fig in figures if pyplot.fignum_exists(fig.number)]
+
+    new_figures = generate_figures(
+        groups_strengths,
+        phases = phases,
+        plot_phase = args.plot_phase,
+        plot_alpha = args.plot_alpha,
+        plot_macknhall = args.plot_macknhall,
+        plot_stimuli = args.plot_stimuli,
+        dpi = args.dpi,
+        reuse_figures = figures,
+    )
+
+    for fig in figures[len(new_figures):]:
+        pyplot.close(fig)
+
+    for fig in new_figures[:len(figures)]:
+        fig.canvas.draw_idle()
+
+    for fig in new_figures[len(figures):]:
+        fig.show()
+
+    return new_figures
+
+# Run an experiment file and rerun it whenever it's saved, refreshing the
+# outputs given in the arguments; without outputs, the figures are shown and
+# redrawn in place. Runs until interrupted.
+def watch(args: Namespace, experiment_args: RWArgs, interval: float = .5):
+    path = args.experiment_file.name
+    args.experiment_file.close()
+
+    watcher = Watcher(path, args, experiment_args, None if args.cache is None else ResultCache(args.cache))
+
+    interactive = args.summary is None and args.savefig is None and args.save_results is None and not args.print_results
+    if interactive:
+        from matplotlib import pyplot
+        pyplot.ion()
+
+    figures: list[Any] = []
+    mtime = None
+    print(f'Watching {path}; press Ctrl-C to stop.', file = sys.stderr)
+
+    try:
+        while True:
+            try:
+                current = os.stat(path).st_mtime_ns
+            except FileNotFoundError:
+                # Editors may replace the file when saving it.
+                current = None
+
+            if current is not None and current != mtime:
+                mtime = current
+                start = time.perf_counter()
+
+                # Keep watching after errors, since the file may be saved halfway through an edit.
+                try:
+                    rerun, removed = watcher.update()
+                    if rerun or removed:
+                        figures = refresh(args, watcher, figures, interactive)
+                except Exception as e:
+                    print(f'Error in {path}: {e}', file = sys.stderr)
+                    continue
+
+                changes = [f'reran {", ".join(rerun)}'] if rerun else []
+                changes += [f'removed {", ".join(removed)}'] if removed else []
+                print(f'{time.strftime("%H:%M:%S")} {"; ".join(changes) or "no changes"} ({time.perf_counter() - start:.2f}s).', file = sys.stderr)
+
+            if interactive:
+                pyplot.pause(interval)
+            else:
+                time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,85 @@
+from __future__ import annotations
+
+import copy
+import random
+from pathlib import Path
+
+import numpy
+import pytest
+
+import Api
+import Equivalence
+import Simulator
+from Experiment import RWArgs, executors
+from Models import Model
+
+# Checks of the results of the simulation, run with `python -m pytest`.
+# Randomised phases run a few random trials, so that every experiment and
+# model runs in a few seconds.
+num_trials = 12
+
+experiment_files = sorted((Path(__file__).parent / 'Experiments').glob('*.rw'))
+
+# Groups of an experiment file, with the parameters of its "@" lines.
+def read_groups(path: Path) -> list[tuple[str, list[str], RWArgs]]:
+    args = Simulator.default_args()
+    with open(path) as file:
+        return [
+            (name, phase_strs, copy.deepcopy(args))
+            for name, phase_strs in Simulator.parse_experiment_file(file, args)
+        ]
+
+# The batch engine reproduces the reference simulation with every model.
+@pytest.mark.parametrize('model', list(Model.types()))
+@pytest.mark.parametrize('path', experiment_files, ids = lambda x: x.stem)
+def test_equivalence(path: Path, model: str):
+    for name, phase_strs, args in read_groups(path):
+        args.model = model
+        args.num_trials = num_trials
+
+        expected = Equivalence.reference(name, phase_strs, copy.deepcopy(args), 0)
+        actual = Equivalence.batch(name, phase_strs, copy.deepcopy(args), 0)
+        failures = [d for d in Equivalence.compare(name, expected, actual, atol = 1e-12, rtol = 1e-9) if not d.ok]
+        assert not failures
+
+design = 'Blocking|rand/6A+/4AB+/3B-|rand/5AB-/5C+\nControl|rand/4A+/4C-|6AC+'
+
+# Every executor and number of workers gives the same results, bit for bit.
+@pytest.mark.parametrize('max_workers', [2, 3])
+@pytest.mark.parametrize('executor', [x for x in executors if x not in ('serial', 'interpreters')])
+def test_executors(executor: str, max_workers: int):
+    random.seed(0)
+    expected = Api.simulate(design, num_trials = 40, executor = 'serial', max_workers = 1)
+
+    random.seed(0)
+    actual = Api.simulate(design, num_trials = 40, executor = executor, max_workers = max_workers)
+
+    assert numpy.array_equal(expected.values, actual.values, equal_nan = True)
+
+# Summaries have the same final values, extremes and block means as the full
+# history, including those of randomised phases.
+@pytest.mark.parametrize('model', list(Model.types()))
+def test_summary(model: str):
+    random.seed(0)
+    results = Api.simulate(design, model, num_trials = 30)
+
+    random.seed(0)
+    summaries = Api.simulate(design, model, num_trials = 30, summary = True, block_size = 4)
+
+    assert summaries.groups == results.groups
+    assert summaries.cs == results.cs
+    for g, group in enumerate(results.groups):
+        for p in range(len(results.phases[group])):
+            for c, cs in enumerate(results.cs):
+                assert summaries.counts[g, p, c] == results.lengths[g, p, c]
+                if results.lengths[g, p, c] == 0:
+                    continue
+
+                for field in summaries.fields:
+                    history = results.get(field, group, p + 1, cs)
+                    assert summaries.get('final', field, group, p + 1, cs) == pytest.approx(history[-1], abs = 1e-12)
+                    assert summaries.get('min', field, group, p + 1, cs) == pytest.approx(history.min(), abs = 1e-12)
+                    assert summaries.get('max', field, group, p + 1, cs) == pytest.approx(history.max(), abs = 1e-12)
+
+                    blocks = [history[start : start + 4].mean() for start in range(0, len(history), 4)]
+                    assert summaries.get('block', field, group, p + 1, cs) == pytest.approx(blocks, abs = 1e-12)